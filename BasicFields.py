@@ -28,6 +28,7 @@ import warnings
 import re
 from Globals import InitializeClass
 from DateTime.DateTime import DateTime
+from Acquisition import aq_base
 
 from OFS.Image import cookId, File, Image
 
@@ -38,8 +39,13 @@ from Products.CPSSchemas.Field import CPSField, FieldRegistry
 from Products.CPSSchemas.Field import ValidationError
 from Products.CPSSchemas.FileUtils import convertFileToHtml
 from Products.CPSSchemas.FileUtils import convertFileToText
+from Products.CPSSchemas.FileUtils import getFileFingerprint
+from Products.CPSSchemas.ConversionQueue import queueConversion
 from Products.CPSSchemas.FileUtils import FileObjectFactory
 from Products.CPSSchemas.DiskFile import DiskFile
+from Products.CPSSchemas.DiskFile import LAYOUTS as DISK_FILE_LAYOUTS
+from Products.CPSSchemas.DiskFile import FLAT_LAYOUT as DISK_FILE_FLAT_LAYOUT
+from Products.CPSSchemas.DiskFileTransaction import getDataManager
 
 from zope.interface import implements
 from Products.CPSSchemas.interfaces import IFileField
@@ -47,6 +53,7 @@ from Products.CPSSchemas.interfaces import IImageField
 from Products.CPSSchemas.interfaces import IFieldNodeIO
 
 from Products.CPSUtil.text import OLD_CPS_ENCODING
+from Products.CPSUtil.file import ofsFileHandler
 
 logger = getLogger(__name__)
 
@@ -745,10 +752,13 @@ class CPSFileField(CPSField):
          'label': 'Suffix for field containing HTML conversion'},
         {'id': 'suffix_html_subfiles', 'type': 'string', 'mode': 'w',
          'label': 'Suffix for field containing HTML conversion subobjects'},
+        {'id': 'deferred_conversions', 'type': 'boolean', 'mode': 'w',
+         'label': 'Conversions done after the transaction commit'},
         )
     suffix_text = ''
     suffix_html = ''
     suffix_html_subfiles = ''
+    deferred_conversions = False
 
 
     def _getDependantFieldsBaseId(self):
@@ -772,7 +782,8 @@ class CPSFileField(CPSField):
                     self.suffix_html_subfiles)
         return tuple(base_id + suffix for suffix in suffixes if suffix)
 
-    def computeDependantFields(self, schemas, data, context=None):
+    def computeDependantFields(self, schemas, data, context=None,
+                               datamodel=None):
         """Compute dependant fields.
 
         schemas is the list of schemas
@@ -783,16 +794,49 @@ class CPSFileField(CPSField):
         file = data[field_id] # May be None.
         
         if file is None:
-            return
+            return ()
 
-        text_field_id = self._getDependantFieldId(schemas, self.suffix_text)
-        if text_field_id is not None:
-            data[text_field_id] = convertFileToText(file, context=context)
+        return self._computeConversions(schemas, data, file, context,
+                                        datamodel=datamodel)
+
+    def _computeConversions(self, schemas, data, file, context,
+                            datamodel=None):
+        """Compute the text and HTML conversions of file into data.
+
+        Conversions are skipped if the content of file hasn't changed since
+        they were last computed: its fingerprint is kept on file.
 
+        With deferred_conversions, they are queued to be done after the
+        transaction commit if possible (see ConversionQueue). This needs
+        the datamodel.
+
+        Returns the ids of the fields updated.
+        """
+        text_field_id = self._getDependantFieldId(schemas, self.suffix_text)
         html_field_id = self._getDependantFieldId(schemas, self.suffix_html)
         html_subfiles_field_id = self._getDependantFieldId(
             schemas,
             self.suffix_html_subfiles)
+        targets = (text_field_id, html_field_id, html_subfiles_field_id)
+        if targets == (None, None, None):
+            return ()
+
+        if file is not None:
+            info = (getFileFingerprint(file), targets)
+            if getattr(aq_base(file), '_conversions_info', None) == info:
+                logger.debug("Content of %r unchanged, not converting", file)
+                return ()
+            if self.deferred_conversions and datamodel is not None:
+                schema_ids = [schema.getId() for schema in schemas]
+                if queueConversion(datamodel.getObject(), schema_ids,
+                                   self.getFieldId(), info[0]):
+                    return ()
+
+        changed = []
+        if text_field_id is not None:
+            data[text_field_id] = convertFileToText(file, context=context)
+            changed.append(text_field_id)
+
         if html_field_id is not None:
             html_conversion = convertFileToHtml(file, context=context)
             if html_conversion is not None:
@@ -816,7 +860,14 @@ class CPSFileField(CPSField):
                 html_file = None
                 files_dict = {}
             data[html_field_id] = html_file
-            data[html_subfiles_field_id] = files_dict
+            changed.append(html_field_id)
+            if html_subfiles_field_id is not None:
+                data[html_subfiles_field_id] = files_dict
+                changed.append(html_subfiles_field_id)
+
+        if file is not None:
+            file._conversions_info = info
+        return changed
 
     def validate(self, value):
         if not value:
@@ -861,8 +912,13 @@ class CPSDiskFileField(CPSFileField):
     _properties = CPSFileField._properties + (
         {'id': 'disk_storage_path', 'type': 'string', 'mode': 'w',
          'label': 'Storage path'},
+        {'id': 'disk_storage_layout', 'type': 'selection', 'mode': 'w',
+         'select_variable': 'all_disk_storage_layouts',
+         'label': 'Storage layout (flat or hashed subdirectories)'},
         )
     disk_storage_path = ''
+    disk_storage_layout = ''
+    all_disk_storage_layouts = [''] + list(DISK_FILE_LAYOUTS)
 
     def getStoragePath(self):
         if self.disk_storage_path:
@@ -874,7 +930,15 @@ class CPSDiskFileField(CPSFileField):
                 return storage_path
             return 'var/files'
 
-    def computeDependantFields(self, schemas, data, context=None):
+    def getStorageLayout(self):
+        if self.disk_storage_layout:
+            return self.disk_storage_layout
+        portal_schemas = getToolByName(self, 'portal_schemas')
+        return getattr(portal_schemas, 'disk_storage_layout',
+                       DISK_FILE_FLAT_LAYOUT) or DISK_FILE_FLAT_LAYOUT
+
+    def computeDependantFields(self, schemas, data, context=None,
+                               datamodel=None):
         """Compute dependant fields.
 
         In particular this method handles the conversion from File to DiskFile
@@ -885,42 +949,19 @@ class CPSDiskFileField(CPSFileField):
         """
         field_id = self.getFieldId()
         file = data[field_id] # May be None.
-        if isinstance(file, File) and not isinstance(file, DiskFile):
-            file = DiskFile(file.getId(), file.title, file.data,
-                            file.content_type, self.getStoragePath())
+        if isinstance(file, DiskFile):
+            # e.g. made from an upload by a file widget, now stored
+            manager = getDataManager(create=False)
+            if manager is not None:
+                manager.confirm(file)
+        elif isinstance(file, File):
+            # streamed, without loading the whole data
+            file = DiskFile(file.getId(), file.title, ofsFileHandler(file),
+                            file.content_type, self.getStoragePath(),
+                            layout=self.getStorageLayout())
             data[field_id] = file
-        text_field_id = self._getDependantFieldId(schemas, self.suffix_text)
-        if text_field_id is not None:
-            data[text_field_id] = convertFileToText(file, context=context)
-
-        html_field_id = self._getDependantFieldId(schemas, self.suffix_html)
-        html_subfiles_field_id = self._getDependantFieldId(
-            schemas,
-            self.suffix_html_subfiles)
-        if html_field_id is not None:
-            html_conversion = convertFileToHtml(file, context=context)
-            if html_conversion is not None:
-                html_string = html_conversion.getData()
-                fileid = cookId('', '', file)[0]
-                if '.' in fileid:
-                    fileid = fileid[:fileid.rfind('.')]
-                if not fileid:
-                    fileid = 'document'
-                fileid = fileid + '.html'
-                html_file = File(fileid, '', html_string,
-                                 content_type='text/html')
-
-                # getSubObjects returns a dict of sub-objects, each sub-object
-                # being a file but described as a string.
-                subobjects_dict = html_conversion.getSubObjects()
-                files_dict = {}
-                for k, v in subobjects_dict.items():
-                    files_dict[k] = File(k, k, v)
-            else:
-                html_file = None
-                files_dict = {}
-            data[html_field_id] = html_file
-            data[html_subfiles_field_id] = files_dict
+        return self._computeConversions(schemas, data, file, context,
+                                        datamodel=datamodel)
 
     def validate(self, value):
         if not value:
@@ -947,7 +988,22 @@ class CPSDiskFileField(CPSFileField):
 #         return File(self.getFieldId(), '', values[0])
 
 InitializeClass(CPSDiskFileField)
-FileObjectFactory.methods[CPSDiskFileField.meta_type] = (DiskFile, {})
+
+def makeDiskFile(id, title, file, context=None):
+    """Make a DiskFile for a disk file field (context).
+
+    File uploads are copied directly to the disk, by chunks.
+    """
+    if context is None:
+        file = DiskFile(id, title, file)
+    else:
+        file = DiskFile(id, title, file,
+                        storage_path=context.getStoragePath(),
+                        layout=context.getStorageLayout())
+    return file
+
+FileObjectFactory.methods[CPSDiskFileField.meta_type] = (
+    makeDiskFile, {'context': True})
 
 
 class CPSSubObjectsField(CPSField):
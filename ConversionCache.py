@@ -0,0 +1,252 @@
+# (C) Copyright 2010 CPS-CMS Community <http://cps-cms.org/>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Cache of file conversion results.
+
+Conversions of files to text or HTML are stored on the disk, keyed by the
+SHA-1 of the file content, the source and target mime types and the
+encoding, so that identical files (templates, forwarded attachments,
+revisions) are converted only once.
+
+The least recently used entries are removed when the cache grows bigger
+than its maximum size, down to a part of it (low_water).
+
+There is no cache by default, use setConversionCache() to set one, e.g.:
+
+  setConversionCache(ConversionCache('/var/cache/conversions', 100 << 20))
+"""
+
+import os
+import tempfile
+import threading
+from cPickle import dump, load, HIGHEST_PROTOCOL, PicklingError
+from logging import getLogger
+try:
+    from hashlib import sha1
+except ImportError: # python < 2.5
+    from sha import new as sha1
+
+logger = getLogger(__name__)
+
+_SUFFIX = '.conv'
+
+
+class CachedConversion:
+    """A conversion result read from the cache.
+
+    Behaves like the data streams returned by portal_transforms.
+    """
+
+    def __init__(self, data, subobjects):
+        self._data = data
+        self._subobjects = subobjects
+
+    def getData(self):
+        return self._data
+
+    def getSubObjects(self):
+        return self._subobjects
+
+    def getMetadata(self):
+        return {}
+
+
+class ConversionCache:
+    """Conversion results stored in a directory, with LRU eviction."""
+
+    # When full, the cache is reduced to this part of its maximum size,
+    # so that evictions (which list and sort the entries) don't happen
+    # on each set.
+    low_water = 0.9
+
+    def __init__(self, path, max_size=100 << 20):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None # computed on first use
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _getFilename(self, key):
+        name = sha1(repr(key)).hexdigest()
+        return os.path.join(self.path, name + _SUFFIX)
+
+    def get(self, key):
+        """Return the cached conversion for key, or None."""
+        filename = self._getFilename(key)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            self._count(False)
+            return None
+        try:
+            try:
+                data, subobjects = load(f)
+            except Exception, e:
+                # truncated, or pickled by another version (UnpicklingError,
+                # ImportError, AttributeError, ...)
+                logger.warn("Corrupted conversion cache entry %s: %s",
+                            filename, e)
+                self._remove(filename)
+                self._count(False)
+                return None
+        finally:
+            f.close()
+        try:
+            os.utime(filename, None) # recently used
+        except OSError:
+            pass
+        self._count(True)
+        return CachedConversion(data, subobjects)
+
+    def _count(self, hit):
+        self._lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+
+    def _remove(self, filename):
+        """Remove an entry."""
+        self._lock.acquire()
+        try:
+            try:
+                size = os.path.getsize(filename)
+                os.remove(filename)
+            except OSError: # removed meanwhile
+                return
+            if self._size is not None:
+                self._size -= size
+        finally:
+            self._lock.release()
+
+    def set(self, key, result):
+        """Store a conversion result (a data stream) for key.
+
+        Returns False if the result can't be stored.
+        """
+        data = result.getData()
+        getSubObjects = getattr(result, 'getSubObjects', None)
+        subobjects = getSubObjects is not None and getSubObjects() or {}
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        f = os.fdopen(fd, 'wb')
+        try:
+            try:
+                dump((data, subobjects), f, HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            size = os.path.getsize(tmp)
+            filename = self._getFilename(key)
+            self._lock.acquire()
+            try:
+                self._computeSize()
+                if os.path.exists(filename):
+                    self._size -= os.path.getsize(filename)
+                os.rename(tmp, filename)
+                self._size += size
+                if self._size > self.max_size:
+                    self._evict()
+            finally:
+                self._lock.release()
+        except (PicklingError, TypeError), e:
+            os.remove(tmp)
+            logger.warn("Could not cache a conversion: %s", e)
+            return False
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return True
+
+    def _listEntries(self):
+        """Return a list of (mtime, size, filename) for all entries.
+
+        The mtime of an entry is updated when it is used.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(_SUFFIX):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                st = os.stat(filename)
+            except OSError: # removed meanwhile
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+        return entries
+
+    def _computeSize(self):
+        if self._size is None:
+            self._size = sum([e[1] for e in self._listEntries()])
+
+    def _evict(self):
+        """Remove the least recently used entries, down to the low water."""
+        target = self.max_size * self.low_water
+        entries = self._listEntries()
+        entries.sort()
+        self._size = sum([e[1] for e in entries])
+        for mtime, size, filename in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self._size -= size
+            logger.debug("Evicted conversion cache entry %s", filename)
+
+    def getStatistics(self):
+        """Return a dict with the hits, misses, size and entries counts."""
+        entries = self._listEntries()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': sum([e[1] for e in entries]),
+                'entries': len(entries),
+                }
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        self._lock.acquire()
+        try:
+            for mtime, size, filename in self._listEntries():
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            self._size = 0
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+
+_cache = None
+
+def getConversionCache():
+    """Return the conversion cache, or None if there is none."""
+    return _cache
+
+def setConversionCache(cache):
+    """Set the conversion cache (None to disable), returns the previous one."""
+    global _cache
+    old = _cache
+    _cache = cache
+    return old
@@ -0,0 +1,295 @@
+# (C) Copyright 2010 CPS-CMS Community <http://cps-cms.org/>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Deferred file conversions.
+
+File fields with deferred_conversions set don't convert files to text or
+HTML during the commit of the datamodel. Conversion jobs are stored in a
+persistent queue on the schemas tool instead, in the same transaction.
+Once it is committed, a runner processes the queue in a new connection.
+
+A job is keyed by the object path and the file field id, and remembers the
+fingerprint of the file to convert: if the file changed since, the job is
+stale and dropped (a newer one has been queued). The queue resolves the
+conflicts between transactions queuing or processing different jobs.
+
+Two runners are provided: ThreadPoolRunner, the default, processes the
+queue in a pool of threads, so that the request committing the upload
+doesn't wait for the conversions. LocalRunner processes it right after
+the commit, in the committing thread. Use setConversionRunner() to change
+it. processConversionQueue() can also be called directly, in the current
+transaction.
+"""
+
+import time
+import weakref
+import threading
+from logging import getLogger
+from Queue import Queue
+
+import transaction
+from ZODB.POSException import ConflictError
+from Persistence import Persistent
+from Acquisition import aq_base
+
+from Products.CMFCore.utils import getToolByName
+
+from Products.CPSSchemas.DataModel import DataModel
+from Products.CPSSchemas.FileUtils import getFileFingerprint
+
+logger = getLogger(__name__)
+
+# Transactions for which the runner is already scheduled
+_scheduled = weakref.WeakKeyDictionary()
+
+
+class ConversionJobs(Persistent):
+    """The conversion jobs, keyed by (object path, field id).
+
+    Jobs are (schema ids, fingerprint, time queued) tuples.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+
+    def __setitem__(self, key, job):
+        self._jobs[key] = job
+        self._p_changed = True
+
+    def __getitem__(self, key):
+        return self._jobs[key]
+
+    def __delitem__(self, key):
+        del self._jobs[key]
+        self._p_changed = True
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def keys(self):
+        """Return the keys, oldest jobs first."""
+        items = [(job[2], key) for key, job in self._jobs.items()]
+        items.sort()
+        return [key for queued, key in items]
+
+    def _p_resolveConflict(self, old, committed, new):
+        """Merge the jobs queued and processed by concurrent transactions.
+
+        If both queued a job for the same key, the latest one wins. A job
+        processed by one transaction and queued again by the other is
+        kept.
+        """
+        old_jobs = old['_jobs']
+        committed_jobs = committed['_jobs']
+        jobs = committed_jobs.copy()
+        for key, job in new['_jobs'].items():
+            if old_jobs.get(key) == job:
+                continue # unchanged in new
+            current = jobs.get(key)
+            if current is None or current[2] <= job[2]:
+                jobs[key] = job
+        for key, job in old_jobs.items():
+            if key in new['_jobs']:
+                continue
+            # processed in new, unless queued again in committed
+            if committed_jobs.get(key) == job:
+                del jobs[key]
+        state = committed.copy()
+        state['_jobs'] = jobs
+        return state
+
+
+def _getQueue(stool, create=False):
+    queue = getattr(aq_base(stool), '_conversion_queue', None)
+    if queue is None and create:
+        queue = stool._conversion_queue = ConversionJobs()
+    return queue
+
+
+def queueConversion(ob, schema_ids, field_id, fingerprint):
+    """Queue the conversions of a file field of ob.
+
+    Returns False if conversions can't be deferred (object without path,
+    no schemas tool...): they have to be done right away.
+    """
+    if getattr(aq_base(ob), 'getPhysicalPath', None) is None:
+        return False
+    stool = getToolByName(ob, 'portal_schemas', None)
+    if stool is None:
+        return False
+    txn = transaction.get()
+    if getattr(txn, 'addAfterCommitHook', None) is None:
+        # old ZODB
+        return False
+    queue = _getQueue(stool, create=True)
+    path = '/'.join(ob.getPhysicalPath())
+    queue[(path, field_id)] = (tuple(schema_ids), fingerprint, time.time())
+    logger.debug("Queued conversions of %s for %s", field_id, path)
+
+    jar = stool._p_jar
+    if jar is not None and txn not in _scheduled:
+        portal = getToolByName(stool, 'portal_url').getPortalObject()
+        txn.addAfterCommitHook(_afterCommit,
+                               (jar.db(), portal.getPhysicalPath()))
+        _scheduled[txn] = True
+    return True
+
+
+def _afterCommit(status, db, portal_path):
+    if not status:
+        return
+    try:
+        _runner.run(db, portal_path)
+    except: # never fail after a commit
+        logger.exception("Could not run the conversion queue")
+
+
+def processConversionQueue(portal, max_jobs=None):
+    """Process the conversion jobs, in the current transaction.
+
+    Returns the number of jobs processed.
+    """
+    stool = getToolByName(portal, 'portal_schemas')
+    queue = _getQueue(stool)
+    if not queue:
+        return 0
+    done = 0
+    for key in list(queue.keys()):
+        if max_jobs is not None and done >= max_jobs:
+            break
+        path, field_id = key
+        schema_ids, fingerprint, queued = queue[key]
+        del queue[key]
+        try:
+            _processJob(portal, stool, path, field_id, schema_ids,
+                        fingerprint)
+        except ConflictError:
+            raise
+        except:
+            logger.exception("Conversions of %s for %s failed",
+                             field_id, path)
+        done += 1
+    return done
+
+
+def _processJob(portal, stool, path, field_id, schema_ids, fingerprint):
+    ob = portal.unrestrictedTraverse(path, None)
+    if ob is None:
+        logger.debug("Dropping conversions for removed %s", path)
+        return
+    schemas = [stool._getOb(schema_id) for schema_id in schema_ids
+               if getattr(aq_base(stool), schema_id, None) is not None]
+    adapters = [schema.getStorageAdapter(ob) for schema in schemas]
+    dm = DataModel(ob, adapters, context=ob)
+    dm._check_acls = 0
+    dm._fetch()
+    field = dm._fields.get(field_id)
+    if field is None:
+        return
+    file = dm.data.get(field_id)
+    file = getattr(file, '_file_obj', file) # ProtectedFile
+    if file is None or getFileFingerprint(file) != fingerprint:
+        logger.debug("Dropping stale conversions of %s for %s",
+                     field_id, path)
+        return
+    changed = field._computeConversions(dm._schemas, dm.data, file,
+                                        portal)
+    # defaults fetched are not to be written here
+    dm.dirty = set(changed)
+    dm._commitData()
+    if getattr(aq_base(ob), 'postCommitHook', None) is not None:
+        ob.postCommitHook(datamodel=dm)
+
+
+def _runInNewConnection(db, portal_path):
+    """Process the conversion queue of a portal, in a new connection."""
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    try:
+        app = conn.root()['Application']
+        portal = app.unrestrictedTraverse(portal_path)
+        while True:
+            tm.begin()
+            try:
+                # small transactions, to limit conflicts
+                done = processConversionQueue(portal, max_jobs=10)
+                tm.commit()
+            except ConflictError:
+                tm.abort()
+                logger.debug("Conflict processing the conversion queue")
+                break
+            except:
+                tm.abort()
+                raise
+            if not done:
+                break
+    finally:
+        conn.close()
+
+
+class LocalRunner:
+    """Processes the conversion queue right after the commit.
+
+    The committing thread (and request) waits for the conversions.
+    """
+
+    def run(self, db, portal_path):
+        _runInNewConnection(db, portal_path)
+
+
+class ThreadPoolRunner:
+    """Processes the conversion queue in a pool of threads."""
+
+    def __init__(self, size=2):
+        self.size = size
+        self._requests = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def run(self, db, portal_path):
+        self._startThreads()
+        self._requests.put((db, portal_path))
+
+    def _startThreads(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work,
+                                          name='CPSSchemas conversions')
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            db, portal_path = self._requests.get()
+            try:
+                _runInNewConnection(db, portal_path)
+            except:
+                logger.exception("Could not run the conversion queue")
+
+
+_runner = ThreadPoolRunner()
+
+def setConversionRunner(runner):
+    """Set the runner used after commits, returns the previous one."""
+    global _runner
+    old = _runner
+    _runner = runner
+    return old
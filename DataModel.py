@@ -39,6 +39,7 @@ The storage itself is done through a storage adapter.
 """
 
 import logging
+from copy import copy
 from UserDict import UserDict
 from cgi import escape
 
@@ -68,6 +69,9 @@ class DefaultValue:
 
 DEFAULT_VALUE_MARKER = DefaultValue()
 
+# Types of values that DataModel compares to detect changes
+_COMPARABLE_TYPES = (str, unicode, int, long, float, bool, type(None))
+
 
 class AccessError(ValueError):
     """Raised by a field when access is denied."""
@@ -122,6 +126,218 @@ class ProtectedFile(object):
             self._datamodel.dirty.add(self._dm_key)
         object.__setattr__(self, attr, v)
 
+class DataModelData(dict):
+    """The data of a DataModel.
+
+    Any change drops the cached ACL decisions that may depend on the data
+    (see DataModel._checkAccess), wherever it is made from: storage
+    adapters and fields computing dependant fields write here directly.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.acl_expr_decisions = {}
+
+    def _changed(self):
+        if self.acl_expr_decisions:
+            self.acl_expr_decisions.clear()
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+
+    def update(self, *args, **kw):
+        dict.update(self, *args, **kw)
+        self._changed()
+
+    def setdefault(self, key, failobj=None):
+        if key not in self:
+            self._changed()
+        return dict.setdefault(self, key, failobj)
+
+    def pop(self, key, *args):
+        self._changed()
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+
+class MergedFields:
+    """Read-only mapping of the fields of several schemas.
+
+    Only the position of the schema of each field is stored: fields are
+    taken from the schemas on access, so the same entries can be shared
+    by the schemas of any ZODB connection.
+
+    computing_ids are the ids of the fields that compute dependant fields,
+    in schemas order.
+    """
+
+    def __init__(self, entries, schemas, computing_ids=()):
+        self._entries = entries # field id -> schema index
+        self._schemas = schemas
+        self._fields = {} # field id -> field, from these schemas
+        self.computing_ids = computing_ids
+
+    def __getitem__(self, key):
+        field = self._fields.get(key)
+        if field is None:
+            i = self._entries[key]
+            field = self._fields[key] = self._schemas[i][key]
+        return field
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        return self[key]
+
+    def has_key(self, key):
+        return key in self._entries
+
+    __contains__ = has_key
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def values(self):
+        return [self[key] for key in self._entries]
+
+    def items(self):
+        return [(key, self[key]) for key in self._entries]
+
+
+# Merged field entries (schema indexes), ACL free decisions and computing
+# field ids, see mergeSchemaFields. No field objects: they belong to the
+# ZODB connection of the schemas.
+_merged_fields_cache = {}
+_MERGED_FIELDS_CACHE_MAX_SIZE = 200
+
+def _getMergedFieldsCacheKey(schemas):
+    """Compute the cache key for schemas, None if they can't be cached.
+
+    Schemas must be stored, and unchanged in the current transaction:
+    their serial then changes whenever they or their fields change.
+    """
+    key = []
+    for schema in schemas:
+        base = aq_base(schema)
+        oid = getattr(base, '_p_oid', None)
+        if oid is None or getattr(base, '_p_changed', False):
+            return None
+        key.append((schema.getId(), oid, base._p_serial))
+    return tuple(key)
+
+def _mergeSchemaFields(schemas):
+    entries = {}
+    acl_free = [] # (field id, write)
+    computing_ids = []
+    for i, schema in enumerate(schemas):
+        for fieldid, field in schema.items():
+            if entries.has_key(fieldid):
+                sids = [s.getId() for s in schemas if fieldid in s.keys()]
+                logger.warn(
+                    "Field '%s' is in schema %s but also in schema%s %s.",
+                    fieldid, sids[0], len(sids) > 2 and 's' or '',
+                    ', '.join(sids[1:]))
+                continue
+            entries[fieldid] = i
+            for write in (False, True):
+                if not field._hasAcl(write):
+                    acl_free.append((fieldid, write))
+            if field._computesDependantFields():
+                computing_ids.append(fieldid)
+    return entries, dict.fromkeys(acl_free), tuple(computing_ids)
+
+def mergeSchemaFields(schemas):
+    """Merge the fields of schemas, the first schema having a field wins.
+
+    Returns the fields mapping (see MergedFields), and the ACL decisions
+    (see DataModel) for the fields whose access is never restricted.
+
+    The merge is cached for stored schemas, keyed by their ids and serials.
+    """
+    schemas = tuple(schemas)
+    key = _getMergedFieldsCacheKey(schemas)
+    info = None
+    if key is not None:
+        info = _merged_fields_cache.get(key)
+    if info is None:
+        info = _mergeSchemaFields(schemas)
+        if key is not None:
+            if len(_merged_fields_cache) >= _MERGED_FIELDS_CACHE_MAX_SIZE:
+                # old serials pile up: start again
+                _merged_fields_cache.clear()
+            _merged_fields_cache[key] = info
+    entries, acl_free_decisions, computing_ids = info
+    return (MergedFields(entries, schemas, computing_ids),
+            acl_free_decisions)
+
+
+class DataModelFactory:
+    """Builds datamodels for many objects having the same schemas.
+
+    Fields of the schemas are merged once. The user, its roles and the
+    permission checks are shared by the datamodels having the same
+    context (for instance a container during creation of objects).
+
+    A factory is meant to be used during one request only.
+    """
+
+    def __init__(self, schemas, user=None):
+        self.schemas = tuple(schemas)
+        if user is None:
+            user = getSecurityManager().getUser()
+        self.user = user
+        self._field_info = None
+        self._security_info = {} # (context id, add roles) -> info
+
+    def getFieldInfo(self):
+        """Get the merged fields and ACL decisions, see mergeSchemaFields."""
+        if self._field_info is None:
+            self._field_info = mergeSchemaFields(self.schemas)
+        return self._field_info
+
+    def getSecurityInfo(self, context, add_roles=()):
+        """Get the roles of the user in context and the permissions cache.
+        """
+        add_roles = tuple(add_roles)
+        # context is kept in the value, for its id to stay valid
+        key = (id(aq_base(context)), add_roles)
+        info = self._security_info.get(key)
+        if info is None:
+            user_roles = (tuple(self.user.getRolesInContext(context)) +
+                          add_roles)
+            info = self._security_info[key] = (context, user_roles, {})
+        return info[1:]
+
+    def makeDataModel(self, ob, proxy=None, context=None, add_roles=(),
+                      **kw):
+        """Make the datamodel of ob.
+
+        Storage adapters are made by the schemas, with the kw arguments.
+        """
+        adapters = [schema.getStorageAdapter(ob, proxy=proxy, **kw)
+                    for schema in self.schemas]
+        return DataModel(ob, adapters, proxy=proxy, context=context,
+                         add_roles=add_roles, factory=self)
+
+
 class DataModel(UserDict):
     """An abstraction for the data stored in an object."""
 
@@ -131,7 +347,7 @@ class DataModel(UserDict):
     security.setDefaultAccess('allow')
 
     def __init__(self, ob, adapters=(), proxy=None, context=None,
-                 add_roles=()):
+                 add_roles=(), factory=None):
         """Constructor.
 
         Proxy must be passed, if different than the object, so that
@@ -142,9 +358,13 @@ class DataModel(UserDict):
         be the proxy but its container during creation.
 
         The context is also the one used for acl checks.
+
+        A factory (see DataModelFactory) can be passed to share field and
+        security information with other datamodels. The adapters must then
+        be those of the factory's schemas.
         """
         UserDict.__init__(self)
-        # self.data initialized by UserDict
+        self.data = DataModelData()
         self._ob = ob
         self._adapters = adapters
         self._proxy = proxy
@@ -153,33 +373,37 @@ class DataModel(UserDict):
         # (has been modified).
         self.dirty = set()
 
+        # Field ids whose data has not been read yet (lazy fetch),
+        # mapped to the adapter that will read them.
+        self._unfetched = {}
+
+        # Copies of fetched list values, to detect changes (see _isUnchanged)
+        self._snapshots = {}
+
         if context is None:
             if proxy is not None:
                 context = proxy
             else:
                 context = ob
         self._context = context
-        fields = {}
-        schemas = []
-        for adapter in adapters:
-            schema = adapter.getSchema()
-            for fieldid, field in schema.items():
-                if fields.has_key(fieldid):
-                    sids = [a._schema.getId() for a in adapters
-                            if fieldid in a._schema.keys()]
-                    logger.warn(
-                        "Field '%s' is in schema %s but also in schema%s %s.",
-                        fieldid, sids[0], len(sids) > 2 and 's' or '',
-                        ', '.join(sids[1:]))
-                    continue
-                fields[fieldid] = field
-            schemas.append(schema)
-        self._schemas = tuple(schemas)
+        if factory is None:
+            schemas = tuple([adapter.getSchema() for adapter in adapters])
+            fields, acl_free_decisions = mergeSchemaFields(schemas)
+        else:
+            schemas = factory.schemas
+            fields, acl_free_decisions = factory.getFieldInfo()
+        self._schemas = schemas
         self._fields = fields
+        self._acl_free_decisions = acl_free_decisions
         # Precomputed things used for validation
-        user = getSecurityManager().getUser()
-        self._acl_cache_user = user
-        self._setAddRoles(add_roles)
+        if factory is None:
+            user = getSecurityManager().getUser()
+            self._acl_cache_user = user
+            self._setAddRoles(add_roles)
+        else:
+            self._acl_cache_user = factory.user
+            self._setSecurityInfo(*factory.getSecurityInfo(context,
+                                                           add_roles))
         self._check_acls = 1
         self._forbidden_widgets = []
 
@@ -187,22 +411,61 @@ class DataModel(UserDict):
         user = self._acl_cache_user
         user_roles = (tuple(user.getRolesInContext(self._context)) +
                       tuple(add_roles))
+        self._setSecurityInfo(user_roles, {})
+
+    def _setSecurityInfo(self, user_roles, permissions):
         self._acl_cache_user_roles = user_roles
-        self._acl_cache_permissions = {} # dict with perm: hasit/not
+        self._acl_cache_permissions = permissions # dict with perm: hasit/not
+        # (field id, write) -> None if access is granted, or the error
+        self._acl_decisions = self._acl_free_decisions.copy()
+        # same for decisions that may depend on the data, dropped by the
+        # data when it changes
+        self._acl_expr_decisions = self.data.acl_expr_decisions = {}
 
     #
     # Restricted accessors
     #
     def checkReadAccess(self, key):
         if self._check_acls:
-            self._fields[key].checkReadAccess(self, self._context)
+            self._checkAccess(key, False)
 
     def checkWriteAccess(self, key):
         if self._check_acls:
-            self._fields[key].checkWriteAccess(self, self._context)
+            self._checkAccess(key, True)
+
+    def _checkAccess(self, key, write):
+        """Check access to a field, raising an AccessError if denied.
+
+        Decisions are cached: user, roles and context are fixed for the
+        datamodel. Those involving ACL expressions are kept until the data
+        changes.
+        """
+        cache_key = (key, write)
+        decision = self._acl_decisions.get(cache_key, _marker)
+        if decision is _marker:
+            decision = self._acl_expr_decisions.get(cache_key, _marker)
+        if decision is _marker:
+            field = self._fields[key]
+            try:
+                if write:
+                    field.checkWriteAccess(self, self._context)
+                else:
+                    field.checkReadAccess(self, self._context)
+            except AccessError, decision:
+                pass
+            else:
+                decision = None
+            if field._hasAclExpr(write):
+                self._acl_expr_decisions[cache_key] = decision
+            else:
+                self._acl_decisions[cache_key] = decision
+        if decision is not None:
+            raise decision
 
     def __getitem__(self, key):
         self.checkReadAccess(key)
+        if key in self._unfetched:
+            self._fetchField(key)
         return self.data[key]
 
     def get(self, key, failobj=None):
@@ -210,19 +473,62 @@ class DataModel(UserDict):
             self.checkReadAccess(key)
         except (ReadAccessError, KeyError):
             return failobj
+        if key in self._unfetched:
+            self._fetchField(key)
         return self.data.get(key, failobj)
 
     def items(self):
+        self._fetchAll()
         for key in self.data.keys():
             self.checkReadAccess(key)
         return self.data.items()
 
     def values(self):
+        self._fetchAll()
         for key in self.data.keys():
             self.checkReadAccess(key)
         return self.data.values()
 
+    def iteritems(self):
+        return iter(self.items())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def keys(self):
+        return self.data.keys() + self._unfetched.keys()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    __iter__ = iterkeys
+
+    def has_key(self, key):
+        return key in self.data or key in self._unfetched
+
+    __contains__ = has_key
+
+    def __len__(self):
+        return len(self.data) + len(self._unfetched)
+
+    def copy(self):
+        self._fetchAll()
+        data = self.data
+        try:
+            self.data = DataModelData()
+            c = copy(self)
+        finally:
+            self.data = data
+        c._acl_expr_decisions = c.data.acl_expr_decisions = {}
+        c.update(self)
+        return c
+
+    def __cmp__(self, dict):
+        self._fetchAll()
+        return UserDict.__cmp__(self, dict)
+
     def popitem(self):
+        self._fetchAll()
         key, item = self.data.popitem()
         self.checkReadAccess(key)
         return key, item
@@ -230,6 +536,8 @@ class DataModel(UserDict):
     def pop(self, key, *args):
         # python2.3
         self.checkReadAccess(key)
+        if key in self._unfetched:
+            self._fetchField(key)
         return self.data.pop(key, *args)
 
     def __setitem__(self, key, item):
@@ -240,18 +548,49 @@ class DataModel(UserDict):
         # subsystem or StorageAdapter
         if isinstance(item, ProtectedFile):
             item = item._file_obj
+        old = self.data.get(key, _marker)
         try:
-            self.data[key] = field.validate(item)
+            self.data[key] = value = field.validate(item)
         except ValidationError, e:
             logger.info("Validation failed on obj %r (proxy %r), field %r",
                         self.getObject(), self.getProxy(), field)
             raise
-        self.dirty.add(key)
+        self._unfetched.pop(key, None)
+        if key in self.dirty or not self._isUnchanged(key, old, value):
+            self.dirty.add(key)
 
     def isDirty(self, key):
         """Is the item marked dirty ?"""
         return key in self.dirty
 
+    def _isUnchanged(self, key, old, value):
+        """Tell if value is known to be the same as the old one.
+
+        Only simple values, and lists of simple values, can be compared:
+        other ones (files, objects...) are always considered changed.
+        """
+        if old is _marker or type(value) is not type(old):
+            return False
+        if isinstance(old, _COMPARABLE_TYPES):
+            return value == old
+        if isinstance(old, list):
+            # old may have been modified in place
+            snapshot = self._snapshots.get(key)
+            return snapshot is not None and tuple(value) == snapshot
+        return False
+
+    def _takeSnapshots(self, data):
+        """Keep copies of the list values that can be compared."""
+        snapshots = self._snapshots
+        for field_id, value in data.items():
+            if not isinstance(value, list):
+                continue
+            for v in value:
+                if not isinstance(v, _COMPARABLE_TYPES):
+                    break
+            else:
+                snapshots[field_id] = tuple(value)
+
     # Expose setter as method for restricted code.
     def set(self, key, item):
         self.checkWriteAccess(key)
@@ -312,6 +651,7 @@ class DataModel(UserDict):
 
         Keys are sorted.
         """
+        self._fetchAll()
         data = self.data
         fields = self._fields
         keys = data.keys()
@@ -336,25 +676,92 @@ class DataModel(UserDict):
         """Get the context for this DataModel."""
         return self._context
 
+    def getField(self, field_id, default=None):
+        """Get the field object for field_id."""
+        return self._fields.get(field_id, default)
+
     #
     # Fetch and commit
     #
-    def _fetch(self):
-        """Fetch the data into local dict for user access."""
+    def _fetch(self, lazy=False, field_ids=None):
+        """Fetch the data into local dict for user access.
+
+        In lazy mode, the fields managed by adapters that support it are
+        read only when first accessed. This spares reading values that
+        are never used, typically in views rendering a few widgets.
+
+        If field_ids is specified, these fields and their read dependencies
+        are read right away, the other ones are fetched lazily. See
+        LayoutsTool.getLayoutsFieldIds to compute them.
+        """
         data = self.data
-        fields = self._fields
+        if field_ids is not None:
+            lazy = True
+            field_ids = self._getReadDependencyClosure(field_ids)
         for adapter in self._adapters:
-            adapt_data = adapter.getData()
+            adapter_field_ids = None
+            if lazy and adapter.supports_lazy_fetch:
+                adapter_field_ids = set()
+                for field_id in adapter.getFieldIds():
+                    if field_ids is not None and field_id in field_ids:
+                        adapter_field_ids.add(field_id)
+                    else:
+                        self._unfetched[field_id] = adapter
+                if not adapter_field_ids:
+                    continue
+            adapt_data = adapter.getData(field_ids=adapter_field_ids)
             # Default values are dirty because they have
             # to be considered changed by the user
             # (and written, and used for dependent computations)
             self.dirty.update(adapter.finalizeDefaults(adapt_data, 
 	                      datamodel=self))
             data.update(adapt_data)
+            self._takeSnapshots(adapt_data)
         for field_id, value in data.items():
             if is_file_object(value):
                 self._protectFile(field_id, value)
 
+    def _getReadDependencyClosure(self, field_ids):
+        """Return field_ids and the fields their reading depends on.
+
+        Unknown field ids are dropped.
+        """
+        fields = self._fields
+        res = set()
+        todo = list(field_ids)
+        while todo:
+            field_id = todo.pop()
+            if field_id in res or field_id not in fields:
+                continue
+            res.add(field_id)
+            todo.extend(fields[field_id].read_process_dependent_fields)
+        return res
+
+    def _fetchField(self, field_id):
+        """Fetch the data of a field left aside by a lazy fetch.
+
+        Read dependent fields are fetched first, so that they are available
+        to the read expression.
+        """
+        adapter = self._unfetched.pop(field_id)
+        field = adapter.getSchema()[field_id]
+        for dep_id in field.read_process_dependent_fields:
+            if dep_id in self._unfetched:
+                self._fetchField(dep_id)
+        adapt_data = {field_id: adapter.getFieldData(field_id, self.data)}
+        # Default values are dirty, see _fetch
+        self.dirty.update(adapter.finalizeDefaults(adapt_data, datamodel=self))
+        value = self.data[field_id] = adapt_data[field_id]
+        self._takeSnapshots(adapt_data)
+        if is_file_object(value):
+            self._protectFile(field_id, value)
+
+    def _fetchAll(self):
+        """Fetch all the fields left aside by a lazy fetch."""
+        for field_id in self._unfetched.keys():
+            if field_id in self._unfetched:
+                self._fetchField(field_id)
+
     def _getProtectedFileIds(self):
         """Return the current set of protected file's ids.
 
@@ -453,7 +860,9 @@ class DataModel(UserDict):
         with the _set_editable kwarg. This bypass should be used at creation
         time only: the proxy doesn't know the new object yet in this case.
         """
-        if _set_editable:
+        # fields not read yet may have default values, that are dirty
+        self._fetchAll()
+        if _set_editable and self.dirty:
             self._setEditable()
         ob = self._ob
 
@@ -465,6 +874,10 @@ class DataModel(UserDict):
             logger.warn("Unauthorized to modify object %s", ob)
             raise Unauthorized("Cannot modify object")
 
+        if not self.dirty:
+            logger.debug("Nothing changed, not writing to %r", ob)
+            return ob
+
         self._commitData()
 
         # XXX temporary until we have a better API for this
@@ -475,16 +888,33 @@ class DataModel(UserDict):
 
     def _computeDependentFields(self):
         data = self.data
-        for schema in self._schemas:
-            for field_id, field in schema.items():
-                if self.isDirty(field_id):
-                    field.computeDependantFields(self._schemas, data,
-                                                 context=self._context)
-                    for dep_id in field._getAllDependantFieldIds():
-                        self.dirty.add(dep_id)
+        fields = self._fields
+        for field_id in fields.computing_ids:
+            if not self.isDirty(field_id):
+                continue
+            field = fields[field_id]
+            try:
+                changed = field.computeDependantFields(
+                    self._schemas, data, context=self._context,
+                    datamodel=self)
+            except TypeError:
+                # BBB for old subclasses without the datamodel kwarg
+                import sys
+                if sys.exc_info()[2].tb_next is not None:
+                    # error is deeper
+                    raise
+                changed = field.computeDependantFields(
+                    self._schemas, data, context=self._context)
+            if changed is None:
+                changed = field._getAllDependantFieldIds()
+            self.dirty.update(changed)
+
     def _commitData(self):
         """Compute dependent fields and write data into object."""
 
+        # write expressions and dependent fields may need any field
+        self._fetchAll()
+
         # apply changes to file objects and decapsulate
         self._unProtectFiles()
 
@@ -497,6 +927,8 @@ class DataModel(UserDict):
 
         # nothing's dirty any more
         self.dirty = set()
+        self._snapshots = {}
+        self._takeSnapshots(data)
 
         # reprotect file objects for further changes
         self._protectFiles()
@@ -507,6 +939,7 @@ class DataModel(UserDict):
     def _exportAsXML(self):
         """Export the datamodel as XML string."""
         res = []
+        self._fetchAll()
         data = self.data
         for schema in self._schemas:
             for field_id, field in schema.items():
@@ -522,6 +955,7 @@ class DataModel(UserDict):
         return '\n'.join(res)
 
     def __repr__(self):
+        self._fetchAll()
         return '<DataModel %s>' % (self.data,)
 
 InitializeClass(DataModel)
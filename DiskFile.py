@@ -24,19 +24,105 @@
 __version__ = '$Revision$'[11:-2]
 
 import os
-import sys
+import errno
+import shutil
 import logging
+from uuid import uuid4
+try:
+    from hashlib import sha1
+except ImportError: # python < 2.5
+    from sha import new as sha1
 
 from Globals import InitializeClass, DTMLFile
 from ComputedAttribute import ComputedAttribute
 from AccessControl import ClassSecurityInfo
+from App.Common import rfc1123_date
+from DateTime import DateTime
 from OFS.Image import File
+from webdav.Lockable import ResourceLockedError
+from ZPublisher.Iterators import filestream_iterator
+from ZPublisher.HTTPRangeSupport import parseRange, expandRanges
 from TM import VTM
+from DiskFileStore import getDedupStore, getContentFilename
+from DiskFileTransaction import getDataManager, applyOperations
 
 from Products.CMFCore.permissions import View
 
 logger = logging.getLogger('CPSSchemas.DiskFile')
 
+# Storage layouts: all files in the storage directory, named after their
+# title, in hashed fan-out subdirectories, named after an UUID, or
+# deduplicated, named after the SHA-1 of their content (see DiskFileStore).
+FLAT_LAYOUT = 'flat'
+HASHED_LAYOUT = 'hashed'
+DEDUP_LAYOUT = 'dedup'
+LAYOUTS = (FLAT_LAYOUT, HASHED_LAYOUT, DEDUP_LAYOUT)
+
+# Number of levels of hashed subdirectories, and length of their names
+FAN_OUT_LEVELS = 2
+FAN_OUT_WIDTH = 2
+
+def _fileDigest(path):
+    """Return the SHA-1 of the content of a file, read by chunks."""
+    digest = sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+# Size of the chunks in which uploads are copied
+CHUNK_SIZE = 1 << 16
+
+# Marker for unsatisfiable byte ranges
+_UNSATISFIABLE = object()
+
+class range_filestream_iterator(filestream_iterator):
+    """Stream iterator over a byte range of a file."""
+
+    def __init__(self, name, start, end, mode='rb', bufsize=-1,
+                 streamsize=1<<16):
+        filestream_iterator.__init__(self, name, mode, bufsize, streamsize)
+        self.seek(start)
+        self.remaining = end - start
+
+    def next(self):
+        if self.remaining <= 0:
+            raise StopIteration
+        data = self.read(min(self.streamsize, self.remaining))
+        if not data:
+            raise StopIteration
+        self.remaining -= len(data)
+        return data
+
+    def __len__(self):
+        return self.remaining
+
+def _linkOrCopy(src, dst):
+    """Hardlink src to dst, or copy it by chunks if not possible.
+
+    Files are never modified in place (updates are renames), so linked
+    files stay independent.
+    """
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError): # no hardlinks here
+        shutil.copyfile(src, dst)
+
+def _makeDirs(path):
+    """Create a directory and its parents, if needed."""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
 class DiskFile(File, VTM):
     """Stores the data of a file object into a file on the disk.
     """
@@ -44,15 +130,27 @@ class DiskFile(File, VTM):
     security = ClassSecurityInfo()
     _v_new_file = False
     _v_tmp = False
+    _v_tmp_filename = None
+    _v_obsolete_filename = None
+    _v_refops = ()
     content_type = ''
+    _file_layout = FLAT_LAYOUT
 
-    def __init__(self, id, title, file=None, content_type=None, storage_path='var/files'):
+    def __init__(self, id, title, file=None, content_type=None,
+                 storage_path='var/files', layout=FLAT_LAYOUT):
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown storage layout: %r" % layout)
         self.__name__ = id
         self.title = self._filename = title # _filename prone to change
         self._file_store = storage_path
+        if layout != FLAT_LAYOUT:
+            self._file_layout = layout
         self.precondition = '' # For Image.File compatibility
         self._v_new_file = True # NB: __init__ is bypassed by ZODB loads
-        if file:
+        if getattr(file, 'read', None) is not None:
+            # FileUpload or other file-like object: streamed
+            self.update_file(file, content_type)
+        elif file:
             data, size = self._read_data(file)
             content_type = self._get_content_type(file, data, id, content_type)
             self.update_data(data, content_type, size)
@@ -72,6 +170,13 @@ class DiskFile(File, VTM):
 
         If new, an additional marker is also inserted.
         """
+        if self._file_layout == HASHED_LAYOUT:
+            while True:
+                newid = self._makeHashedFilename(suggested_id, tmp=tmp)
+                path = self.getFullFilename(newid)
+                if not os.path.exists(path):
+                    _makeDirs(os.path.dirname(path))
+                    return newid
 
         dot = suggested_id.find('.')
         if dot != -1:
@@ -93,40 +198,126 @@ class DiskFile(File, VTM):
             newid = tmp and (baseid + '_tmp' + ext) or (baseid + ext)
         return newid
 
+    def _makeHashedFilename(self, suggested_id, tmp=False):
+        """Make a file name in hashed subdirectories, from an UUID.
+
+        The extension of suggested_id is kept.
+        """
+        ext = os.path.splitext(os.path.basename(suggested_id))[1]
+        name = uuid4().hex
+        parts = [name[i*FAN_OUT_WIDTH:(i+1)*FAN_OUT_WIDTH]
+                 for i in range(FAN_OUT_LEVELS)]
+        parts.append(name + (tmp and '_tmp' or '') + ext)
+        return '/'.join(parts)
+
+    def _createNewFile(self, suggested_id, tmp=False):
+        """Create a new file in the file store, based on suggested id.
+
+        Returns its name and the file object, opened for writing.
+        In the hashed and dedup layouts, the file is created with O_EXCL,
+        there's no need to list the directory.
+        """
+        if self._file_layout == FLAT_LAYOUT:
+            newid = self.getNewFilename(suggested_id, tmp=tmp)
+            return newid, open(self.getFullFilename(newid), 'wb')
+        flags = (os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                 | getattr(os, 'O_BINARY', 0))
+        while True:
+            newid = self._makeHashedFilename(suggested_id, tmp=tmp)
+            path = self.getFullFilename(newid)
+            try:
+                fd = os.open(path, flags, 0666)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    _makeDirs(os.path.dirname(path))
+                    continue
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            return newid, os.fdopen(fd, 'wb')
 
     #
     # Transaction support
     #
-    def _finish(self):
-        """Called after ZODB write.
-        This is the VTM transaction support.
-        """
+    def _register(self):
+        """Register with the DiskFile data manager of the transaction."""
+        getDataManager().register(self)
 
-        # This is called after ZODB write
-
-        if not self._v_tmp:
-            return
-        tmp_path = self.getFullFilename(self._v_tmp_filename)
-        target = self.getFullFilename(self._filename)
+    def _getFinishOperations(self):
+        """Return the file operations to do once the ZODB is committed.
 
-        if sys.platform == 'win32' and not self._v_new_file:
-            # Crappy win32 cannot do an atomic rename
-            try:
-                os.remove(target)
-            except OSError:
-                logger.warn('Error during transaction commit',
-                    'Removing file %s failed. \nStray files may linger.\n',
-                    target)
-        os.rename(tmp_path, target)
+        See DiskFileTransaction for the operations.
+        """
+        ops = []
+        if self._v_tmp:
+            tmp_path = self.getFullFilename(self._v_tmp_filename)
+            if self._file_layout == DEDUP_LAYOUT:
+                ops.append(('store', self._getStorePath(), tmp_path,
+                            self._filename))
+            else:
+                ops.append(('rename', tmp_path,
+                            self.getFullFilename(self._filename)))
+        for delta, filename in self._v_refops:
+            ops.append(('addref', self._getStorePath(), filename, delta))
+        manager = getDataManager(create=False)
+        if manager is not None:
+            # Deleted, and not added back (see manage_afterAdd)
+            ops.extend(manager.getDeleteOperations(self))
+        if self._v_obsolete_filename is not None:
+            # Moved to another file name
+            ops.append(('remove',
+                        self.getFullFilename(self._v_obsolete_filename)))
+        return ops
+
+    def _getPendingState(self):
+        """Return the pending changes, for savepoints."""
+        return (self._v_tmp, self._v_tmp_filename, self._v_new_file,
+                self._v_obsolete_filename, self._v_refops)
+
+    def _setPendingState(self, state):
+        """Restore pending changes (savepoint rollback), None for none."""
+        if state is None:
+            state = (False, None, False, None, ())
+        (self._v_tmp, self._v_tmp_filename, self._v_new_file,
+         self._v_obsolete_filename, self._v_refops) = state
+
+    def __setstate__(self, state):
+        File.__setstate__(self, state)
+        # Reloaded after being invalidated by a savepoint rollback
+        manager = getDataManager(create=False)
+        if manager is not None:
+            manager.restorePending(self)
+
+    def _resetPending(self):
         self._v_tmp = self._v_new_file = False
+        self._v_refops = ()
+        self._v_obsolete_filename = None
+        manager = getDataManager(create=False)
+        if manager is not None:
+            manager.cancelDelete(self)
+
+    def _finish(self):
+        """Called after ZODB write.
+
+        The DiskFile data manager applies the operations of all files of
+        the transaction at once instead, see DiskFileTransaction.
+        """
+        ops = self._getFinishOperations()
+        self._resetPending()
+        applyOperations(ops)
 
     def _abort(self):
         """Called when the Zope transaction is rolled-back.
-        This is the VTM transaction support.
+        This is called by the DiskFile data manager.
         """
+        self._v_refops = ()
+        manager = getDataManager(create=False)
+        if manager is not None:
+            manager.cancelDelete(self)
         if not self._v_tmp:
             return
         self._v_tmp = self._v_new_file = False
+        self._v_obsolete_filename = None
         path = self.getFullFilename(self._v_tmp_filename)
         logger.debug("Aborting creation or modification for path %s" % path)
 
@@ -136,6 +327,20 @@ class DiskFile(File, VTM):
             logger.warn('Error during transaction abort',
                 'Removing file %s failed. \nStray files may linger.\n', path)
 
+    #
+    # Deduplicated contents
+    #
+    def _getStorePath(self):
+        return os.path.join(INSTANCE_HOME, self._file_store)
+
+    def _getStore(self):
+        return getDedupStore(self._getStorePath())
+
+    def _addRefOp(self, delta, filename):
+        """Change the reference count of a content, on commit."""
+        self._register()
+        self._v_refops = self._v_refops + ((delta, filename),)
+
     #
     # API
     #
@@ -151,31 +356,88 @@ class DiskFile(File, VTM):
         if size is None:
             size = len(data)
         self.size = size
-        new_tmp = self.getNewFilename(self._filename, tmp=True)
-        fpath = self.getFullFilename(new_tmp)
-        file_d = open(fpath, 'wb')
-        file_d.write(str(data))
+        data = str(data)
+        new_tmp, file_d = self._createNewFile(self._filename, tmp=True)
+        file_d.write(data)
         file_d.close()
+        self._setNewContent(new_tmp, sha1(data).hexdigest())
+
+    def update_file(self, file, content_type=None):
+        """Update the content from a file-like object, such as a FileUpload.
+
+        The file is copied by chunks to the temporary file, computing its
+        size and SHA-1 on the way: it is never loaded in memory.
+        """
+        self._register()
+        if getattr(file, 'seek', None) is not None:
+            file.seek(0)
+        digest = sha1()
+        size = 0
+        head = None
+        new_tmp, file_d = self._createNewFile(self._filename, tmp=True)
+        try:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if head is None:
+                    head = chunk
+                digest.update(chunk)
+                size += len(chunk)
+                file_d.write(chunk)
+        finally:
+            file_d.close()
+        if content_type is None and not self.content_type:
+            # Guessed from the upload headers and the first chunk
+            content_type = self._get_content_type(file, head or '',
+                                                  self._filename, None)
+        if content_type is not None:
+            self.content_type = content_type
+        self.size = size
+        self._setNewContent(new_tmp, digest.hexdigest())
+
+    def _setNewContent(self, new_tmp, digest):
+        """Make a new temporary file the current content."""
+        self._content_sha1 = digest
+        if self._file_layout == DEDUP_LAYOUT:
+            if not self._v_tmp and not self._v_new_file:
+                # The committed content isn't used by this file anymore
+                self._addRefOp(-1, self._filename)
+            self._filename = getContentFilename(digest)
+        manager = getDataManager()
         if self._v_tmp:
             # There is a previous temporary file. It is now outdated.
             oldpath = self.getFullFilename(self._v_tmp_filename)
-            try:
-                os.remove(oldpath)
+            if not manager.isHeld(oldpath): # else kept for a savepoint
+                try:
+                    os.remove(oldpath)
 
-            except OSError:
-                logger.error("Error attempting to remove the previous "
-                             "temporary file %s", oldpath)
+                except OSError:
+                    logger.error("Error attempting to remove the previous "
+                                 "temporary file %s", oldpath)
         self._v_tmp = True
         self._v_tmp_filename = new_tmp
+        manager.registerTemporary(self.getFullFilename(new_tmp))
 
         self.ZCacheable_invalidate()
         self.ZCacheable_set(None)
         self.http__refreshEtag()
 
         # must be done before ZODB write
-        if self._v_new_file:
+        if self._v_new_file and self._file_layout != DEDUP_LAYOUT:
             self._filename = self.getNewFilename(self.title)
 
+    def manage_upload(self, file='', REQUEST=None):
+        """Replace the contents of the file, streaming file uploads."""
+        if getattr(file, 'read', None) is None:
+            return File.manage_upload(self, file, REQUEST)
+        if self.wl_isLocked():
+            raise ResourceLockedError("File is locked via WebDAV")
+        self.update_file(file)
+        if REQUEST:
+            message = "Saved changes."
+            return self.manage_main(self, REQUEST, manage_tabs_message=message)
+
     security.declareProtected(View, 'getData')
     def getData(self):
         filename = self.getFullFilename()
@@ -188,9 +450,73 @@ class DiskFile(File, VTM):
     def getFileHandler(self):
         return open(self.getFullFilename())
 
+    security.declareProtected(View, 'index_html')
+    def index_html(self, REQUEST, RESPONSE):
+        """Publish the file, streamed from the disk.
+
+        The content is never loaded in memory. If-Modified-Since and
+        requests for a single byte range are supported.
+        """
+        if self._if_modified_since_request_handler(REQUEST, RESPONSE):
+            return ''
+
+        size = self.get_size()
+        if self._p_mtime is not None:
+            RESPONSE.setHeader('Last-Modified', rfc1123_date(self._p_mtime))
+        RESPONSE.setHeader('Content-Type', self.content_type)
+        RESPONSE.setHeader('Accept-Ranges', 'bytes')
+
+        byte_range = self._getRequestedRange(REQUEST, size)
+        if byte_range is _UNSATISFIABLE:
+            RESPONSE.setHeader('Content-Range', 'bytes */%d' % size)
+            RESPONSE.setHeader('Content-Length', size)
+            RESPONSE.setStatus(416)
+            return ''
+        if byte_range is not None:
+            start, end = byte_range
+            RESPONSE.setHeader('Content-Range',
+                               'bytes %d-%d/%d' % (start, end - 1, size))
+            RESPONSE.setHeader('Content-Length', end - start)
+            RESPONSE.setStatus(206)
+            return range_filestream_iterator(self.getFullFilename(),
+                                             start, end)
+
+        RESPONSE.setHeader('Content-Length', size)
+        return filestream_iterator(self.getFullFilename(), 'rb')
+
+    def _getRequestedRange(self, REQUEST, size):
+        """Return the byte range (start, end) requested, end excluded.
+
+        Returns None if the whole file has to be sent: no range, invalid
+        or multiple ranges, or If-Range date older than the file.
+        """
+        header = REQUEST.get_header('Range', None)
+        if header is None:
+            return None
+        ranges = parseRange(header)
+        if not ranges or len(ranges) != 1:
+            return None
+        if_range = REQUEST.get_header('If-Range', None)
+        if if_range is not None:
+            # Only dates are supported, as in OFS.Image.File
+            try:
+                since = long(DateTime(if_range.split(';')[0]).timeTime())
+            except:
+                return None
+            if self._p_mtime is None or self._p_mtime > since:
+                return None
+        ranges = expandRanges(ranges, size)
+        if not ranges:
+            return _UNSATISFIABLE
+        return ranges[0]
+
     def __str__(self):
         if self.content_type.startswith('text/'):
-            return str(self.getData()[:500])
+            file = open(self.getFullFilename(), 'rb')
+            try:
+                return file.read(500)
+            finally:
+                file.close()
         else:
             return "%s content" % self.content_type
 
@@ -203,10 +529,7 @@ class DiskFile(File, VTM):
     def loadData(self):
         """Loads the data from the external object to internal attributes
 
-        This is used for cut/copy/paste.
-        XXX GR within a folder cut/paste, this can load gigabytes in RAM
-               If this is for cut/copy/paste *only*, a simple set of
-               flags would be much better.
+        Not used anymore for cut/paste, see manage_beforeDelete.
         """
         self._copy_data = self.getData()
 
@@ -217,27 +540,78 @@ class DiskFile(File, VTM):
         file.write(self._copy_data)
         del self._copy_data
 
+    def _migrateLayout(self, layout):
+        """Move the file to another storage layout.
+
+        The current file is linked (or copied) to a temporary file, renamed
+        and removed at the end of the transaction, as for an update.
+
+        Returns False if the file already uses this layout.
+        """
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown storage layout: %r" % layout)
+        if self._file_layout == layout:
+            return False
+        if self._v_tmp:
+            raise ValueError("Cannot migrate %r, pending changes"
+                             % self._filename)
+        self._register()
+        old_layout = self._file_layout
+        old_filename = self._filename
+        old_path = self.getFullFilename(old_filename)
+        if layout == FLAT_LAYOUT:
+            del self._file_layout
+        else:
+            self._file_layout = layout
+        new_tmp, file_d = self._createNewFile(self.title, tmp=True)
+        file_d.close()
+        tmp_path = self.getFullFilename(new_tmp)
+        os.remove(tmp_path)
+        _linkOrCopy(old_path, tmp_path)
+        self._v_tmp = self._v_new_file = True
+        self._v_tmp_filename = new_tmp
+        if old_layout == DEDUP_LAYOUT:
+            # The content may be shared
+            self._addRefOp(-1, old_filename)
+        else:
+            self._v_obsolete_filename = old_filename
+        if layout == DEDUP_LAYOUT:
+            self._filename = getContentFilename(_fileDigest(tmp_path))
+        else:
+            self._filename = self.getNewFilename(self.title)
+        return True
+
     def manage_beforeDelete(self, item, container):
-        self.loadData()
-        try:
-            os.remove(self.getFullFilename())
-        except OSError:
-            logger.warn('manage_beforeDelete: '
-                'Removing file %s failed. \nStray files may linger.\n',
-                    self.getFullFilename())
+        # The file is removed (or its content dereferenced) at the end of
+        # the transaction, unless this is a move: the file doesn't depend
+        # on the container, manage_afterAdd just cancels the removal.
+        if self._file_layout == DEDUP_LAYOUT:
+            ops = [('addref', self._getStorePath(), self._filename, -1)]
+        else:
+            ops = [('remove', self.getFullFilename(self._filename))]
+        getDataManager().registerDelete(self, ops)
 
     def manage_afterClone(self, item):
+        if self._file_layout == DEDUP_LAYOUT:
+            # Copies share the content
+            self._addRefOp(1, self._filename)
+            return
         # This is a copy-paste operation, so duplicate the data!
-        data = self.getData()
-        self._filename = self.getNewFilename(self._filename)
-        filename = self.getFullFilename()
-        file = open(filename, 'wb')
-        file.write(data)
+        old_path = self.getFullFilename()
+        self._filename, file = self._createNewFile(self._filename)
+        file.close()
+        new_path = self.getFullFilename(self._filename)
+        os.remove(new_path)
+        _linkOrCopy(old_path, new_path)
 
     def manage_afterAdd(self, item, container):
+        manager = getDataManager(create=False)
+        if manager is not None and manager.cancelDelete(self):
+            # This is a cut-paste operation, keep the file
+            return
         if hasattr(self, '_copy_data'):
-            # This is a cut-paste operation, so restore the data loaded
-            # in manage_beforeDelete!
+            # BBB: cut-paste started by an older version, restore the data
+            # loaded in manage_beforeDelete
             self.storeData()
 
     def get_size(self):
@@ -0,0 +1,374 @@
+# (C) Copyright 2010 CPS-CMS Community <http://cps-cms.org/>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Consistency scanner for DiskFile stores.
+
+Aborted transactions, failed renames or crashes can leave files in the
+storage directories that no DiskFile uses anymore (orphans), or DiskFile
+objects whose file is missing. scanDiskFiles() finds them, and can remove
+the orphans.
+
+Storage directories may be shared by several portals, so orphans are only
+removed, and reference counts of deduplicated contents rebuilt, when the
+whole database is walked, from the application root.
+Databases mounted in the application, or used by other instances, that
+share the same storage directories are not walked: don't delete orphans
+then.
+
+Memory stays mostly bounded on big stores: objects are deactivated once
+walked, and both the file names used by DiskFile objects and the ones
+found on the disk are sorted on the disk, then compared side by side.
+The oids of the walked objects are kept in memory though, about 10 bytes
+by object with ZODB >= 3.8 (80 bytes before): 100 MB for 10 millions of
+objects.
+"""
+
+import os
+import time
+import heapq
+import tempfile
+from types import ClassType
+from logging import getLogger
+from urllib import quote, unquote
+
+from Acquisition import aq_base
+from persistent import Persistent
+from ZODB.utils import u64
+try:
+    from BTrees.LLBTree import LLTreeSet
+except ImportError:
+    # ZODB < 3.8
+    LLTreeSet = None
+
+from Products.CPSSchemas.DiskFile import DiskFile, DEDUP_LAYOUT
+from Products.CPSSchemas.DiskFileStore import CONTENTS_DIR, INDEX_NAME
+from Products.CPSSchemas.DiskFileStore import getDedupStore
+
+logger = getLogger(__name__)
+
+# Number of items sorted in memory at once
+SORT_CHUNK_SIZE = 100000
+
+# Number of objects walked between ZODB cache garbage collections
+CACHE_GC_INTERVAL = 1000
+
+
+class SortedSpool:
+    """Strings sorted by chunks on the disk, then merged (external sort)."""
+
+    def __init__(self, chunk_size=SORT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._buffer = []
+        self._runs = []
+
+    def add(self, item):
+        self._buffer.append(item)
+        if len(self._buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        self._buffer.sort()
+        run = tempfile.TemporaryFile()
+        for item in self._buffer:
+            run.write(quote(item) + '\n')
+        run.seek(0)
+        self._runs.append(run)
+        self._buffer = []
+
+    def _iterRun(self, run):
+        for line in run:
+            yield unquote(line[:-1])
+
+    def __iter__(self):
+        """Iterate over the sorted items, once."""
+        self._buffer.sort()
+        iterators = [self._iterRun(run) for run in self._runs]
+        iterators.append(iter(self._buffer))
+        heap = []
+        for index, it in enumerate(iterators):
+            for item in it:
+                heap.append((item, index))
+                break
+        heapq.heapify(heap)
+        while heap:
+            item, index = heapq.heappop(heap)
+            yield item
+            for item in iterators[index]:
+                heapq.heappush(heap, (item, index))
+                break
+        self.close()
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._buffer = []
+
+
+class OidSet:
+    """Set of the oids of the walked objects.
+
+    With 64-bit integer tree sets (ZODB >= 3.8) about 10 bytes are used by
+    oid, against about 80 bytes with a set of oid strings.
+    """
+
+    def __init__(self):
+        if LLTreeSet is not None:
+            self._oids = LLTreeSet()
+        else:
+            self._oids = set()
+
+    def add(self, oid):
+        """Add an oid, return False if it was already there."""
+        if LLTreeSet is not None:
+            return bool(self._oids.insert(u64(oid)))
+        if oid in self._oids:
+            return False
+        self._oids.add(oid)
+        return True
+
+
+class DiskFileWalker:
+    """Walk the DiskFile objects under an object, with a bounded cache.
+
+    All the persistent objects reachable from the object are walked
+    (folders, BTrees, persistent mappings, ...), once each, through their
+    pickled state, and deactivated once done.
+
+    The walk is iterative, so long chains of objects (e.g. the buckets of
+    big BTrees) are fine. Memory used is the oids of the walked objects
+    (see OidSet), and the objects referenced by walked objects that are
+    still to be walked (ghosts, mostly).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._seen = OidSet()
+        self._unsaved = set() # ids of new objects, not deactivable anyway
+
+    def walk(self, ob):
+        """Iterate over the DiskFile objects under ob."""
+        ob = aq_base(ob)
+        jar = getattr(ob, '_p_jar', None)
+        stack = [ob]
+        while stack:
+            ob = stack.pop()
+            oid = ob._p_oid
+            if oid is not None:
+                if not self._seen.add(oid):
+                    continue
+            elif id(ob) in self._unsaved:
+                continue
+            else:
+                self._unsaved.add(id(ob))
+            if isinstance(ob, DiskFile):
+                yield ob
+                self._deactivate(ob, jar)
+                continue
+            ob._p_activate()
+            state = ob.__getstate__()
+            stack.extend(self._getReferences(state))
+            self._deactivate(ob, jar)
+
+    def _getReferences(self, state):
+        """Return the persistent objects referenced by a pickled state."""
+        references = []
+        seen = set()
+        values = [state]
+        while values:
+            value = values.pop()
+            if isinstance(value, Persistent):
+                references.append(value)
+                continue
+            if isinstance(value, dict):
+                children = value.values()
+            elif isinstance(value, (list, tuple)):
+                children = value
+            elif isinstance(value, (type, ClassType)):
+                continue
+            elif getattr(value, '__dict__', None) is not None:
+                # non persistent instance, pickled with its container
+                children = value.__dict__.values()
+            else:
+                continue
+            if id(value) in seen:
+                continue
+            seen.add(id(value))
+            values.extend(children)
+        return references
+
+    def _deactivate(self, ob, jar):
+        if getattr(ob, '_p_deactivate', None) is not None and \
+               not ob._p_changed:
+            ob._p_deactivate()
+        self.count += 1
+        if jar is not None and self.count % CACHE_GC_INTERVAL == 0:
+            jar.cacheGC()
+
+
+def _iterStoreFiles(store_path):
+    """Iterate over the full paths of the files of a storage directory."""
+    index_names = (INDEX_NAME, INDEX_NAME + '-journal')
+    for dirpath, dirnames, filenames in os.walk(store_path):
+        for name in filenames:
+            if dirpath == store_path and name in index_names:
+                continue
+            yield os.path.join(dirpath, name)
+
+
+def scanDiskFiles(root, delete=False, grace=3600, max_listed=100,
+                  rebuild=False):
+    """Compare the DiskFile objects under root and their storage directories.
+
+    Files of the storage directories used by no DiskFile are orphans. Those
+    older than grace seconds (not part of a running transaction) are
+    removed if delete is true, which is only allowed if root is the
+    application root (the whole database is then walked). Deduplicated
+    contents whose reference count is above 0 are never removed, only
+    reported as 'referenced'.
+
+    If rebuild is true (also only from the application root), the
+    reference counts of the deduplicated contents are rebuilt from the
+    DiskFile objects walked before orphans are removed, see
+    DedupStore.rebuildRefCounts(): don't change disk files meanwhile, and
+    don't rebuild them if other databases use the same storage directories.
+
+    Returns a report dict: number of 'objects' and 'files', 'orphans',
+    'missing' and 'referenced' files, with at most max_listed paths listed
+    for each, and number of files 'removed' and reference counts
+    'rebuilt'.
+    """
+    if delete or rebuild:
+        jar = getattr(aq_base(root), '_p_jar', None)
+        if jar is None or jar.root().get('Application') is not aq_base(root):
+            raise ValueError("Orphans can only be deleted, and reference "
+                             "counts rebuilt, when scanning from the "
+                             "application root")
+        # including objects stored outside of the application
+        root = jar.root()
+    used = SortedSpool()
+    store_paths = {}
+    dedup_names = {} # store path -> names of the contents used
+    objects = 0
+    walker = DiskFileWalker()
+    for df in walker.walk(root):
+        store_path = os.path.normpath(df._getStorePath())
+        store_paths[store_path] = df._file_layout
+        used.add(os.path.normpath(os.path.join(store_path, df._filename)))
+        if rebuild and df._file_layout == DEDUP_LAYOUT:
+            if store_path not in dedup_names:
+                dedup_names[store_path] = SortedSpool()
+            dedup_names[store_path].add(df._filename)
+        objects += 1
+        if objects % 10000 == 0:
+            logger.info("Walked %d disk files so far", objects)
+
+    found = SortedSpool()
+    for store_path in store_paths.keys():
+        for path in _iterStoreFiles(store_path):
+            found.add(os.path.normpath(path))
+
+    report = {'objects': objects, 'files': 0,
+              'orphans': [], 'orphans_count': 0,
+              'missing': [], 'missing_count': 0,
+              'referenced': [], 'referenced_count': 0,
+              'removed': 0, 'rebuilt': 0}
+    for store_path, names in dedup_names.items():
+        report['rebuilt'] += getDedupStore(store_path).rebuildRefCounts(names)
+    limit = time.time() - grace
+
+    def orphan(path):
+        report['orphans_count'] += 1
+        if len(report['orphans']) < max_listed:
+            report['orphans'].append(path)
+        logger.debug("Orphan file %s", path)
+        if not delete:
+            return
+        try:
+            if os.path.getmtime(path) > limit:
+                return # maybe in a running transaction
+        except OSError:
+            return
+        if _removeOrphan(path, store_paths):
+            report['removed'] += 1
+            return
+        report['referenced_count'] += 1
+        if len(report['referenced']) < max_listed:
+            report['referenced'].append(path)
+        logger.warn("Orphan content %s is still referenced, kept", path)
+
+    def missing(path):
+        report['missing_count'] += 1
+        if len(report['missing']) < max_listed:
+            report['missing'].append(path)
+        logger.warn("Missing file %s", path)
+
+    used_it = iter(used)
+    found_it = iter(found)
+    u = _next(used_it)
+    f = _next(found_it)
+    while f is not None or u is not None:
+        if u is None or (f is not None and f < u):
+            report['files'] += 1
+            orphan(f)
+            f = _next(found_it)
+        elif f is None or u < f:
+            missing(u)
+            u = _skip(used_it, u)
+        else:
+            report['files'] += 1
+            u = _skip(used_it, u)
+            f = _next(found_it)
+
+    logger.info("Scanned %(objects)d disk file objects, %(files)d files: "
+                "%(orphans_count)d orphans (%(removed)d removed), "
+                "%(missing_count)d missing", report)
+    return report
+
+
+def _next(iterator):
+    for item in iterator:
+        return item
+    return None
+
+
+def _skip(iterator, current):
+    """Return the next item different from current (contents may be shared).
+    """
+    item = _next(iterator)
+    while item is not None and item == current:
+        item = _next(iterator)
+    return item
+
+
+def _removeOrphan(path, store_paths):
+    """Remove an orphan file.
+
+    Returns False if it is a deduplicated content still referenced (e.g.
+    by DiskFile objects of another database), which is kept.
+    """
+    for store_path, layout in store_paths.items():
+        contents = os.path.join(store_path, CONTENTS_DIR) + os.sep
+        if path.startswith(contents):
+            filename = '/'.join(path[len(store_path)+1:].split(os.sep))
+            # Unused deduplicated content: forget its reference count too
+            return getDedupStore(store_path).forgetUnused(filename)
+    try:
+        os.remove(path)
+    except OSError, e:
+        logger.warn("Removing %s failed: %s", path, e)
+    return True
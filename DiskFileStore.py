@@ -0,0 +1,344 @@
+# (C) Copyright 2010 CPS-CMS Community <http://cps-cms.org/>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Deduplicated store for DiskFile contents.
+
+In the dedup storage layout, the content of a DiskFile is stored under a
+name derived from its SHA-1, so identical contents (copies, revisions) are
+stored only once. The number of DiskFile objects using each content is
+kept in a small SQLite database in the storage directory.
+
+References are only added or removed when transactions are committed.
+Contents whose count drops to zero are not removed right away, but by the
+garbage collector, see DedupStore.collect(). Both take the database write
+lock, so that a content can't be collected while being reused. Counts left
+too high (references leaked by a bug) can be rebuilt from a walk of the
+whole database, see DedupStore.rebuildRefCounts() and scanDiskFiles().
+
+Changes made by the operations of a DiskFile journal record a marker
+(journal name, operation index) in the same database transaction, so that
+replaying a journal after a crash doesn't apply them twice. The markers
+are forgotten once the journal is removed.
+"""
+
+import os
+import time
+import errno
+import threading
+from logging import getLogger
+try:
+    import sqlite3
+except ImportError: # python < 2.5
+    from pysqlite2 import dbapi2 as sqlite3
+
+logger = getLogger(__name__)
+
+# Subdirectory of the storage directory holding the contents
+CONTENTS_DIR = 'sha1'
+
+INDEX_NAME = 'refcounts.db'
+
+
+def getContentFilename(digest):
+    """Return the file name of a content, relative to the storage directory.
+    """
+    return '/'.join((CONTENTS_DIR, digest[:2], digest[2:4], digest))
+
+
+class DedupStore:
+    """Reference counts of the contents of a storage directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _getConnection(self):
+        if self._conn is None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            conn = sqlite3.connect(os.path.join(self.path, INDEX_NAME),
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("CREATE TABLE IF NOT EXISTS refs ("
+                         "name TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS applied ("
+                         "journal TEXT NOT NULL, op INTEGER NOT NULL, "
+                         "PRIMARY KEY (journal, op))")
+            self._conn = conn
+        return self._conn
+
+    def _run(self, func, *args):
+        """Run func(conn, *args) in a write transaction."""
+        self._lock.acquire()
+        try:
+            conn = self._getConnection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn, *args)
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        finally:
+            self._lock.release()
+
+    def _addRef(self, conn, filename, delta):
+        cursor = conn.execute("UPDATE refs SET count = count + ? "
+                              "WHERE name = ?", (delta, filename))
+        if not cursor.rowcount:
+            conn.execute("INSERT INTO refs (name, count) VALUES (?, ?)",
+                         (filename, delta))
+
+    def _markApplied(self, conn, marker):
+        """Record the marker of an operation.
+
+        Returns False if it was recorded already: the operation is done.
+        """
+        if marker is None:
+            return True
+        cursor = conn.execute("INSERT OR IGNORE INTO applied (journal, op) "
+                              "VALUES (?, ?)", marker)
+        return cursor.rowcount > 0
+
+    def addRef(self, filename, delta=1, marker=None):
+        """Add delta (maybe negative) to the reference count of a content.
+
+        If marker (journal name, operation index) is given, nothing is done
+        if it was recorded already.
+        """
+        self._run(self._addMarkedRef, filename, delta, marker)
+
+    def _addMarkedRef(self, conn, filename, delta, marker):
+        if self._markApplied(conn, marker):
+            self._addRef(conn, filename, delta)
+
+    def storeContent(self, tmp_path, filename, marker=None):
+        """Store a temporary file as a content, and add a reference to it.
+
+        If the content is already stored, the temporary file is removed.
+        If marker (journal name, operation index) is given, nothing is done
+        if it was recorded already.
+        """
+        self._run(self._storeContent, tmp_path, filename, marker)
+
+    def _storeContent(self, conn, tmp_path, filename, marker):
+        if not self._markApplied(conn, marker):
+            return
+        target = os.path.join(self.path, filename)
+        if os.path.exists(target):
+            os.remove(tmp_path)
+        else:
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.rename(tmp_path, target)
+        self._addRef(conn, filename, 1)
+
+    def getRefCount(self, filename):
+        """Return the reference count of a content."""
+        self._lock.acquire()
+        try:
+            row = self._getConnection().execute(
+                "SELECT count FROM refs WHERE name = ?",
+                (filename,)).fetchone()
+        finally:
+            self._lock.release()
+        return row is not None and row[0] or 0
+
+    def collect(self, grace=3600):
+        """Remove the contents that aren't referenced anymore.
+
+        Contents without any reference count (left by a crash) are removed
+        if they are older than grace seconds. Contents whose count is too
+        high are kept until the counts are rebuilt, see rebuildRefCounts().
+
+        The candidates are gathered without the database write lock, which
+        is then only taken for each batch of collect_batch_size contents,
+        their reference count and modification time being checked again.
+
+        Returns the number of contents removed.
+        """
+        removed = 0
+        self._lock.acquire()
+        try:
+            unused = self._getConnection().execute(
+                "SELECT name FROM refs WHERE count <= 0").fetchall()
+        finally:
+            self._lock.release()
+        unused = [filename for (filename,) in unused]
+        for batch in self._iterBatches(unused):
+            removed += self._run(self._collectUnused, batch)
+
+        limit = time.time() - grace
+        candidates = []
+        root = os.path.join(self.path, CONTENTS_DIR)
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                if mtime > limit:
+                    continue
+                filename = '/'.join(
+                    [CONTENTS_DIR] + path[len(root)+1:].split(os.sep))
+                candidates.append((filename, mtime))
+        for batch in self._iterBatches(candidates):
+            removed += self._run(self._collectUnindexed, batch)
+        return removed
+
+    collect_batch_size = 100
+
+    def _iterBatches(self, items):
+        size = self.collect_batch_size
+        for i in xrange(0, len(items), size):
+            yield items[i:i+size]
+
+    def _collectUnused(self, conn, filenames):
+        removed = 0
+        for filename in filenames:
+            row = conn.execute("SELECT count FROM refs WHERE name = ?",
+                               (filename,)).fetchone()
+            if row is None or row[0] > 0:
+                # reused or already collected meanwhile
+                continue
+            self._removeContent(filename)
+            conn.execute("DELETE FROM refs WHERE name = ?", (filename,))
+            removed += 1
+        return removed
+
+    def _collectUnindexed(self, conn, candidates):
+        removed = 0
+        for filename, mtime in candidates:
+            row = conn.execute("SELECT count FROM refs WHERE name = ?",
+                               (filename,)).fetchone()
+            if row is not None:
+                continue
+            path = os.path.join(self.path, filename)
+            try:
+                if os.path.getmtime(path) != mtime:
+                    # stored again meanwhile
+                    continue
+            except OSError:
+                continue
+            logger.info("Removing unreferenced content %s", path)
+            self._removeContent(filename)
+            removed += 1
+        return removed
+
+    def rebuildRefCounts(self, referenced_names):
+        """Set the reference counts from the contents used by DiskFiles.
+
+        referenced_names has a content name for each DiskFile using it,
+        e.g. from a walk of the whole database (see DiskFileScanner).
+        Contents not listed get a count of 0, so that the garbage collector
+        removes them: the store must not be used by other databases.
+        Changes committed during the walk are lost: only rebuild the counts
+        while no DiskFile of the store is changed.
+
+        Returns the number of counts changed.
+        """
+        return self._run(self._rebuildRefCounts, referenced_names)
+
+    def _rebuildRefCounts(self, conn, referenced_names):
+        # counted on the disk, there may be many contents
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS rebuilt ("
+                     "name TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        conn.execute("DELETE FROM rebuilt")
+        for filename in referenced_names:
+            cursor = conn.execute("UPDATE rebuilt SET count = count + 1 "
+                                  "WHERE name = ?", (filename,))
+            if not cursor.rowcount:
+                conn.execute("INSERT INTO rebuilt (name, count) "
+                             "VALUES (?, 1)", (filename,))
+        rebuilt = ("COALESCE((SELECT count FROM rebuilt "
+                   "WHERE rebuilt.name = refs.name), 0)")
+        changed = conn.execute("UPDATE refs SET count = %s "
+                               "WHERE count != %s" % (rebuilt, rebuilt)
+                               ).rowcount
+        changed += conn.execute("INSERT INTO refs (name, count) "
+                                "SELECT name, count FROM rebuilt WHERE name "
+                                "NOT IN (SELECT name FROM refs)").rowcount
+        conn.execute("DELETE FROM rebuilt")
+        return changed
+
+    def _removeContent(self, filename):
+        path = os.path.join(self.path, filename)
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logger.warn("Removing %s failed: %s", path, e)
+
+    def forget(self, filename):
+        """Remove a content and its reference count, whatever it is."""
+        self._run(self._forget, filename)
+
+    def _forget(self, conn, filename):
+        self._removeContent(filename)
+        conn.execute("DELETE FROM refs WHERE name = ?", (filename,))
+
+    def forgetUnused(self, filename):
+        """Remove a content and its reference count, unless it is above 0.
+
+        Returns False if the content is still referenced.
+        """
+        return self._run(self._forgetUnused, filename)
+
+    def _forgetUnused(self, conn, filename):
+        row = conn.execute("SELECT count FROM refs WHERE name = ?",
+                           (filename,)).fetchone()
+        if row is not None and row[0] > 0:
+            return False
+        self._forget(conn, filename)
+        return True
+
+    def forgetJournal(self, journal):
+        """Forget the markers of the operations of a removed journal."""
+        self._run(self._forgetJournal, journal)
+
+    def _forgetJournal(self, conn, journal):
+        conn.execute("DELETE FROM applied WHERE journal = ?", (journal,))
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        finally:
+            self._lock.release()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def getDedupStore(path):
+    """Return the store for a storage directory (absolute path)."""
+    _stores_lock.acquire()
+    try:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = DedupStore(path)
+        return store
+    finally:
+        _stores_lock.release()
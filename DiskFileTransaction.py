@@ -0,0 +1,596 @@
+# (C) Copyright 2010 CPS-CMS Community <http://cps-cms.org/>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Transaction support for DiskFile objects.
+
+All the DiskFile objects changed in a transaction are handled by a single
+data manager. When the transaction is voted, it collects the file
+operations of all of them (renames of temporary files, removals,
+reference counts) and writes them to a journal: the vote fails if it
+can't be written. Once the ZODB is committed, the journal is marked
+committed, the operations are applied in one pass, each directory is
+synced once, and the journal is removed. It is also removed if the
+transaction is aborted.
+
+Journals are locked by their process while in use. If a process crashes
+before the end, recoverJournals() (called at startup) applies the
+operations of its committed journals that aren't marked as done; the
+journals of transactions that didn't reach the commit are discarded,
+their temporary files are left. Renames and removals are idempotent, and
+the reference count changes of deduplicated contents record a marker in
+the store index along with the change, so that they aren't applied twice
+(see DiskFileStore). Without file locks (win32), journals aren't
+recovered at startup, as they could belong to another running process.
+
+Savepoints can be rolled back: the temporary files made before a
+savepoint are kept until the end of the transaction, even when replaced
+by newer ones, and the pending changes of the files are restored.
+
+Operations are tuples:
+
+- ('rename', tmp_path, target_path)
+
+- ('remove', path)
+
+- ('store', store_path, tmp_path, filename): store a deduplicated content
+  and add a reference to it (see DiskFileStore)
+
+- ('addref', store_path, filename, delta)
+"""
+
+import os
+import sys
+import errno
+import weakref
+from logging import getLogger
+from urllib import quote, unquote
+from uuid import uuid4
+try:
+    import fcntl
+except ImportError: # win32
+    fcntl = None
+
+import transaction
+from Acquisition import aq_base
+
+from DiskFileStore import getDedupStore
+
+logger = getLogger(__name__)
+
+JOURNAL_HEADER = 'CPSSchemas DiskFile journal 1'
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_TMP_SUFFIX = '.tmp'
+
+# Journals can be recovered while other processes run
+JOURNAL_LOCKING = fcntl is not None
+
+# Directory of the journals, var/diskfile_journal in the instance if None
+JOURNAL_DIRECTORY = None
+
+# Data managers of the current transactions
+_managers = weakref.WeakKeyDictionary()
+
+# Paths of the journals in use in this process (file locks are per process)
+_active_journals = set()
+
+
+def getJournalDirectory():
+    if JOURNAL_DIRECTORY is not None:
+        return JOURNAL_DIRECTORY
+    return os.path.join(INSTANCE_HOME, 'var', 'diskfile_journal')
+
+
+def getDataManager(create=True):
+    """Return the DiskFile data manager of the current transaction.
+
+    If create is false, returns None if there is none yet.
+    """
+    txn = transaction.get()
+    manager = _managers.get(txn)
+    if manager is None and create:
+        manager = _managers[txn] = DiskFileDataManager()
+        txn.join(manager)
+    return manager
+
+
+class DiskFileDataManager:
+    """Applies the file operations of DiskFile objects after the commit.
+
+    The removals of deleted files are kept here rather than on the objects,
+    whose volatile attributes are lost if they are deactivated.
+
+    Files registered as tentative (e.g. made from an upload before the
+    datamodel is committed) are aborted when the transaction is voted,
+    unless they have been confirmed meanwhile or stored in the ZODB.
+
+    The temporary files made in the transaction are listed. Those used
+    when a savepoint is made are held: they are kept on the disk until the
+    end of the transaction, even when replaced.
+    """
+
+    def __init__(self):
+        self._clear()
+        self.ops = ()
+        self.journal = None
+
+    def _clear(self):
+        self.files = {}
+        self.deleted = {}
+        self.tentative = {}
+        self.created = []
+        self.held = set()
+        self.restored = {}
+
+    def register(self, ob):
+        ob = aq_base(ob)
+        if id(ob) in self.restored:
+            # changed after a rollback, its pending state is live from now
+            ob._p_activate()
+            del self.restored[id(ob)]
+        self.files[id(ob)] = ob
+
+    def registerDelete(self, ob, ops):
+        """Apply ops (removals) after the commit, unless cancelled."""
+        self.register(ob)
+        self.deleted[id(aq_base(ob))] = ops
+
+    def cancelDelete(self, ob):
+        """Cancel the removals of ob, return False if there were none."""
+        return self.deleted.pop(id(aq_base(ob)), None) is not None
+
+    def getDeleteOperations(self, ob):
+        return self.deleted.get(id(aq_base(ob)), ())
+
+    def registerTentative(self, ob):
+        """Drop the file operations of ob on vote, unless confirmed."""
+        self.register(ob)
+        ob = aq_base(ob)
+        self.tentative[id(ob)] = ob
+
+    def confirm(self, ob):
+        """Keep the file operations of a tentative ob."""
+        self.tentative.pop(id(aq_base(ob)), None)
+
+    def registerTemporary(self, path):
+        """Register a temporary file made in the transaction."""
+        self.created.append(path)
+
+    def isHeld(self, path):
+        """Tell if a temporary file must be kept until the end."""
+        return path in self.held
+
+    def restorePending(self, ob):
+        """Restore the pending changes of ob after a rollback.
+
+        Called when ob is loaded, its volatile attributes are lost if the
+        ZODB invalidated it.
+        """
+        entry = self.restored.get(id(ob))
+        if entry is not None and entry[0] is ob:
+            ob._setPendingState(entry[1])
+
+    def abort(self, txn):
+        files = self.files.values()
+        # replaced since a savepoint
+        stale = self.held - _getTemporaryPaths(files)
+        self._clear()
+        for ob in files:
+            try:
+                ob._abort()
+            except:
+                logger.exception("Error aborting %r", ob)
+        _removeFiles(stale)
+
+    def tpc_abort(self, txn):
+        journal = self.journal
+        self.ops = ()
+        self.journal = None
+        if journal is not None:
+            try:
+                journal.remove()
+            except OSError:
+                logger.exception("Could not remove the DiskFile journal %s",
+                                 journal.path)
+        self.abort(txn)
+
+    def savepoint(self):
+        return DiskFileSavepoint(self)
+
+    def _rollback(self, savepoint):
+        # Files made since the savepoint
+        _removeFiles(self.created[savepoint.created:])
+        del self.created[savepoint.created:]
+        self.held = set(savepoint.held)
+        for key, ob in self.files.items():
+            if key not in savepoint.files:
+                ob._setPendingState(None)
+        self.files = dict(savepoint.files)
+        self.deleted = dict(savepoint.deleted)
+        self.tentative = dict(savepoint.tentative)
+        self.restored = {}
+        for key, ob in self.files.items():
+            state = savepoint.pending[key]
+            ob._setPendingState(state)
+            self.restored[key] = (ob, state)
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        tentative = self.tentative.values()
+        self.tentative = {}
+        for ob in tentative:
+            if getattr(ob, '_p_jar', None) is not None:
+                # stored by this commit, the ZODB data managers come first
+                continue
+            # not stored, e.g. the datamodel wasn't committed
+            self.files.pop(id(ob), None)
+            self.deleted.pop(id(ob), None)
+            self.held = self.held - _getTemporaryPaths([ob])
+            try:
+                ob._abort()
+            except:
+                logger.exception("Error aborting %r", ob)
+        ops = []
+        for ob in self.files.values():
+            ops.extend(ob._getFinishOperations())
+        if not ops:
+            return
+        # Errors make the vote fail, and the transaction abort
+        self.journal = Journal.create(getJournalDirectory(), ops)
+        self.ops = ops
+
+    def tpc_finish(self, txn):
+        # Called after the ZODB commit, as our sort key comes last
+        files = self.files.values()
+        ops, journal = self.ops, self.journal
+        # replaced since a savepoint
+        stale = self.held - _getTemporaryPaths(files)
+        self._clear()
+        self.ops = ()
+        self.journal = None
+        for ob in files:
+            ob._resetPending()
+        if ops:
+            try:
+                journal.markCommitted()
+            except (IOError, OSError):
+                logger.exception("Could not mark the DiskFile journal %s "
+                                 "committed", journal.path)
+            try:
+                applyOperations(ops, journal)
+            except:
+                # never fail after the commit, the journal stays for recovery
+                logger.exception("Error finishing DiskFile operations")
+                journal.close()
+                return
+            removeJournal(journal, ops)
+        _removeFiles(stale)
+
+    def sortKey(self):
+        # After the ZODB storages
+        return '~CPSSchemas.DiskFile'
+
+
+class DiskFileSavepoint:
+    """Savepoint of DiskFile changes.
+
+    The temporary files used now are held by the data manager, so rolling
+    back removes the newer ones and restores the pending changes.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.files = dict(manager.files)
+        self.deleted = dict(manager.deleted)
+        self.tentative = dict(manager.tentative)
+        self.pending = dict([(key, ob._getPendingState())
+                             for key, ob in manager.files.items()])
+        self.created = len(manager.created)
+        manager.held = manager.held | _getTemporaryPaths(self.files.values())
+        self.held = manager.held
+
+    def rollback(self):
+        self.manager._rollback(self)
+
+
+def _getTemporaryPaths(files):
+    """Return the paths of the temporary files used by DiskFile objects."""
+    return set([ob.getFullFilename(ob._v_tmp_filename)
+                for ob in files if ob._v_tmp])
+
+
+def _removeFiles(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logger.warn("Removing %s failed: %s", path, e)
+
+
+def _lockFile(f, blocking=True):
+    """Lock a file opened for writing, return False if it's locked already.
+    """
+    if fcntl is None:
+        return True
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.lockf(f.fileno(), flags)
+    except IOError, e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    return True
+
+
+class Journal:
+    """Journal of the file operations of a transaction.
+
+    One line per operation, a 'commit' line once the ZODB is committed,
+    then one 'done' line per operation applied. The journal is locked as
+    long as its file is open.
+    """
+
+    def __init__(self, path, f=None):
+        self.path = path
+        self.name = os.path.basename(path)[:-len(JOURNAL_SUFFIX)]
+        self.f = f
+
+    def create(cls, directory, ops):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = uuid4().hex
+        tmp_path = os.path.join(directory, name + JOURNAL_TMP_SUFFIX)
+        path = os.path.join(directory, name + JOURNAL_SUFFIX)
+        f = open(tmp_path, 'w')
+        try:
+            # locked before being visible to recoverJournals()
+            _lockFile(f)
+            f.write(JOURNAL_HEADER + '\n')
+            for op in ops:
+                f.write(' '.join([quote(str(arg)) for arg in op]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            _active_journals.add(path)
+            os.rename(tmp_path, path)
+        except:
+            _active_journals.discard(path)
+            f.close()
+            os.remove(tmp_path)
+            raise
+        return cls(path, f)
+    create = classmethod(create)
+
+    def openUnused(cls, path):
+        """Open and lock the journal of a dead transaction.
+
+        Returns None if it is in use, or was removed meanwhile.
+        """
+        if path in _active_journals:
+            return None
+        try:
+            f = open(path, 'r+')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if not _lockFile(f, blocking=False):
+            f.close()
+            return None
+        if fcntl is not None and not os.fstat(f.fileno()).st_nlink:
+            # removed by its process before we got the lock
+            f.close()
+            return None
+        return cls(path, f)
+    openUnused = classmethod(openUnused)
+
+    def read(self):
+        """Return the operations, the set of indexes of done ones, and
+        whether the transaction was committed.
+        """
+        ops = []
+        done = set()
+        committed = False
+        f = self.f
+        if f is None:
+            f = open(self.path)
+        else:
+            # reopening would release the lock
+            f.seek(0)
+        try:
+            if f.readline().strip() != JOURNAL_HEADER:
+                raise ValueError("Not a DiskFile journal: %s" % self.path)
+            for line in f:
+                if not line.endswith('\n'):
+                    break # incomplete write
+                args = [unquote(arg) for arg in line.split()]
+                if args[0] == 'commit':
+                    committed = True
+                    continue
+                if args[0] == 'done':
+                    done.add(int(args[1]))
+                    continue
+                if args[0] == 'addref':
+                    args[3] = int(args[3])
+                ops.append(tuple(args))
+        finally:
+            if f is not self.f:
+                f.close()
+        return ops, done, committed
+
+    def _write(self, line):
+        if self.f is None:
+            self.f = open(self.path, 'a')
+        self.f.seek(0, 2)
+        self.f.write(line)
+
+    def markCommitted(self):
+        self._write('commit\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def markDone(self, index):
+        self._write('done %d\n' % index)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        _active_journals.discard(self.path)
+
+    def remove(self):
+        if sys.platform == 'win32':
+            # open files can't be removed
+            self.close()
+        # else still locked while removed
+        os.remove(self.path)
+        self.close()
+
+
+def _applyOperation(op, recovering=False, marker=None):
+    """Apply an operation, return the directory to sync or None.
+
+    marker (journal name, operation index) makes the changes of reference
+    counts idempotent.
+    """
+    kind = op[0]
+    if kind == 'rename':
+        tmp_path, target = op[1:]
+        if recovering and not os.path.exists(tmp_path):
+            return None # already done
+        if sys.platform == 'win32' and os.path.exists(target):
+            # Crappy win32 cannot do an atomic rename
+            os.remove(target)
+        os.rename(tmp_path, target)
+        return os.path.dirname(target)
+    elif kind == 'remove':
+        path = op[1]
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logger.warn('Removing file %s failed. '
+                            'Stray files may linger.', path)
+        return os.path.dirname(path)
+    elif kind == 'store':
+        store_path, tmp_path, filename = op[1:]
+        store = getDedupStore(store_path)
+        if recovering and not os.path.exists(tmp_path):
+            # Stored, and referenced unless the marker wasn't recorded
+            store.addRef(filename, 1, marker)
+            return None
+        store.storeContent(tmp_path, filename, marker)
+        return os.path.dirname(os.path.join(store_path, filename))
+    elif kind == 'addref':
+        store_path, filename, delta = op[1:]
+        getDedupStore(store_path).addRef(filename, delta, marker)
+        return None
+    raise ValueError("Unknown DiskFile operation %r" % (op,))
+
+
+def _syncDirectories(directories):
+    if sys.platform == 'win32':
+        return
+    for directory in directories:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+
+def applyOperations(ops, journal=None, done=(), recovering=False):
+    """Apply file operations, marking them done in the journal."""
+    directories = set()
+    for index, op in enumerate(ops):
+        if index in done:
+            continue
+        marker = None
+        if journal is not None:
+            marker = (journal.name, index)
+        directory = _applyOperation(op, recovering=recovering,
+                                    marker=marker)
+        if directory is not None:
+            directories.add(directory)
+        if journal is not None:
+            journal.markDone(index)
+    _syncDirectories(directories)
+
+
+def removeJournal(journal, ops):
+    """Remove a journal whose operations are all applied.
+
+    The markers of its operations are forgotten afterwards: if this fails,
+    the stale markers left in the store indexes are never used again.
+    """
+    journal.remove()
+    store_paths = set([op[1] for op in ops if op[0] in ('store', 'addref')])
+    for store_path in store_paths:
+        try:
+            getDedupStore(store_path).forgetJournal(journal.name)
+        except:
+            logger.exception("Could not forget the markers of the DiskFile "
+                             "journal %s in %s", journal.path, store_path)
+
+
+def recoverJournals(directory=None):
+    """Apply the operations of journals left by a crash.
+
+    Journals in use by running processes are skipped; as there is no way
+    to tell without file locks, only call it when no other process uses
+    the directory if JOURNAL_LOCKING is false.
+
+    Returns the number of journals recovered or discarded.
+    """
+    if directory is None:
+        directory = getJournalDirectory()
+    if not os.path.isdir(directory):
+        return 0
+    count = 0
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        journal = Journal.openUnused(os.path.join(directory, name))
+        if journal is None:
+            continue
+        try:
+            ops, done, committed = journal.read()
+            if committed:
+                logger.info("Recovering DiskFile journal %s", journal.path)
+                applyOperations(ops, journal, done, recovering=True)
+            else:
+                logger.warn("Discarding DiskFile journal %s, its "
+                            "transaction wasn't committed", journal.path)
+                # no marker recorded
+                ops = ()
+        except:
+            logger.exception("Could not recover DiskFile journal %s",
+                             journal.path)
+            journal.close()
+            continue
+        removeJournal(journal, ops)
+        count += 1
+    return count
@@ -22,6 +22,7 @@ Base classes for fields, the individual parts of a schema.
 """
 
 import logging
+import re
 from copy import deepcopy
 from ComputedAttribute import ComputedAttribute
 from Globals import InitializeClass, DTMLFile
@@ -30,6 +31,7 @@ from DateTime.DateTime import DateTime
 from AccessControl import ClassSecurityInfo
 from AccessControl import getSecurityManager
 from AccessControl.PermissionRole import rolesForPermissionOn
+from Acquisition import aq_base, aq_inner, aq_parent
 
 from Products.CMFCore.Expression import Expression
 from Products.CMFCore.Expression import getEngine
@@ -52,6 +54,59 @@ from Products.CPSSchemas.interfaces import IField
 
 logger = logging.getLogger(__name__)
 
+# Default expressions whose value can't depend on anything
+_STATIC_EXPR_REGEXP = re.compile(r"""^\s*(
+    nothing |
+    string:[^$]* |
+    python:\s*(None|True|False|-?\d+(\.\d*)?|'[^'\\]*'|"[^"\\]*"|
+                \[\s*\]|\{\s*\}|\(\s*\))\s*
+    )$""", re.VERBOSE | re.DOTALL)
+
+# Values that don't need to be copied when handed out
+_IMMUTABLE_TYPES = (str, unicode, int, long, float, bool, type(None),
+                    DateTime)
+
+def isStaticExpression(expr):
+    """Tell if a TALES expression always evaluates to the same value."""
+    return _STATIC_EXPR_REGEXP.match(expr) is not None
+
+
+class StorageNamespace(dict):
+    """Namespace for storage expressions, over data but not copying it.
+
+    Own items (value, field, portal...) take precedence over data items.
+    Data is looked up at each access, therefore always up to date.
+    """
+
+    def __init__(self, data, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self._data = data
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            pass
+        value = self._data[key]
+        if value is DEFAULT_VALUE_MARKER:
+            return '' # XXX should be field's default
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._data
+
+    has_key = __contains__
+
+    def copy(self):
+        return StorageNamespace(self._data, self)
+
+
 class Field(PropertiesPostProcessor, SimpleItemWithProperties):
     """Basic Field.
 
@@ -70,6 +125,8 @@ class Field(PropertiesPostProcessor, SimpleItemWithProperties):
          'label': "Id"},
         {'id': 'default_expr', 'type': 'string', 'mode': 'w',
          'label': "Default value expression"},
+        {'id': 'default_expr_static', 'type': 'boolean', 'mode': 'w',
+         'label': "Default value expression is static"},
         {'id': 'is_searchabletext', 'type': 'boolean', 'mode': 'w',
          'label': "Indexed by SearchableText"},
         {'id': 'acl_read_permissions', 'type': 'string', 'mode': 'w',
@@ -105,6 +162,7 @@ class Field(PropertiesPostProcessor, SimpleItemWithProperties):
         )
 
     default_expr = 'string:'
+    default_expr_static = False
     is_searchabletext = 0
     acl_read_permissions = ''
     acl_read_roles = ''
@@ -133,6 +191,9 @@ class Field(PropertiesPostProcessor, SimpleItemWithProperties):
     read_process_expr_c = None
     write_process_expr_c = None
 
+    # None if unknown, () if default is not static, (value,) otherwise
+    _v_static_default = None
+
     _properties_post_process_split = (
         ('acl_read_permissions', 'acl_read_permissions_c', ',;'),
         ('acl_read_roles', 'acl_read_roles_c', ',; '),
@@ -152,11 +213,44 @@ class Field(PropertiesPostProcessor, SimpleItemWithProperties):
         self.id = id
         self.manage_changeProperties(**kw)
 
+    def _postProcessProperties(self):
+        """Post-processing after properties change.
+
+        Also tells the schema, which caches computations about its fields.
+        """
+        PropertiesPostProcessor._postProcessProperties(self)
+        aq_base(self)._v_static_default = None
+        schema = aq_parent(aq_inner(self))
+        if getattr(aq_base(schema), 'subObjectChanged', None) is not None:
+            schema.subObjectChanged()
+
     security.declarePrivate('getDefault')
     def getDefault(self, datamodel=None):
-        """Get the default value for this field."""
+        """Get the default value for this field.
+
+        Static defaults (see default_expr_static) are computed only once,
+        a copy of mutable values being returned.
+        """
         if not self.default_expr_c:
             return None
+        base = aq_base(self)
+        static = base._v_static_default
+        if static is None:
+            if self.default_expr_static or isStaticExpression(
+                self.default_expr):
+                static = (self._computeDefault(datamodel),)
+            else:
+                static = ()
+            base._v_static_default = static
+        if not static:
+            return self._computeDefault(datamodel)
+        value = static[0]
+        if not isinstance(value, _IMMUTABLE_TYPES):
+            value = deepcopy(value)
+        return value
+
+    def _computeDefault(self, datamodel):
+        """Evaluate the default value expression."""
         expr_context = self._createDefaultExpressionContext(datamodel)
         __traceback_info__ = self.default_expr
         return self.default_expr_c(expr_context)
@@ -179,19 +273,36 @@ class Field(PropertiesPostProcessor, SimpleItemWithProperties):
         return getEngine().getContext(mapping)
 
     security.declarePrivate('computeDependantFields')
-    def computeDependantFields(self, schemas, data, context=None):
+    def computeDependantFields(self, schemas, data, context=None,
+                               datamodel=None):
         """Compute dependant fields.
 
         Has access to the current schemas, and may update the data from
-        the datamodel.
+        the datamodel, which is also passed.
 
         The context argument is passed to look for placeful information.
 
         This is used for fields that update other fields when they are
         themselves updated.
+
+        May return the ids of the fields actually updated. If None is
+        returned, all the dependant fields are considered updated.
         """
         pass
 
+    def _overridesMethod(self, name):
+        """Tell if a method of Field is overridden by the field's class.
+
+        For instance, overriding storage process methods may not accept
+        the expr_context argument.
+        """
+        return (getattr(self.__class__, name).im_func is not
+                getattr(Field, name).im_func)
+
+    def _computesDependantFields(self):
+        """Tell if the field may update other fields when updated."""
+        return self._overridesMethod('computeDependantFields')
+
     security.declarePrivate('getDependantFieldsIds')
     def _getAllDependantFieldIds(self):
         """Provides the list of all *possible* dependent fields.
@@ -250,13 +361,13 @@ class Field(PropertiesPostProcessor, SimpleItemWithProperties):
     # Storage interaction
     #
     def _createStorageExpressionContext(self, value, data, context, proxy):
-        """Create an expression context for field storage process."""
-        # Put all the names in the data in the namespace.
-        mapping = data.copy() # XXX there may be DEFAULT_VALUE_MARKER here
-        # XXX hack replace DEFAULT_VALUE_MARKER
-        for k, v in mapping.items():
-            if v is DEFAULT_VALUE_MARKER:
-                mapping[k] = '' # XXX should be field's default
+        """Create an expression context for field storage process.
+
+        The context can be reused by other fields working on the same
+        data, context and proxy: see _rebindStorageExpressionContext.
+        """
+        # All the names in the data are in the namespace.
+        mapping = StorageNamespace(data)
         portal = getToolByName(self, "portal_url").getPortalObject()
         # Wrapping util in the current acquisition context
         util = fieldStorageNamespace.__of__(portal)
@@ -279,23 +390,59 @@ class Field(PropertiesPostProcessor, SimpleItemWithProperties):
             })
         return getEngine().getContext(mapping)
 
+    def _hasReadProcess(self):
+        """Tell if processValueAfterRead may change the value read."""
+        if self.read_process_expr_c:
+            return True
+        # Subclasses may have their own processing
+        return self._overridesMethod('processValueAfterRead')
+
+    def _hasWriteProcess(self):
+        """Tell if processValueBeforeWrite may change the value to write."""
+        if self.write_process_expr_c:
+            return True
+        return self._overridesMethod('processValueBeforeWrite')
+
+    def _rebindStorageExpressionContext(self, expr_context, value):
+        """Prepare a storage expression context to be used by this field."""
+        expr_context.setGlobal('value', value)
+        expr_context.setGlobal('field', self)
+
+    def _getStorageExpressionContext(self, value, data, context, proxy,
+                                     expr_context=None):
+        """Get an expression context, reusing expr_context if passed."""
+        if expr_context is None:
+            return self._createStorageExpressionContext(value, data,
+                                                        context, proxy)
+        self._rebindStorageExpressionContext(expr_context, value)
+        return expr_context
+
     security.declarePrivate('processValueAfterRead')
-    def processValueAfterRead(self, value, data, context, proxy):
-        """Process value after read from storage."""
+    def processValueAfterRead(self, value, data, context, proxy,
+                              expr_context=None):
+        """Process value after read from storage.
+
+        An expression context created for the same data, context and
+        proxy can be passed to be reused.
+        """
         if not self.read_process_expr_c:
             return value
-        expr_context = self._createStorageExpressionContext(value, data,
-                                                            context, proxy)
+        expr_context = self._getStorageExpressionContext(
+            value, data, context, proxy, expr_context=expr_context)
         __traceback_info__ = self.read_process_expr
         return self.read_process_expr_c(expr_context)
 
     security.declarePrivate('processValueBeforeWrite')
-    def processValueBeforeWrite(self, value, data, context, proxy):
-        """Process value before write to storage."""
+    def processValueBeforeWrite(self, value, data, context, proxy,
+                                expr_context=None):
+        """Process value before write to storage.
+
+        See processValueAfterRead for expr_context.
+        """
         if not self.write_process_expr_c:
             return value
-        expr_context = self._createStorageExpressionContext(value, data,
-                                                            context, proxy)
+        expr_context = self._getStorageExpressionContext(
+            value, data, context, proxy, expr_context=expr_context)
         __traceback_info__ = self.write_process_expr
         return self.write_process_expr_c(expr_context)
 
@@ -358,6 +505,29 @@ class Field(PropertiesPostProcessor, SimpleItemWithProperties):
             if not acl_expr_c(expr_context):
                 raise exception(self.getFieldId(), 'expression')
 
+    def _hasAcl(self, write=False):
+        """Tell if read (or write) access to the field may be restricted."""
+        if self._hasAclExpr(write):
+            return True
+        if write:
+            return bool(self.acl_write_permissions_c or
+                        self.acl_write_roles_c)
+        return bool(self.acl_read_permissions_c or self.acl_read_roles_c)
+
+    def _hasAclExpr(self, write=False):
+        """Tell if read (or write) access may depend on more than the user.
+
+        This is the case for ACL expressions and for subclasses having
+        their own checks.
+        """
+        if write:
+            expr_c, name = self.acl_write_expr_c, 'checkWriteAccess'
+        else:
+            expr_c, name = self.acl_read_expr_c, 'checkReadAccess'
+        if expr_c:
+            return True
+        return self._overridesMethod(name)
+
     def checkReadAccess(self, datamodel, context):
         """Check that field can be read.
 
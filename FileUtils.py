@@ -21,14 +21,111 @@
 Utilities to deal with files: conversion to HTML, or text.
 """
 
+import tempfile
 from copy import deepcopy
+try:
+    from hashlib import sha1
+except ImportError: # python < 2.5
+    from sha import new as sha1
 from ZODB.POSException import ConflictError
+from Acquisition import aq_base
+from OFS.Image import Pdata
 from Products.CMFCore.utils import getToolByName
 from Products.CPSUtil.file import ofsFileHandler
+from Products.CPSSchemas.ConversionCache import getConversionCache
 from logging import getLogger
 
 logger = getLogger('CPSSchemas.FileUtils._convertFileToMimeType')
 
+# Size of the chunks in which files are read
+CHUNK_SIZE = 1 << 16
+
+# Default maximum size of the files to convert, 0 for no limit.
+# Can be overridden by a max_conversion_size attribute on portal_schemas.
+MAX_CONVERSION_SIZE = 0
+
+def iterFileChunks(file):
+    """Iterate over the content of a Zope File object, by chunks.
+
+    The Pdata chunks of files stored in the ZODB are deactivated once read,
+    so that the whole file doesn't end up in the ZODB cache.
+    """
+    base = aq_base(file)
+    if getattr(base, '_p_activate', None) is not None:
+        base._p_activate()
+    # not through getattr: DiskFile computes data from the disk
+    data = base.__dict__.get('data')
+    if isinstance(data, Pdata):
+        while data is not None:
+            chunk = data.data
+            next = data.next
+            yield chunk
+            if data._p_jar is not None and not data._p_changed:
+                data._p_deactivate()
+            data = next
+        return
+    fh = ofsFileHandler(file)
+    try:
+        while True:
+            chunk = fh.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fh.close()
+
+
+def getFileFingerprint(file):
+    """Compute a fingerprint of the content of a file: size and SHA-1.
+
+    The file argument may be a Zope File object or None.
+
+    Returns a string, or None if there is no file.
+    """
+    if file is None:
+        return None
+    base = aq_base(file)
+    digest = getattr(base, '_content_sha1', None)
+    if digest is not None:
+        # computed on upload (DiskFile)
+        return '%d:%s' % (base.size, digest)
+    digest = sha1()
+    size = 0
+    for chunk in iterFileChunks(file):
+        size += len(chunk)
+        digest.update(chunk)
+    return '%d:%s' % (size, digest.hexdigest())
+
+
+def getMaxConversionSize(context=None):
+    """Return the maximum size of the files to convert, 0 for no limit."""
+    stool = getToolByName(context, 'portal_schemas', None)
+    return getattr(stool, 'max_conversion_size', MAX_CONVERSION_SIZE)
+
+
+def readFile(file, max_size=0):
+    """Read the content of a Zope File object, by chunks, into a string.
+
+    The chunks are spooled to a temporary file, then read at once: only the
+    resulting string is in memory, not the chunks besides.
+
+    Returns None if the content is bigger than max_size (if not 0), without
+    reading further.
+    """
+    spool = tempfile.TemporaryFile()
+    try:
+        size = 0
+        for chunk in iterFileChunks(file):
+            size += len(chunk)
+            if max_size and size > max_size:
+                return None
+            spool.write(chunk)
+        spool.seek(0)
+        return spool.read(size)
+    finally:
+        spool.close()
+
+
 def _convertFileToMimeType(file, mime_type, context=None, **kwargs):
     """Convert a file to a new mime type.
 
@@ -37,6 +134,11 @@ def _convertFileToMimeType(file, mime_type, context=None, **kwargs):
     The context argument is used to find placeful tools.
 
     Returns a string, or None if no conversion is possible.
+
+    Transforms need the content as a string, so it is read in memory once
+    (the chunks of files stored in the ZODB are released as they are read,
+    see iterFileChunks). With a conversion cache, disk files whose SHA-1 is
+    known aren't read at all if the conversion is cached.
     """
     if file is None:
         return None
@@ -44,13 +146,12 @@ def _convertFileToMimeType(file, mime_type, context=None, **kwargs):
     if transformer is None:
         logger.debug('No portal_transforms')
         return None
-    fh = ofsFileHandler(file)
-    raw = fh.read() # TODO RAM efficiency
-    fh.close()
-
-    if not raw:
+    max_size = getMaxConversionSize(context)
+    get_size = getattr(file, 'get_size', None)
+    if max_size and get_size is not None and get_size() > max_size:
+        logger.debug('Not converting %s, bigger than %s bytes',
+                     repr(file), max_size)
         return None
-    logger.debug('to %s for file %s', mime_type, repr(file))
     current_mime_type = getattr(file, 'content_type',
                                 'application/octet-stream')
     if context is not None:
@@ -58,6 +159,38 @@ def _convertFileToMimeType(file, mime_type, context=None, **kwargs):
     else:
         default_encoding = 'utf-8'
 
+    # other arguments may change the result, don't cache then
+    cache = not kwargs and getConversionCache() or None
+    key = None
+    if cache is not None:
+        digest = getattr(aq_base(file), '_content_sha1', None)
+        if digest is not None:
+            # computed on upload (DiskFile)
+            key = (digest, current_mime_type, mime_type, default_encoding)
+            data = cache.get(key)
+            if data is not None:
+                logger.debug('to %s for file %s: cached',
+                             mime_type, repr(file))
+                return data
+
+    raw = readFile(file, max_size)
+    if raw is None:
+        logger.debug('Not converting %s, bigger than %s bytes',
+                     repr(file), max_size)
+        return None
+    if not raw:
+        return None
+
+    if cache is not None and key is None:
+        key = (sha1(raw).hexdigest(), current_mime_type, mime_type,
+               default_encoding)
+        data = cache.get(key)
+        if data is not None:
+            logger.debug('to %s for file %s: cached', mime_type, repr(file))
+            return data
+
+    logger.debug('to %s for file %s', mime_type, repr(file))
+
     try:
       data = transformer.convertTo(mime_type, raw, mimetype=current_mime_type,
       	                           # filename='fooXXX', encoding='',
@@ -74,6 +207,12 @@ def _convertFileToMimeType(file, mime_type, context=None, **kwargs):
 
     if not data:
         return None
+    if cache is not None:
+        try:
+            cache.set(key, data)
+        except (IOError, OSError), e:
+            logger.warn("Could not cache the conversion to %s of %s: %s",
+                        mime_type, repr(file), e)
     return data
 
 
@@ -35,8 +35,42 @@ class FolderWithPrefixedIds(Folder):
 
     prefix = 'prefix__'
 
+    # Volatile attributes holding data computed from the subobjects.
+    # They are dropped whenever the subobjects change.
+    _volatile_caches = ()
+
+    # (keys, mapping key -> id), see _getKeyIndex
+    _v_key_index = None
+
     security = ClassSecurityInfo()
 
+    def _clearVolatileCaches(self):
+        """Drop the volatile caches computed from the subobjects."""
+        for attr in ('_v_key_index',) + tuple(self._volatile_caches):
+            try:
+                delattr(self, attr)
+            except (AttributeError, KeyError):
+                pass
+
+    security.declarePrivate('subObjectChanged')
+    def subObjectChanged(self):
+        """Tell that a subobject has been modified.
+
+        Volatile caches are dropped, in this ZODB connection and, through
+        invalidation, in the other ones.
+        """
+        self._clearVolatileCaches()
+        self._p_changed = 1
+
+    def _setObject(self, id, object, *args, **kw):
+        res = Folder._setObject(self, id, object, *args, **kw)
+        self._clearVolatileCaches()
+        return res
+
+    def _delObject(self, id, *args, **kw):
+        Folder._delObject(self, id, *args, **kw)
+        self._clearVolatileCaches()
+
     security.declarePrivate('addSubObject')
     def addSubObject(self, ob):
         """Add a subobject, with a correctly prefixed id.
@@ -66,6 +100,25 @@ class FolderWithPrefixedIds(Folder):
         else:
             return id
 
+    def _getKeyIndex(self):
+        """Get the ordered keys and the mapping from key to subobject id.
+
+        Kept until the subobjects change.
+        """
+        index = self._v_key_index
+        if index is None:
+            keys = []
+            ids = {}
+            prefix = self.prefix
+            prefixlen = len(prefix)
+            for id in self.objectIds():
+                if id.startswith(prefix):
+                    key = id[prefixlen:]
+                    keys.append(key)
+                    ids[key] = id
+            index = self._v_key_index = (tuple(keys), ids)
+        return index
+
     # Simple dict-like access without prefix
 
     def __getitem__(self, key):
@@ -81,30 +134,21 @@ class FolderWithPrefixedIds(Folder):
     security.declareProtected(AccessContentsInformation, 'keys')
     def keys(self):
         """Return subobjects ids without prefix."""
-        keys = []
-        prefix = self.prefix
-        prefixlen = len(prefix)
-        for id in self.objectIds():
-            if id.startswith(prefix):
-                keys.append(id[prefixlen:])
-        return keys
+        return list(self._getKeyIndex()[0])
 
     security.declareProtected(AccessContentsInformation, 'items')
     def items(self):
         """Return items, ids without prefix."""
-        items = []
-        prefix = self.prefix
-        prefixlen = len(prefix)
-        for id, value in self.objectItems():
-            if id.startswith(prefix):
-                items.append((id[prefixlen:], value))
-        return items
+        keys, ids = self._getKeyIndex()
+        _getOb = self._getOb
+        return [(key, _getOb(ids[key])) for key in keys]
 
     security.declareProtected(AccessContentsInformation, 'has_key')
     def has_key(self, key):
         """Test if key is present."""
-        if not key.startswith(self.prefix):
-            key = self.prefix + key
-        return key in self.objectIds()
+        prefix = self.prefix
+        if key.startswith(prefix):
+            key = key[len(prefix):]
+        return key in self._getKeyIndex()[1]
 
 InitializeClass(FolderWithPrefixedIds)
@@ -0,0 +1,282 @@
+# (C) Copyright 2010 CPS-CMS Community <http://cps-cms.org/>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Cache of rendered widget fragments.
+
+Layouts rendered in view mode for anonymous users can reuse the rendering
+of widgets whose cache_view_rendering property is set. Fragments are
+keyed by the widget (path and modification time), the document (paths
+and modification times of the object and its proxy), the values of the
+widget fields, the language, the theme page and the server URL.
+
+Only widgets whose view rendering depends on nothing else should be
+marked, e.g. not those requiring resources or using the request.
+
+The cache is kept in RAM, the least recently used fragments are removed
+when it grows bigger than its maximum size. There is no cache by default,
+use setFragmentCache() to set one, e.g.:
+
+  setFragmentCache(FragmentCache(10 << 20))
+"""
+
+import threading
+from logging import getLogger
+try:
+    from hashlib import sha1
+except ImportError: # python < 2.5
+    from sha import new as sha1
+
+from Acquisition import aq_base
+from AccessControl import getSecurityManager
+from DateTime.DateTime import DateTime
+
+from Products.CMFCore.utils import getToolByName
+from Products.CPSSchemas.Widget import REQUEST_NEGOCIATED_THEME_MARKER
+
+logger = getLogger(__name__)
+
+ANONYMOUS_USER_NAME = 'Anonymous User'
+
+# Types of the values that have a stable representation
+_SIMPLE_TYPES = (str, unicode, int, long, float, bool, type(None), DateTime)
+
+
+class FragmentCache:
+    """Rendered fragments kept in RAM, with LRU eviction."""
+
+    # When full, the cache is reduced to this part of its maximum size,
+    # so that evictions (which sort the entries) don't happen too often.
+    low_water = 0.75
+
+    def __init__(self, max_size=10 << 20):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {} # key -> [fragment, size, last use]
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the fragment cached for key, or None."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._clock += 1
+            entry[2] = self._clock
+            self.hits += 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, fragment):
+        """Cache a fragment for key.
+
+        Returns False if the fragment is too big to be cached.
+        """
+        size = len(fragment)
+        if isinstance(fragment, unicode):
+            size *= 2
+        if size > self.max_size:
+            return False
+        self._lock.acquire()
+        try:
+            old = self._entries.get(key)
+            if old is not None:
+                self.size -= old[1]
+            self._clock += 1
+            self._entries[key] = [fragment, size, self._clock]
+            self.size += size
+            if self.size > self.max_size:
+                self._evict()
+        finally:
+            self._lock.release()
+        return True
+
+    def _evict(self):
+        """Remove the least recently used fragments."""
+        target = self.max_size * self.low_water
+        entries = [(entry[2], key) for key, entry in self._entries.items()]
+        entries.sort()
+        for last_use, key in entries:
+            if self.size <= target:
+                break
+            self.size -= self._entries.pop(key)[1]
+
+    def getStatistics(self):
+        """Return a dict with the hits, misses, size and entries counts."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': self.size,
+                'entries': len(self._entries),
+                }
+
+    def clear(self):
+        """Remove all fragments and reset the counters."""
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            self.size = 0
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+
+_cache = None
+
+def getFragmentCache():
+    """Return the fragment cache, or None if there is none."""
+    return _cache
+
+def setFragmentCache(cache):
+    """Set the fragment cache (None to disable), returns the previous one."""
+    global _cache
+    old = _cache
+    _cache = cache
+    return old
+
+
+def _getStableRepr(value):
+    """Return a representation of value that doesn't change between
+    requests, or None if there is none.
+    """
+    if isinstance(value, _SIMPLE_TYPES):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        items = [_getStableRepr(item) for item in value]
+        if None in items:
+            return None
+        return '[%s]' % ', '.join(items)
+    if isinstance(value, dict):
+        items = []
+        for key, item in value.items():
+            key, item = _getStableRepr(key), _getStableRepr(item)
+            if key is None or item is None:
+                return None
+            items.append('%s: %s' % (key, item))
+        items.sort()
+        return '{%s}' % ', '.join(items)
+    return None
+
+
+def _getPersistentKey(ob):
+    """Return (path, modification time) of a stored object, or None."""
+    mtime = getattr(aq_base(ob), '_p_mtime', None)
+    if mtime is None or getattr(ob, 'getPhysicalPath', None) is None:
+        return None
+    return (ob.getPhysicalPath(), mtime)
+
+
+def _getWidgetKey(widget):
+    """Return the key of a widget, or None.
+
+    Indirect widgets are rendered by their worker widget, their key also
+    holds the state of their base widget.
+    """
+    key = _getPersistentKey(widget)
+    if key is None:
+        return None
+    if getattr(aq_base(widget), 'getBaseWidgetState', None) is None:
+        return key
+    serial, changed = widget.getBaseWidgetState()
+    if changed:
+        # being modified, no serial yet
+        return None
+    return key + (serial,)
+
+
+def getRenderingKey(datastructure, **kw):
+    """Return the part of the fragment keys shared by a layout rendering.
+
+    kw are the keywords passed to the widgets. Returns None if fragments
+    can't be cached for this rendering.
+    """
+    if getSecurityManager().getUser().getUserName() != ANONYMOUS_USER_NAME:
+        return None
+    dm = datastructure.getDataModel()
+    ob = dm.getObject()
+    ob_key = _getPersistentKey(ob)
+    if ob_key is None:
+        return None
+    proxy = dm.getProxy()
+    if proxy is not None:
+        proxy_key = _getPersistentKey(proxy)
+        if proxy_key is None:
+            return None
+    else:
+        proxy_key = None
+
+    options = []
+    for name, value in kw.items():
+        if name == 'widget_infos':
+            continue
+        value = _getStableRepr(value)
+        if value is None:
+            return None
+        options.append((name, value))
+    options.sort()
+
+    translation_service = getToolByName(ob, 'translation_service', None)
+    if translation_service is not None:
+        language = translation_service.getSelectedLanguage()
+    else:
+        language = None
+    request = getattr(ob, 'REQUEST', None)
+    if request is not None:
+        theme_page = getattr(request, REQUEST_NEGOCIATED_THEME_MARKER, None)
+        server_url = request.get('SERVER_URL')
+    else:
+        theme_page = server_url = None
+    return (ob_key, proxy_key, tuple(options), language,
+            _getStableRepr(theme_page), server_url)
+
+
+def getFragmentKey(widget, datastructure, rendering_key, widget_infos):
+    """Return the cache key of the view rendering of a widget, or None.
+
+    rendering_key comes from getRenderingKey().
+    """
+    if rendering_key is None:
+        return None
+    worker = widget
+    if getattr(aq_base(widget), 'getWorkerWidget', None) is not None:
+        worker = widget.getWorkerWidget()
+    if not worker.cache_view_rendering:
+        return None
+    widget_key = _getWidgetKey(widget)
+    if widget_key is None:
+        return None
+    dm = datastructure.getDataModel()
+    values = [dm.get(field_id) for field_id in widget.fields]
+    values.append(datastructure.get(widget.getWidgetId()))
+    values = _getStableRepr(values)
+    if values is None:
+        return None
+    # Compound widgets depend on their subwidgets and their modes
+    subwidgets = []
+    for widget_id in getattr(aq_base(worker), 'widget_ids', ()):
+        info = widget_infos.get(widget_id)
+        if info is None:
+            subwidgets.append(None)
+            continue
+        subwidgets.append((_getWidgetKey(info['widget']),
+                           info['widget_mode']))
+    return (widget_key, rendering_key, sha1(values).hexdigest(),
+            tuple(subwidgets))
@@ -26,6 +26,7 @@ import logging
 from copy import deepcopy
 from Globals import InitializeClass, DTMLFile
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
 
 from OFS.Folder import Folder
 
@@ -41,12 +42,139 @@ from Products.CPSUtil.property import PropertiesPostProcessor
 from Products.CPSSchemas.FolderWithPrefixedIds import FolderWithPrefixedIds
 from Products.CPSSchemas.DataModel import ReadAccessError
 from Products.CPSSchemas.Widget import widgetRegistry
+from Products.CPSSchemas.FragmentCache import getFragmentCache
+from Products.CPSSchemas.FragmentCache import getRenderingKey, getFragmentKey
 
 from zope.interface import implements
 from Products.CPSSchemas.interfaces import ILayout
 
 logger = logging.getLogger(__name__)
 
+
+def _getWorkerWidget(widget):
+    """Return the worker of an indirect widget, or the widget itself."""
+    if getattr(aq_base(widget), 'getWorkerWidget', None) is not None:
+        return widget.getWorkerWidget()
+    return widget
+
+
+def _freezeExtra(mapping, keys):
+    """Return the items of mapping other than keys, as a sorted tuple.
+
+    Values are copied, so that the persistent definition can't be changed
+    through the frozen one.
+    """
+    items = [(key, deepcopy(value)) for key, value in mapping.items()
+             if key not in keys]
+    items.sort()
+    return tuple(items)
+
+
+class LayoutCell(object):
+    """A cell of a frozen layout definition.
+
+    Immutable, so it can be shared by all the users of the definition.
+    Keys other than widget_id and ncols are kept, read-only.
+    """
+
+    __slots__ = ('widget_id', 'ncols', '_extra')
+
+    _keys = ('widget_id', 'ncols')
+
+    def __init__(self, widget_id, ncols=1, extra=()):
+        object.__setattr__(self, 'widget_id', widget_id)
+        object.__setattr__(self, 'ncols', ncols)
+        object.__setattr__(self, '_extra', tuple(extra))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Layout cells are immutable")
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            return getattr(self, key)
+        for extra_key, value in self._extra:
+            if extra_key == key:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        return (isinstance(other, LayoutCell) and
+                self.widget_id == other.widget_id and
+                self.ncols == other.ncols and
+                self._extra == other._extra)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<LayoutCell %r ncols=%d>' % (self.widget_id, self.ncols)
+
+    def asDict(self):
+        """Return the cell as a (mutable) dict."""
+        cell = self._extra and dict(deepcopy(self._extra)) or {}
+        cell['widget_id'] = self.widget_id
+        cell['ncols'] = self.ncols
+        return cell
+
+
+class FrozenLayoutDefinition(object):
+    """An immutable layout definition.
+
+    Rows are tuples of LayoutCell objects. Keys other than ncols and rows
+    are kept, read-only.
+    """
+
+    __slots__ = ('ncols', 'rows', '_extra')
+
+    _keys = ('ncols', 'rows')
+
+    def __init__(self, layoutdef):
+        rows = tuple([tuple([LayoutCell(cell['widget_id'],
+                                        cell.get('ncols', 1),
+                                        _freezeExtra(cell, LayoutCell._keys))
+                             for cell in row])
+                      for row in layoutdef['rows']])
+        object.__setattr__(self, 'ncols', layoutdef.get('ncols', 1))
+        object.__setattr__(self, 'rows', rows)
+        object.__setattr__(self, '_extra',
+                           _freezeExtra(layoutdef, self._keys))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Layout definitions are immutable")
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            return getattr(self, key)
+        for extra_key, value in self._extra:
+            if extra_key == key:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def getExtra(self):
+        """Return the keys other than ncols and rows, as a (mutable) dict.
+        """
+        return self._extra and dict(deepcopy(self._extra)) or {}
+
+    def asDict(self):
+        """Return the definition in its (mutable) dict form."""
+        layoutdef = self.getExtra()
+        layoutdef['ncols'] = self.ncols
+        layoutdef['rows'] = [[cell.asDict() for cell in row]
+                             for row in self.rows]
+        return layoutdef
+
 class LayoutContainer(Folder):
     """Layout Tool
 
@@ -160,6 +288,24 @@ class Layout(PropertiesPostProcessor,
     prefix = 'w__'
     id = None
 
+    _volatile_caches = ('_v_frozen_layoutdef', '_v_layout_field_ids',
+                        '_v_static_widget_ids', '_v_layout_skeletons',
+                        '_v_indirect_widget_ids', '_v_base_widget_states')
+    _v_frozen_layoutdef = None
+    _v_layout_field_ids = None
+    _v_static_widget_ids = None
+    _v_layout_skeletons = None
+    _v_indirect_widget_ids = None
+    _v_base_widget_states = None
+
+    # Volatile caches depending on the base widgets of indirect widgets,
+    # see _checkBaseWidgets
+    _base_widget_caches = ('_v_layout_field_ids', '_v_static_widget_ids',
+                           '_v_layout_skeletons')
+
+    # Maximum number of layout skeletons cached, see computeLayoutStructure
+    max_layout_skeletons = 100
+
     security = ClassSecurityInfo()
     security.setDefaultAccess('allow')
 
@@ -233,12 +379,75 @@ class Layout(PropertiesPostProcessor,
         """Set the layout definition."""
         layoutdef = self.normalizeLayoutDefinition(layoutdef)
         self._layoutdef = deepcopy(layoutdef)
+        self._clearVolatileCaches()
 
     security.declareProtected(View, 'getLayoutDefinition')
     def getLayoutDefinition(self):
-        """Get the layout definition."""
+        """Get the layout definition.
+
+        This is a copy that can be modified, see getFrozenLayoutDefinition
+        to read it.
+        """
         return deepcopy(self._layoutdef)
 
+    security.declarePrivate('getFrozenLayoutDefinition')
+    def getFrozenLayoutDefinition(self):
+        """Get the layout definition as a FrozenLayoutDefinition.
+
+        It is shared and not copied, and cached until the definition
+        changes.
+        """
+        frozen = self._v_frozen_layoutdef
+        if frozen is None:
+            frozen = FrozenLayoutDefinition(self._layoutdef)
+            self._v_frozen_layoutdef = frozen
+        return frozen
+
+    security.declarePrivate('getLayoutFieldIds')
+    def getLayoutFieldIds(self, layout_mode):
+        """Return the ids of the fields used by the widgets in layout_mode.
+
+        Widgets of compound widgets and workers of indirect widgets are
+        followed. Widgets statically hidden in layout_mode are skipped.
+
+        This is meant to restrict the fields to read beforehand (see
+        DataModel._fetch). The result is a frozenset, cached until the
+        layout, its widgets or the base widgets of its indirect widgets
+        change.
+        """
+        self._checkBaseWidgets()
+        cache = self._v_layout_field_ids
+        if cache is None:
+            cache = self._v_layout_field_ids = {}
+        field_ids = cache.get(layout_mode)
+        if field_ids is not None:
+            return field_ids
+
+        field_ids = set()
+        done = set()
+        todo = [cell.widget_id
+                for row in self.getFrozenLayoutDefinition().rows
+                for cell in row]
+        while todo:
+            widget_id = todo.pop()
+            if widget_id in done:
+                continue
+            done.add(widget_id)
+            if not self.has_key(widget_id):
+                continue
+            widget = self[widget_id]
+            if widget.isHidden():
+                continue
+            if hasattr(aq_base(widget), 'getWorkerWidget'):
+                widget = widget.getWorkerWidget()
+            if layout_mode in widget.hidden_layout_modes:
+                continue
+            field_ids.update(widget.fields)
+            todo.extend(getattr(aq_base(widget), 'widget_ids', ()))
+
+        field_ids = cache[layout_mode] = frozenset(field_ids)
+        return field_ids
+
     security.declarePrivate('removeHiddenWidgets')
     def removeHiddenWidgets(self, layout_structure):
         """Remove cells of hidden widgets.
@@ -293,50 +502,187 @@ class Layout(PropertiesPostProcessor,
          - widget_javascript
          - widget_input_area_id
         (In addition to widget_id and ncols of the standard data.)
+
+        The information of widgets without expressions only depends on
+        the layout mode and the write access to their fields: it is
+        compiled once in a skeleton for each combination, and only the
+        other widgets are computed for each call.
         """
-        layout_structure = self.getLayoutDefinition() # get a copy
-        layout_structure['layout'] = self
-        layout_structure['layout_id'] = self.getId() # XXX FIXME remove
+        self._checkBaseWidgets()
+        forbidden = datamodel._forbidden_widgets
+        key = (layout_mode, tuple(forbidden),
+               self._getAclSignature(layout_mode, datamodel))
+        skeletons = self._v_layout_skeletons
+        if skeletons is None:
+            skeletons = self._v_layout_skeletons = {}
+        skeleton = skeletons.get(key)
+        if skeleton is None:
+            if len(skeletons) >= self.max_layout_skeletons:
+                skeletons.clear()
+            skeleton = self._compileLayoutSkeleton(layout_mode, datamodel)
+            skeletons[key] = skeleton
+        static_infos, skeleton_rows = skeleton
+
         # Set the mode, CSS class and JavaScript code for all the widgets.
         widgets = {}
         for widget_id, widget in self.items():
-            if (not widget_id in datamodel._forbidden_widgets
-                and not widget.isHidden()):
-                mode = widget.getModeFromLayoutMode(layout_mode, datamodel)
-                css_class = widget.getCssClass(layout_mode, datamodel)
-                js_code = widget.getJavaScriptCode(layout_mode, datamodel)
-                # Information about a potential input area is important for
-                # accessibility: it is used to associate the widget label with a
-                # potential input area.
-                if widget.has_input_area and mode != 'view':
-                    input_area_id = widget.getHtmlWidgetId()
-                else:
-                    input_area_id = None
-                widgets[widget_id] = {
-                    'widget': widget,
-                    'widget_mode': mode,
-                    'widget_css_class': css_class,
-                    'widget_javascript': js_code,
-                    'widget_input_area_id': input_area_id,
-                    }
+            info = static_infos.get(widget_id)
+            if info is None:
+                info = self._computeWidgetInfo(widget, layout_mode, datamodel)
             else:
-                widgets[widget_id] = {
-                    'widget': widget,
-                    'widget_mode': 'hidden',
-                    }
-
+                info = info.copy()
+            info['widget'] = widget
+            widgets[widget_id] = info
+
+        # Store computed widget info in row/cell structure, without the
+        # hidden widgets.
+        rows = []
+        for skeleton_row in skeleton_rows:
+            row = []
+            for skeleton_cell in skeleton_row:
+                widget_id = skeleton_cell.widget_id
+                info = widgets[widget_id]
+                if info['widget_mode'] == 'hidden':
+                    continue
+                cell = skeleton_cell.asDict()
+                cell.update(info)
+                row.append(cell)
+            rows.append(row)
+
+        frozen = self.getFrozenLayoutDefinition()
+        layout_structure = frozen.getExtra()
+        layout_structure['ncols'] = frozen.ncols
+        layout_structure['rows'] = rows
+        layout_structure['layout'] = self
+        layout_structure['layout_id'] = self.getId() # XXX FIXME remove
         layout_structure['widgets'] = widgets
-        # Store computed widget info in row/cell structure.
-        for row in layout_structure['rows']:
+        self.normalizeLayoutDefinition(layout_structure)
+        return layout_structure
+
+    security.declarePrivate('_computeWidgetInfo')
+    def _computeWidgetInfo(self, widget, layout_mode, datamodel):
+        """Compute the mode, CSS class and JavaScript code of a widget."""
+        mode = widget.getModeFromLayoutMode(layout_mode, datamodel)
+        css_class = widget.getCssClass(layout_mode, datamodel)
+        js_code = widget.getJavaScriptCode(layout_mode, datamodel)
+        # Information about a potential input area is important for
+        # accessibility: it is used to associate the widget label with a
+        # potential input area.
+        if widget.has_input_area and mode != 'view':
+            input_area_id = widget.getHtmlWidgetId()
+        else:
+            input_area_id = None
+        return {
+            'widget_mode': mode,
+            'widget_css_class': css_class,
+            'widget_javascript': js_code,
+            'widget_input_area_id': input_area_id,
+            }
+
+    security.declarePrivate('_checkBaseWidgets')
+    def _checkBaseWidgets(self):
+        """Drop the caches depending on the base widgets of indirect widgets
+        if they changed.
+
+        Base widgets live in other layouts, their changes aren't notified
+        to this one (see subObjectChanged).
+        """
+        widget_ids = self._v_indirect_widget_ids
+        if widget_ids is None:
+            widget_ids = [widget_id for widget_id, widget in self.items()
+                          if getattr(aq_base(widget), 'getBaseWidgetState',
+                                     None) is not None]
+            widget_ids = self._v_indirect_widget_ids = tuple(widget_ids)
+        if not widget_ids:
+            return
+        states = tuple([self[widget_id].getBaseWidgetState()
+                        for widget_id in widget_ids])
+        if states == self._v_base_widget_states:
+            return
+        for attr in self._base_widget_caches:
+            try:
+                delattr(self, attr)
+            except (AttributeError, KeyError):
+                pass
+        self._v_base_widget_states = states
+
+    security.declarePrivate('_getStaticWidgetIds')
+    def _getStaticWidgetIds(self):
+        """Return the ids of the widgets whose mode is cacheable.
+
+        See Widget.hasDynamicMode, indirect widgets are checked through
+        their worker. Hidden (template) widgets are included.
+        """
+        widget_ids = self._v_static_widget_ids
+        if widget_ids is None:
+            widget_ids = [widget_id for widget_id, widget in self.items()
+                          if widget.isHidden() or
+                          not _getWorkerWidget(widget).hasDynamicMode()]
+            widget_ids = self._v_static_widget_ids = tuple(widget_ids)
+        return widget_ids
+
+    security.declarePrivate('_getAclSignature')
+    def _getAclSignature(self, layout_mode, datamodel):
+        """Return the ids of the static widgets that are read-only.
+
+        Only the widgets whose mode depends on it in layout_mode are
+        checked.
+        """
+        if not datamodel._check_acls:
+            return None
+        forbidden = datamodel._forbidden_widgets
+        view = layout_mode.startswith('view')
+        readonly = []
+        for widget_id in self._getStaticWidgetIds():
+            if widget_id in forbidden:
+                continue
+            widget = self[widget_id]
+            if widget.isHidden():
+                continue
+            widget = _getWorkerWidget(widget)
+            if layout_mode in widget.hidden_layout_modes:
+                continue
+            if view and layout_mode not in widget.hidden_readonly_layout_modes:
+                continue
+            if widget._isReadOnly(datamodel):
+                readonly.append(widget_id)
+        return tuple(readonly)
+
+    security.declarePrivate('_compileLayoutSkeleton')
+    def _compileLayoutSkeleton(self, layout_mode, datamodel):
+        """Compile the parts of the layout structure that can be cached.
+
+        Returns the information of static widgets, by widget id (without
+        the widget itself), and the rows of LayoutCell objects of the
+        layout definition without the missing or statically hidden widgets.
+        """
+        forbidden = datamodel._forbidden_widgets
+        static_infos = {}
+        for widget_id in self._getStaticWidgetIds():
+            widget = self[widget_id]
+            if widget_id in forbidden or widget.isHidden():
+                static_infos[widget_id] = {'widget_mode': 'hidden'}
+            else:
+                static_infos[widget_id] = self._computeWidgetInfo(
+                    widget, layout_mode, datamodel)
+        for widget_id in forbidden:
+            static_infos[widget_id] = {'widget_mode': 'hidden'}
+
+        rows = []
+        for row in self.getFrozenLayoutDefinition().rows:
+            skeleton_row = []
             for cell in row:
-                if widgets.has_key(cell['widget_id']):
-                    cell.update(widgets[cell['widget_id']])
-                else:
+                widget_id = cell.widget_id
+                if not self.has_key(widget_id):
                     logger.warn('Layout %s refers to missing (deleted?) '
-                                'widget %r', self.getId(), cell['widget_id'])
-        # Eliminate hidden widgets.
-        self.removeHiddenWidgets(layout_structure)
-        return layout_structure
+                                'widget %r', self.getId(), widget_id)
+                    continue
+                info = static_infos.get(widget_id)
+                if info is not None and info['widget_mode'] == 'hidden':
+                    continue
+                skeleton_row.append(cell)
+            rows.append(tuple(skeleton_row))
+        return static_infos, tuple(rows)
 
     security.declarePrivate('validateLayoutStructure')
     def validateLayoutStructure(self, layout_structure, datastructure, **kw):
@@ -389,22 +735,40 @@ class Layout(PropertiesPostProcessor,
 
         After rendering, the structure may be updated because some empty
         widgets may have been removed.
+
+        If a fragment cache is set, the view renderings of the widgets
+        marked as cacheable are taken from it when possible.
         """
         widget_infos = layout_structure['widgets']
+        cache = getFragmentCache()
+        if cache is not None:
+            rendering_key = getRenderingKey(datastructure, **kw)
         for row in layout_structure['rows']:
             for cell in row:
                 widget = cell['widget']
                 mode = cell['widget_mode']
-                try:
-                    rendered = widget.render(mode, datastructure,
-                                             widget_infos=widget_infos, **kw)
-                except UnicodeDecodeError:
-                    logger.warn(
-                        'renderLayoutStructure: widget %r',
-                        'widget %r mixes unicode and non ascii string: ds=%s',
-                        widget.absolute_url_path(), str(datastructure))
-                    raise
-                rendered = rendered.strip()
+                fragment_key = None
+                if cache is not None and mode == 'view':
+                    fragment_key = getFragmentKey(widget, datastructure,
+                                                  rendering_key, widget_infos)
+                rendered = None
+                if fragment_key is not None:
+                    rendered = cache.get(fragment_key)
+                if rendered is None:
+                    try:
+                        rendered = widget.render(mode, datastructure,
+                                                 widget_infos=widget_infos,
+                                                 **kw)
+                    except UnicodeDecodeError:
+                        logger.warn(
+                            'renderLayoutStructure: widget %r',
+                            'widget %r mixes unicode and non ascii string: '
+                            'ds=%s',
+                            widget.absolute_url_path(), str(datastructure))
+                        raise
+                    rendered = rendered.strip()
+                    if fragment_key is not None:
+                        cache.set(fragment_key, rendered)
                 cell['widget_rendered'] = rendered
                 if widget.hidden_empty and not rendered:
                     cell['widget_mode'] = 'hidden'
@@ -53,6 +53,20 @@ class LayoutsTool(UniqueObject, LayoutContainer):
     def __init__(self):
         LayoutContainer.__init__(self, self.id)
 
+    security.declarePrivate('getLayoutsFieldIds')
+    def getLayoutsFieldIds(self, layout_ids, layout_mode):
+        """Return the ids of the fields used by some layouts in layout_mode.
+
+        Missing layouts are ignored. See Layout.getLayoutFieldIds.
+        """
+        field_ids = set()
+        for layout_id in layout_ids:
+            layout = self._getOb(layout_id, None)
+            if layout is None:
+                continue
+            field_ids.update(layout.getLayoutFieldIds(layout_mode))
+        return field_ids
+
     security.declareProtected(View, 'renderLayout')
     def renderLayout(self, layout_id, schema_id, context, mapping=None,
                      layout_mode='edit', ob=None, commit=True, **kw):
@@ -79,7 +93,7 @@ class LayoutsTool(UniqueObject, LayoutContainer):
         layout = ltool._getOb(layout_id)
         adapters = [MappingStorageAdapter(schema, ob)]
         dm = DataModel(ob, adapters, proxy=None, context=context)
-        dm._fetch()
+        dm._fetch(field_ids=layout.getLayoutFieldIds(layout_mode))
         dm._check_acls = 0 # this is needed to shortcut directory acl
         ds = DataStructure(datamodel=dm)
         layout.prepareLayoutWidgets(datastructure=ds)
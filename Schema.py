@@ -92,6 +92,9 @@ class CPSSchema(FolderWithPrefixedIds):
     meta_type = "CPS Schema"
     prefix = 'f__'
 
+    # see StorageAdapter.getAccessPlan
+    _volatile_caches = ('_v_access_plans',)
+
     security = ClassSecurityInfo()
 
     def __init__(self, id, title=''):
@@ -25,6 +25,7 @@ from AccessControl import ClassSecurityInfo
 from Products.CMFCore.utils import UniqueObject
 
 from Products.CPSSchemas.Schema import SchemaContainer
+from Products.CPSSchemas.DataModel import DataModelFactory
 
 from zope.interface import implements
 from Products.CPSSchemas.interfaces import ISchemaTool
@@ -47,4 +48,14 @@ class SchemasTool(UniqueObject, SchemaContainer):
     def __init__(self):
         SchemaContainer.__init__(self, self.id)
 
+    security.declarePrivate('getDataModelFactory')
+    def getDataModelFactory(self, schema_ids):
+        """Get a factory making datamodels for the given schemas.
+
+        Use it to make many datamodels in the same request, for instance
+        for listings or exports. See DataModel.DataModelFactory.
+        """
+        schemas = [self._getOb(schema_id) for schema_id in schema_ids]
+        return DataModelFactory(schemas)
+
 InitializeClass(SchemasTool)
@@ -56,43 +56,180 @@ def deprecate_getContentUrl():
                   'CPS 3.6. Use DataModel.fileUri() instead',
                   DeprecationWarning, stacklevel=2)
 
+class AccessPlan:
+    """Precomputed partition of the fields of a schema for data access.
+
+    Built once for a schema and a set of field ids (see getAccessPlan), it
+    spares storage adapters lots of per-field checks on each read or write.
+
+    Fields are stored without acquisition wrappers: they must not keep
+    a request alive.
+    """
+
+    def __init__(self, schema, field_ids=None):
+        if field_ids is not None:
+            field_ids = set(field_ids)
+        fields = {}
+        field_items = []
+        read_field_items = [] # fields to actually read from storage
+        ignored_field_ids = [] # fields whose storage is ignored for read
+        read_process_field_items = [] # fields with a read processing
+        # fields whose processing can share an expression context
+        read_shared_context_ids = set()
+        write_shared_context_ids = set()
+        write_items = [] # (field id, field, has write process, is stored)
+        writable_field_items = []
+        write_dependencies = {} # field id -> fields depending on it for write
+        all_dependents = [] # fields that depend for write on all others
+        for field_id, field in schema.items():
+            if field_ids is not None and field_id not in field_ids:
+                continue
+            field = aq_base(field)
+            item = (field_id, field)
+            fields[field_id] = field
+            field_items.append(item)
+            if field.read_ignore_storage:
+                ignored_field_ids.append(field_id)
+            else:
+                read_field_items.append(item)
+            if field._hasReadProcess():
+                read_process_field_items.append(item)
+                if not field._overridesMethod('processValueAfterRead'):
+                    read_shared_context_ids.add(field_id)
+            if not field._overridesMethod('processValueBeforeWrite'):
+                write_shared_context_ids.add(field_id)
+            stored = not field.write_ignore_storage
+            if stored:
+                writable_field_items.append(item)
+            write_items.append((field_id, field, field._hasWriteProcess(),
+                                stored))
+            if not field.write_process_expr:
+                continue
+            wpdf = field.write_process_dependent_fields
+            if '*' in wpdf:
+                all_dependents.append(field_id)
+                continue
+            for ancestor in wpdf:
+                write_dependencies.setdefault(ancestor, set()).add(field_id)
+
+        # Write processing is done ancestors first
+        write_order = _sortForWrite([item[0] for item in field_items],
+                                    write_dependencies, all_dependents)
+        rank = dict((field_id, i) for i, field_id in enumerate(write_order))
+        write_items.sort(key=lambda item: rank[item[0]])
+
+        # Transitive closures, with dependents in write order
+        def closure(field_ids):
+            res = set()
+            todo = list(field_ids)
+            while todo:
+                field_id = todo.pop()
+                if field_id in res:
+                    continue
+                res.add(field_id)
+                todo.extend(write_dependencies.get(field_id, ()))
+            return tuple(field_id for field_id in write_order
+                         if field_id in res)
+
+        self.fields = fields
+        self.field_items = tuple(field_items)
+        self.read_field_items = tuple(read_field_items)
+        self.ignored_field_ids = tuple(ignored_field_ids)
+        self.read_process_field_items = tuple(read_process_field_items)
+        self.read_shared_context_ids = frozenset(read_shared_context_ids)
+        self.write_shared_context_ids = frozenset(write_shared_context_ids)
+        self.write_items = tuple(write_items)
+        self.writable_field_items = tuple(writable_field_items)
+        self.write_dependencies = write_dependencies
+        self.all_dependents = all_dependents
+        self.write_closure = dict(
+            (ancestor, closure(dependents))
+            for ancestor, dependents in write_dependencies.items())
+        self.all_dependents_closure = closure(all_dependents)
+
+
+def _sortForWrite(field_ids, write_dependencies, all_dependents):
+    """Sort field ids so that write ancestors come before their dependents.
+
+    Fields depending on all others come after the other ones. The original
+    order is kept as much as possible, cycles are broken deterministically.
+    """
+    ancestors = {}
+    for ancestor, dependents in write_dependencies.items():
+        for field_id in dependents:
+            ancestors.setdefault(field_id, []).append(ancestor)
+    for field_ids_ancestors in ancestors.values():
+        field_ids_ancestors.sort()
+    known = set(field_ids)
+    all_dependents = set(all_dependents)
+    others = [field_id for field_id in field_ids
+              if field_id not in all_dependents]
+
+    res = []
+    done = set()
+    def visit(field_id):
+        if field_id in done:
+            return
+        done.add(field_id) # also breaks cycles
+        if field_id in all_dependents:
+            for ancestor in others:
+                visit(ancestor)
+        for ancestor in ancestors.get(field_id, ()):
+            if ancestor in known:
+                visit(ancestor)
+        res.append(field_id)
+    for field_id in others:
+        visit(field_id)
+    for field_id in field_ids:
+        visit(field_id)
+    return res
+
+
+def getAccessPlan(schema, field_ids=None):
+    """Get the access plan for schema, restricted to field_ids if specified.
+
+    Plans are cached on the schema, until one of its fields changes.
+    """
+    if field_ids is not None:
+        field_ids = frozenset(field_ids)
+    base = aq_base(schema)
+    if getattr(base, 'subObjectChanged', None) is None:
+        # no invalidation, no cache
+        return AccessPlan(schema, field_ids)
+    plans = getattr(base, '_v_access_plans', None)
+    if plans is None:
+        plans = base._v_access_plans = {}
+    plan = plans.get(field_ids)
+    if plan is None:
+        plan = plans[field_ids] = AccessPlan(schema, field_ids)
+    return plan
+
+
 class BaseStorageAdapter:
     """Base Storage Adapter
 
     Base class for storage adapters.
     """
 
+    # Can fields be read one at a time through _getFieldData ?
+    # Subclasses overriding _getData to read all fields at once (e.g.,
+    # in a single query) should leave this to False.
+    supports_lazy_fetch = False
+
     def __init__(self, schema, field_ids=None, **kw):
         """Create a StorageAdapter for a schema.
 
         If field_ids is specified, only those fields will be managed.
         """
         self._schema = schema
-        if field_ids is None:
-            field_ids = schema.keys()
-        field_items = []
-        writable_field_items = []
-        write_dependencies = {} # field id -> fields depending on it for write
-        all_dependents = [] # fields that depend for write on all others
-        for field_id, field in schema.items():
-            if field_id in field_ids:
-                field_items.append((field_id, field))
-                if not field.write_ignore_storage:
-                    writable_field_items.append((field_id, field))
-                if not field.write_process_expr:
-                    continue
-                wpdf = field.write_process_dependent_fields
-                if '*' in wpdf:
-                    all_dependents.append(field_id)
-                    continue
-                for ancestor in wpdf:
-                    write_dependencies.setdefault(ancestor, set()).add(
-                        field_id)
-
-        self._field_items = field_items
-        self._writable_field_items = writable_field_items
-        self._write_dependencies = write_dependencies
-        self._all_dependents = all_dependents
+        plan = self._plan = getAccessPlan(schema, field_ids)
+        self._field_items = [(field_id, field.__of__(schema))
+                             for field_id, field in plan.field_items]
+        self._writable_field_items = [
+            (field_id, field.__of__(schema))
+            for field_id, field in plan.writable_field_items]
+        self._write_dependencies = plan.write_dependencies
+        self._all_dependents = plan.all_dependents
 
     def getContextObject(self):
         """Get the underlying context for this adapter.
@@ -165,6 +302,24 @@ class BaseStorageAdapter:
         """Get data from the object, returns a mapping."""
         return self._getData(field_ids=field_ids)
 
+    def getFieldData(self, field_id, data):
+        """Get data for one field, processed after read.
+
+        The data mapping is the namespace for the read expression. It must
+        already hold the values of the field's read dependent fields.
+
+        Defaults still have to be finalized (see finalizeDefaults).
+        Only available if supports_lazy_fetch is true.
+        """
+        field = self._plan.fields[field_id].__of__(self._schema)
+        if field.read_ignore_storage:
+            value = DEFAULT_VALUE_MARKER
+        else:
+            value = self._getFieldData(field_id, field)
+        return field.processValueAfterRead(value, data,
+                                           self.getContextObject(),
+                                           self.getProxy())
+
     def setData(self, data, toset=None):
         """Set data to the object, from a mapping.
 
@@ -255,27 +410,52 @@ class BaseStorageAdapter:
 
     def _getData(self, field_ids=None, **kw):
         """Get data from the object, returns a mapping."""
-        data = {}
-        for field_id, field in self.getFieldItems():
-            if field_ids is not None and not field_id in field_ids:
-                continue
-            if field.read_ignore_storage:
-                value = DEFAULT_VALUE_MARKER
-            else:
-                value = self._getFieldData(field_id, field, **kw)
-            data[field_id] = value
+        plan = self._plan
+        schema = self._schema
+        if field_ids is None:
+            ignored_field_ids = plan.ignored_field_ids
+            read_field_items = plan.read_field_items
+        else:
+            ignored_field_ids = [field_id
+                                 for field_id in plan.ignored_field_ids
+                                 if field_id in field_ids]
+            read_field_items = [item for item in plan.read_field_items
+                                if item[0] in field_ids]
+        data = dict.fromkeys(ignored_field_ids, DEFAULT_VALUE_MARKER)
+        for field_id, field in read_field_items:
+            data[field_id] = self._getFieldData(field_id,
+                                                field.__of__(schema), **kw)
         self._getDataDoProcess(data, field_ids=field_ids, **kw)
         return data
 
     def _getDataDoProcess(self, data, field_ids=None, **kw):
-        """Process data after read."""
-        for field_id, field in self.getFieldItems():
+        """Process data after read.
+
+        Read expressions all share the same expression context.
+        """
+        plan = self._plan
+        items = plan.read_process_field_items
+        if not items:
+            return
+        shared = plan.read_shared_context_ids
+        schema = self._schema
+        context = self.getContextObject()
+        proxy = self.getProxy()
+        expr_context = None
+        for field_id, field in items:
             if field_ids is not None and field_id not in field_ids:
                 continue
+            field = field.__of__(schema)
             value = data[field_id]
-            data[field_id] = field.processValueAfterRead(value, data,
-                                                         self.getContextObject(),
-                                                         self.getProxy())
+            if field_id not in shared:
+                data[field_id] = field.processValueAfterRead(value, data,
+                                                             context, proxy)
+                continue
+            if expr_context is None:
+                expr_context = field._createStorageExpressionContext(
+                    value, data, context, proxy)
+            data[field_id] = field.processValueAfterRead(
+                value, data, context, proxy, expr_context=expr_context)
 
     def _getFieldData(self, field_id, field, **kw):
         """Get data from one field."""
@@ -298,26 +478,42 @@ class BaseStorageAdapter:
         if toset is None:
             toset = set(data)
 
-        # resolve dependencies
-        # XXX only first order dependencies are ensured. Others depend on
-        # impredictable ordering of iteration
-        for ancestor, dependents in self._write_dependencies.items():
-            if ancestor in toset:
+        # resolve dependencies, using precomputed transitive closures
+        plan = self._plan
+        write_closure = plan.write_closure
+        for ancestor in list(toset):
+            dependents = write_closure.get(ancestor)
+            if dependents:
                 toset.update(dependents)
         # being dependent on 'all' means in particular upon fields of other
-        # schemas. We have no choice but to always update.
-        toset.update(self._all_dependents)
+        # schemas: update as soon as something has changed.
+        if toset:
+            toset.update(plan.all_dependents_closure)
 
         new_data = {}
-        for field_id, field in self.getFieldItems():
-            if not field_id in toset:
+        shared = plan.write_shared_context_ids
+        schema = self._schema
+        context = self.getContextObject()
+        proxy = self.getProxy()
+        expr_context = None
+        for field_id, field, process, stored in plan.write_items:
+            if field_id not in toset:
                 continue
             value = data[field_id]
-            result = field.processValueBeforeWrite(value, data,
-                                                   self.getContextObject(),
-                                                   self.getProxy())
-            if not field.write_ignore_storage:
-                new_data[field_id] = result
+            if process:
+                field = field.__of__(schema)
+                if field_id not in shared:
+                    value = field.processValueBeforeWrite(value, data,
+                                                          context, proxy)
+                else:
+                    if expr_context is None:
+                        expr_context = field._createStorageExpressionContext(
+                            value, data, context, proxy)
+                    value = field.processValueBeforeWrite(
+                        value, data, context, proxy,
+                        expr_context=expr_context)
+            if stored:
+                new_data[field_id] = value
         return new_data
 
     def _setFieldData(self, field_id, value):
@@ -331,6 +527,8 @@ class AttributeStorageAdapter(BaseStorageAdapter):
     This adapter simply gets and sets data from/to an attribute.
     """
 
+    supports_lazy_fetch = True
+
     def __init__(self, schema, ob, proxy=None, **kw):
         """Create an Attribute Storage Adapter for a schema.
 
@@ -457,6 +655,8 @@ class MetaDataStorageAdapter(BaseStorageAdapter):
     standard CMF Dublin Core methods, or using specific attributes otherwise.
     """
 
+    supports_lazy_fetch = True
+
     _field_attributes = {
         'Creator': ACCESSOR_READ_ONLY,
         'CreationDate': ('creation_date', None),
@@ -539,6 +739,8 @@ class MappingStorageAdapter(BaseStorageAdapter):
     This adapter simply store data into a dictionnary.
     """
 
+    supports_lazy_fetch = True
+
     def __init__(self, schema, ob, **kw):
         """Create an Attribute Storage Adapter for a schema.
 
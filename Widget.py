@@ -32,6 +32,7 @@ import logging
 from Persistence import Persistent
 from Globals import InitializeClass, DTMLFile
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base, aq_inner, aq_parent
 
 from Products.CMFCore.utils import SimpleItemWithProperties
 from Products.CMFCore.utils import getToolByName
@@ -146,6 +147,10 @@ class Widget(PropertiesPostProcessor, SimpleItemWithProperties):
         # JavaScript
         {'id': 'javascript_expr', 'type': 'text', 'mode': 'w',
          'label': 'JavaScript (TALES)'},
+        # Caching
+        {'id': 'cache_view_rendering', 'type': 'boolean', 'mode': 'w',
+         'label': 'Cache the view rendering for anonymous users '
+         '(see FragmentCache)'},
         )
 
     fields = []
@@ -167,6 +172,7 @@ class Widget(PropertiesPostProcessor, SimpleItemWithProperties):
     css_class_expr = ''
     javascript_expr = ''
     fieldset = False
+    cache_view_rendering = False
 
     field_types = []
     field_inits = [] # default settings for fields created in flexible mode
@@ -208,6 +214,17 @@ class Widget(PropertiesPostProcessor, SimpleItemWithProperties):
         """Get the html-form version of this widget's id."""
         return widgetname(self.getWidgetId())
 
+    def _postProcessProperties(self):
+        """Post-processing after properties change.
+
+        Also tells the layout, which may have cached computations about
+        its widgets.
+        """
+        PropertiesPostProcessor._postProcessProperties(self)
+        layout = aq_parent(aq_inner(self))
+        if getattr(aq_base(layout), 'subObjectChanged', None) is not None:
+            layout.subObjectChanged()
+
     #
     # Widget access control
     #
@@ -375,6 +392,29 @@ class Widget(PropertiesPostProcessor, SimpleItemWithProperties):
                 js_code = js_code_computed
         return js_code
 
+    # Methods computing the mode, CSS class and JavaScript code
+    _mode_methods = ('getModeFromLayoutMode', 'isReadOnly', '_isReadOnly',
+                     'getCssClass', 'getJavaScriptCode')
+
+    security.declarePrivate('hasDynamicMode')
+    def hasDynamicMode(self):
+        """Tell if the mode, CSS class or JavaScript code may depend on more
+        than the layout mode and the write access to the fields.
+
+        This is the case if expressions are set, or if the widget class
+        computes them differently. Layouts cache them otherwise.
+        """
+        if (self.readonly_if_expr_c or self.hidden_if_expr_c or
+            self.widget_mode_expr_c or self.css_class_expr_c or
+            self.javascript_expr_c):
+            return True
+        klass = self.__class__
+        for name in self._mode_methods:
+            if getattr(klass, name).im_func is not \
+                   getattr(Widget, name).im_func:
+                return True
+        return False
+
 
     #
     # May be overloaded.
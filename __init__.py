@@ -38,6 +38,7 @@ import LocalVocabulary
 logger = getLogger(__name__)
 
 import DiskFile
+import DiskFileTransaction
 
 import utils
 
@@ -50,6 +51,13 @@ tools = (
 registerDirectory('skins', globals())
 
 def initialize(registrar):
+    if DiskFileTransaction.JOURNAL_LOCKING:
+        # only the journals of dead processes
+        try:
+            DiskFileTransaction.recoverJournals()
+        except: # don't prevent startup
+            logger.exception("Could not recover DiskFile journals")
+
     registrar.registerClass(
         Schema.CPSSchema,
         permission=ManagePortal,
@@ -226,15 +226,15 @@ class LayoutXMLAdapter(XMLAdapterBase, PostProcessingPropertyManagerHelpers):
 
     def _extractTable(self):
         layout = self.context
-        layoutdef = layout.getLayoutDefinition()
+        layoutdef = layout.getFrozenLayoutDefinition()
         table_node = self._doc.createElement('table')
-        for row in layoutdef['rows']:
+        for row in layoutdef.rows:
             row_node = self._doc.createElement('row')
             table_node.appendChild(row_node)
             for cell in row:
                 cell_node = self._doc.createElement('cell')
-                cell_node.setAttribute('name', cell['widget_id'])
-                ncols = cell.get('ncols', 1)
+                cell_node.setAttribute('name', cell.widget_id)
+                ncols = cell.ncols
                 if ncols != 1:
                     cell_node.setAttribute('ncols', str(ncols))
                 row_node.appendChild(cell_node)
@@ -23,6 +23,7 @@ from Testing.ZopeTestCase import ZopeTestCase
 from Acquisition import Implicit
 from DateTime.DateTime import DateTime
 from Products.CPSSchemas.StorageAdapter import BaseStorageAdapter
+from Products.CPSSchemas.StorageAdapter import getAccessPlan
 from Products.CPSSchemas.StorageAdapter import AttributeStorageAdapter
 from Products.CPSSchemas.StorageAdapter import MetaDataStorageAdapter
 from Products.CPSSchemas.StorageAdapter import MappingStorageAdapter
@@ -84,6 +85,7 @@ class TestBaseStorageAdapter(ZopeTestCase):
                         write_process_expr='python: f2+"_uh"',
                         # default write_process will be used
                         )
+        self.schema = schema
         self.adapter = BaseStorageAdapter(schema)
 
     def testInit(self):
@@ -92,6 +94,68 @@ class TestBaseStorageAdapter(ZopeTestCase):
                           {'f2': set(['f6'])})
         self.assertEquals(self.adapter._all_dependents, ['f7'])
 
+    def testWriteDependenciesClosure(self):
+        self.schema.addField('f8', 'CPS String Field',
+                             write_process_expr='python: f6+"_eh"',
+                             write_process_dependent_fields=('f6',))
+        adapter = BaseStorageAdapter(self.schema)
+        self.assertEquals(adapter._plan.write_closure['f2'], ('f6', 'f8'))
+        # dependents come after their ancestors, '*' ones last
+        self.assertEquals([i[0] for i in adapter._plan.write_items],
+                          ['f1', 'f2', 'f3', 'f4', 'f5', 'f6', 'f8', 'f7'])
+
+        data = dict((fid, fid) for fid in self.schema.keys())
+        toset = set(['f2'])
+        new_data = adapter._setDataDoProcess(data, toset=toset)
+        self.assertEquals(toset, set(['f2', 'f6', 'f7', 'f8']))
+        self.assertEquals(new_data['f8'], 'f6_eh')
+
+        # nothing changed, nothing to compute
+        toset = set()
+        self.assertEquals(adapter._setDataDoProcess(data, toset=toset), {})
+        self.assertEquals(toset, set())
+
+    def testSharedExpressionContext(self):
+        # expression contexts are shared, value and field being rebound
+        self.schema.addField('f8', 'CPS String Field',
+                             write_process_expr='python: value+"_eh"')
+        self.schema.addField('f9', 'CPS String Field',
+                             write_process_expr='python: field.getFieldId()')
+        adapter = BaseStorageAdapter(self.schema)
+        self.assertEquals(adapter._plan.write_shared_context_ids,
+                          frozenset(self.schema.keys()))
+        data = dict((fid, fid) for fid in self.schema.keys())
+        new_data = adapter._setDataDoProcess(data)
+        self.assertEquals(new_data['f6'], 'f2_ja')
+        self.assertEquals(new_data['f7'], 'f2_uh')
+        self.assertEquals(new_data['f8'], 'f8_eh')
+        self.assertEquals(new_data['f9'], 'f9')
+
+    def testAccessPlan(self):
+        plan = getAccessPlan(self.schema)
+        self.assert_(self.adapter._plan is plan)
+        self.assertEquals(sorted(plan.ignored_field_ids), ['f5', 'f6', 'f7'])
+        self.assertEquals(sorted(i[0] for i in plan.read_field_items),
+                          ['f1', 'f2', 'f3', 'f4'])
+        self.assertEquals([i[0] for i in plan.read_process_field_items],
+                          ['f5'])
+        self.assertEquals(sorted(i[0] for i in plan.write_items if i[2]),
+                          ['f6', 'f7'])
+        restricted = getAccessPlan(self.schema, field_ids=['f1', 'f5'])
+        self.assertEquals([i[0] for i in restricted.field_items],
+                          ['f1', 'f5'])
+
+        # changing a field invalidates
+        self.schema['f1'].manage_changeProperties(read_ignore_storage=True)
+        plan = getAccessPlan(self.schema)
+        self.failIf(self.adapter._plan is plan)
+        self.assertEquals(sorted(plan.ignored_field_ids),
+                          ['f1', 'f5', 'f6', 'f7'])
+
+        # so does adding one
+        self.schema.addField('f8', 'CPS String Field')
+        self.failIf(getAccessPlan(self.schema) is plan)
+
 
 class TestStorageAdapter(ZopeTestCase):
     def afterSetUp(self):
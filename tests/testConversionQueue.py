@@ -0,0 +1,148 @@
+# (C) Copyright 2010 CPS-CMS Community <http://cps-cms.org/>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+import unittest
+
+import transaction
+from Acquisition import Implicit, aq_inner, aq_parent
+from OFS.Folder import Folder
+from OFS.Image import File
+
+from Products.CPSSchemas.SchemasTool import SchemasTool
+from Products.CPSSchemas.Schema import CPSSchema
+from Products.CPSSchemas.DataModel import DataModel
+from Products.CPSSchemas.StorageAdapter import AttributeStorageAdapter
+from Products.CPSSchemas.ConversionQueue import processConversionQueue
+from Products.CPSSchemas.ConversionQueue import ConversionJobs
+
+
+class FakeRoot(Folder):
+    def getPhysicalPath(self):
+        return ('',)
+    def getPhysicalRoot(self):
+        return self
+
+class FakeUrlTool(Implicit):
+    def getPortalObject(self):
+        return aq_parent(aq_inner(self))
+
+class FakeTransforms(Implicit):
+    def __init__(self):
+        self.calls = []
+    def convertTo(self, mt, raw, **kw):
+        self.calls.append(raw)
+        class Result:
+            def getData(self):
+                return 'converted_' + raw
+        return Result()
+
+
+class TestConversionQueue(unittest.TestCase):
+
+    def setUp(self):
+        root = FakeRoot('')
+        root._setObject('portal', Folder('portal'))
+        portal = self.portal = root.portal
+        portal.default_charset = 'utf-8'
+        portal.portal_url = FakeUrlTool()
+        portal.portal_transforms = self.transforms = FakeTransforms()
+        portal._setObject('portal_schemas', SchemasTool())
+        stool = portal.portal_schemas
+        schema = stool.addSchema('s', CPSSchema('s'))
+        schema.addField('file', 'CPS File Field', suffix_text='_text',
+                        deferred_conversions=True)
+        schema.addField('file_text', 'CPS String Field')
+        portal._setObject('doc', Folder('doc'))
+        self.doc = portal.doc
+
+    def tearDown(self):
+        transaction.abort()
+
+    def makeDataModel(self):
+        schema = self.portal.portal_schemas.s
+        adapter = AttributeStorageAdapter(schema, self.doc)
+        return DataModel(self.doc, (adapter,))
+
+    def getQueue(self):
+        return self.portal.portal_schemas._conversion_queue
+
+    def testDeferredConversions(self):
+        dm = self.makeDataModel()
+        dm._fetch()
+        dm['file'] = File('file', '', 'content')
+        dm._commit(check_perms=0)
+        # not converted yet
+        self.assertEquals(self.transforms.calls, [])
+        self.assertEquals(self.doc.file_text, '')
+        self.assertEquals(list(self.getQueue().keys()),
+                          [('/portal/doc', 'file')])
+
+        self.assertEquals(processConversionQueue(self.portal), 1)
+        self.assertEquals(self.doc.file_text, 'converted_content')
+        self.assertEquals(len(self.getQueue()), 0)
+
+        # unchanged content, nothing queued
+        dm = self.makeDataModel()
+        dm._fetch()
+        dm['file'] = self.doc.file
+        dm._commit(check_perms=0)
+        self.assertEquals(len(self.getQueue()), 0)
+
+    def testStaleJob(self):
+        dm = self.makeDataModel()
+        dm._fetch()
+        dm['file'] = File('file', '', 'content')
+        dm._commit(check_perms=0)
+        # changed behind the queue's back
+        self.doc.file.manage_upload('other content')
+        self.assertEquals(processConversionQueue(self.portal), 1)
+        self.assertEquals(self.transforms.calls, [])
+        self.assertEquals(self.doc.file_text, '')
+
+
+class TestConversionJobs(unittest.TestCase):
+
+    def testResolveConflict(self):
+        job1 = (('s',), 'fp1', 1.0)
+        job2 = (('s',), 'fp2', 2.0)
+        job3 = (('s',), 'fp3', 3.0)
+        old = {'_jobs': {'a': job1, 'b': job1, 'c': job1}}
+        # committed: processed a, queued d and e
+        committed = {'_jobs': {'b': job1, 'c': job1, 'd': job2, 'e': job2}}
+        # new: processed b, queued a again, queued c and e again later
+        new = {'_jobs': {'a': job3, 'c': job3, 'e': job3}}
+        state = ConversionJobs()._p_resolveConflict(old, committed, new)
+        self.assertEquals(state['_jobs'],
+                          {'a': job3, 'c': job3, 'd': job2, 'e': job3})
+
+    def testKeys(self):
+        jobs = ConversionJobs()
+        jobs['b'] = (('s',), 'fp', 1.0)
+        jobs['a'] = (('s',), 'fp', 2.0)
+        self.assertEquals(jobs.keys(), ['b', 'a'])
+        del jobs['b']
+        self.assertEquals(len(jobs), 1)
+
+
+def test_suite():
+    suites = [unittest.makeSuite(TestConversionQueue),
+              unittest.makeSuite(TestConversionJobs)]
+    return unittest.TestSuite(suites)
+
+if __name__=="__main__":
+    unittest.main(defaultTest='test_suite')
@@ -6,11 +6,15 @@ import unittest
 
 from copy import deepcopy
 
-from Acquisition import Implicit
+from Acquisition import Implicit, aq_base, aq_parent
 from OFS.Image import File, Image
 
 from Products.CPSSchemas.DataModel import DataModel, ValidationError
 from Products.CPSSchemas.DataModel import ProtectedFile
+from Products.CPSSchemas.DataModel import DataModelFactory
+from Products.CPSSchemas.DataModel import mergeSchemaFields
+from Products.CPSSchemas.DataModel import ReadAccessError
+from Products.CPSSchemas.DataModel import WriteAccessError
 from Products.CPSSchemas.StorageAdapter import AttributeStorageAdapter
 from Products.CPSSchemas.Schema import CPSSchema
 from Products.CPSSchemas.BasicFields import CPSStringField
@@ -179,6 +183,150 @@ class TestDataModel(unittest.TestCase):
         self.assertEquals(dm.getContext(), self.doc)
         self.assertEquals(dm.getProxy(), None)
 
+    def makeFetched(self, **kw):
+        dm = self.makeOne()
+        dm._fetch(**kw)
+        return dm
+
+    def testLazyFetchMappingAPI(self):
+        # the whole mapping API sees the fields not fetched yet
+        dm = self.makeFetched(lazy=True)
+        self.assertEquals(sort(list(dm)), sort(dm.keys()))
+        self.assertEquals(len(self.makeFetched(lazy=True).items()), 11)
+        self.assertEquals(len(self.makeFetched(lazy=True).values()), 11)
+        self.assertEquals(len(self.makeFetched(lazy=True).copy().data), 11)
+        self.assert_("'f7'" in repr(self.makeFetched(lazy=True)))
+
+    def testLazyFetch(self):
+        dm = self.makeOne()
+        dm._fetch(lazy=True)
+        self.assertEquals(dm.data, {})
+        self.assertEquals(len(dm), 11)
+        self.assert_('f1' in dm)
+        self.failIf('lol' in dm)
+
+        self.assertEquals(dm['f1'], 'f1class')
+        self.assertEquals(sort(dm.data.keys()), ['f1'])
+        # read dependencies are fetched first
+        self.assertEquals(dm['f5'], 'f2inst_yo')
+        self.assertEquals(sort(dm.data.keys()), ['f1', 'f2', 'f5'])
+        # defaults are finalized and dirty
+        self.failIf(dm.isDirty('f3'))
+        self.assertEquals(dm.get('f3'), 'f3def')
+        self.assert_(dm.isDirty('f3'))
+        # setting doesn't need to fetch
+        dm['f4'] = 'f4changed'
+        self.failIf('f4' in dm._unfetched)
+
+        dm._commit(check_perms=0)
+        self.assertEquals(dm._unfetched, {})
+        self.assertEquals(self.doc.f3, 'f3def')
+        self.assertEquals(self.doc.f4, 'f4changed')
+
+    def testFetchFieldIds(self):
+        dm = self.makeOne()
+        dm._fetch(field_ids=('f1', 'f5', 'unknown'))
+        # f2 is needed by the read expression of f5
+        self.assertEquals(sort(dm.data.keys()), ['f1', 'f2', 'f5'])
+        self.assertEquals(dm['f5'], 'f2inst_yo')
+        # other fields are still available
+        self.assertEquals(dm['f3'], 'f3def')
+        self.assertEquals(len(dm.keys()), 11)
+
+    def testAclDecisions(self):
+        self.makeOne()
+        self.schema.addField('fR', 'CPS String Field',
+                             acl_read_roles='Manager')
+        self.schema.addField('fW', 'CPS String Field',
+                             acl_write_expr='python: datamodel.get("f1") == "open"')
+        doc = self.doc
+        dm = DataModel(doc, (AttributeStorageAdapter(self.schema, doc),))
+        dm._fetch()
+        # fields without ACL are never checked
+        self.assert_(('f1', False) in dm._acl_free_decisions)
+        self.assert_(('f1', True) in dm._acl_free_decisions)
+        self.failIf(('fR', False) in dm._acl_free_decisions)
+        self.assert_(('fR', True) in dm._acl_free_decisions)
+        self.failIf(('fW', True) in dm._acl_free_decisions)
+
+        self.assertRaises(ReadAccessError, dm.__getitem__, 'fR')
+        self.assert_(isinstance(dm._acl_decisions[('fR', False)],
+                                ReadAccessError))
+        self.assertRaises(ReadAccessError, dm.__getitem__, 'fR')
+
+        # decisions from expressions are kept until the data changes
+        self.assertRaises(WriteAccessError, dm.__setitem__, 'fW', 'foo')
+        self.assert_(('fW', True) in dm._acl_expr_decisions)
+        dm['f1'] = 'open'
+        self.assertEquals(dm._acl_expr_decisions, {})
+        dm['fW'] = 'foo'
+        self.assertEquals(dm['fW'], 'foo')
+        # also when the data is changed directly (dependant fields)
+        dm.data['f1'] = 'closed'
+        self.assertRaises(WriteAccessError, dm.__setitem__, 'fW', 'bar')
+
+    def testMergeSchemaFields(self):
+        self.makeOne()
+        schema = self.schema
+        fields, acl_free = mergeSchemaFields((schema,))
+        self.assertEquals(sort(fields.keys()), sort(schema.keys()))
+        self.assert_('f1' in fields)
+        self.assertEquals(fields.get('lol'), None)
+        self.assert_(aq_base(aq_parent(fields['f1'])) is aq_base(schema))
+        # schemas not stored in the ZODB are not cached
+        fields2, acl_free = mergeSchemaFields((schema,))
+        self.failIf(fields2._entries is fields._entries)
+
+        base = aq_base(schema)
+        base._p_oid = '\0'*7 + '\1'
+        base._p_serial = '\0'*7 + '\1'
+        fields, acl_free = mergeSchemaFields((schema,))
+        fields2, acl_free = mergeSchemaFields((schema,))
+        self.assert_(fields2._entries is fields._entries)
+        self.assertEquals(fields._entries['f1'], 0)
+        # fields come from the schemas passed, not from the cache
+        other = CPSSchema('s1', 'Schema1').__of__(fakePortal)
+        other.addField('f1', 'CPS String Field')
+        aq_base(other)._p_oid = base._p_oid
+        aq_base(other)._p_serial = base._p_serial
+        fields2, acl_free = mergeSchemaFields((other,))
+        self.assert_(fields2._entries is fields._entries)
+        self.assert_(aq_base(fields2['f1']) is aq_base(other['f1']))
+        # a new serial means a change
+        base._p_serial = '\0'*7 + '\2'
+        fields2, acl_free = mergeSchemaFields((schema,))
+        self.failIf(fields2._entries is fields._entries)
+
+    def testFactory(self):
+        self.makeOne()
+        factory = DataModelFactory((self.schema,))
+        doc1 = self.doc
+        doc2 = FakeDocument()
+        doc2.f2 = 'f2doc2'
+        dm1 = factory.makeDataModel(doc1)
+        dm2 = factory.makeDataModel(doc2)
+        dm1._fetch()
+        dm2._fetch()
+        self.assertEquals(dm1['f5'], 'f2inst_yo')
+        self.assertEquals(dm2['f5'], 'f2doc2_yo')
+        self.assertEquals(sort(dm2.keys()), sort(self.schema.keys()))
+        # field bookkeeping is shared
+        self.assert_(dm1._fields is dm2._fields)
+        self.assert_(dm1._schemas is dm2._schemas)
+        # security information is shared if the context is the same
+        self.failIf(dm1._acl_cache_permissions is
+                    dm2._acl_cache_permissions)
+        folder = FakeDocument()
+        dm3 = factory.makeDataModel(doc1, context=folder)
+        dm4 = factory.makeDataModel(doc2, context=folder)
+        self.assert_(dm3._acl_cache_permissions is
+                     dm4._acl_cache_permissions)
+        self.assertEquals(dm3._acl_cache_user_roles,
+                          dm4._acl_cache_user_roles)
+        dm5 = factory.makeDataModel(doc2, context=folder, add_roles=('Foo',))
+        self.assert_('Foo' in dm5._acl_cache_user_roles)
+        self.failIf('Foo' in dm4._acl_cache_user_roles)
+
     def testCommitDirty(self):
         dm = self.makeOne()
         doc = self.doc
@@ -213,6 +361,39 @@ class TestDataModel(unittest.TestCase):
         self.assertEquals(dm.isDirty('f4'), False)
         self.assertEquals(dm.isDirty('f5'), False)
 
+    def testChangeDetection(self):
+        self.makeOne()
+        self.schema.addField('fL', 'CPS String List Field')
+        doc = self.doc
+        doc.fL = ['a', 'b']
+        commits = []
+        doc.postCommitHook = lambda datamodel: commits.append(datamodel)
+        dm = DataModel(doc, (AttributeStorageAdapter(self.schema, doc),))
+        dm._fetch()
+        dm._commit(check_perms=0) # writes defaults
+        self.assertEquals(len(commits), 1)
+
+        # setting the same values doesn't make dirty
+        dm['f1'] = 'f1class'
+        dm['f2'] = 'f2inst'
+        dm['fL'] = ['a', 'b']
+        self.assertEquals(dm.dirty, set())
+        # same value, other type
+        dm['f2'] = u'f2inst'
+        self.assert_(dm.isDirty('f2'))
+        dm.dirty = set()
+        # list modified in place
+        dm['fL'].append('c')
+        dm['fL'] = dm['fL']
+        self.assert_(dm.isDirty('fL'))
+        dm.dirty = set()
+
+        # nothing to commit
+        doc.f1 = 'overwritten?'
+        dm._commit(check_perms=0)
+        self.assertEquals(len(commits), 1)
+        self.assertEquals(doc.f1, 'overwritten?')
+
     def testValidation(self):
         # Test that validation methods are being called by using the
         # Ascii String Field
@@ -1,28 +1,56 @@
 import unittest
 import os, sys, stat
+import shutil
+from StringIO import StringIO
+
+import transaction
 
 from Products.CPSSchemas.DiskFile import DiskFile
+from Products.CPSSchemas.DiskFile import FLAT_LAYOUT, HASHED_LAYOUT
+from Products.CPSSchemas.DiskFile import DEDUP_LAYOUT
+from Products.CPSSchemas.DiskFileStore import getDedupStore
+from Products.CPSSchemas.DiskFileStore import getContentFilename
+from Products.CPSSchemas import DiskFileTransaction
+from Products.CPSSchemas.DiskFileTransaction import Journal, recoverJournals
+from Products.CPSSchemas.DiskFileScanner import SortedSpool, scanDiskFiles
+from Products.CPSSchemas.DiskFileScanner import DiskFileWalker
+try:
+    from hashlib import sha1
+except ImportError: # python < 2.5
+    from sha import new as sha1
 
 test_data = 'A text string for testing'
 
+class FakeRequest:
+    def __init__(self, **headers):
+        self.headers = headers
+    def get_header(self, name, default=None):
+        return self.headers.get(name.replace('-', '_'), default)
+
+class FakeResponse:
+    status = 200
+    def __init__(self):
+        self.headers = {}
+    def setHeader(self, name, value):
+        self.headers[name] = value
+    def setStatus(self, status):
+        self.status = status
+
 class TestDiskFile(unittest.TestCase):
 
     def setUp(self):
         self.testdir = os.path.join(os.path.split(__file__)[0], 'diskfiletests')
         if not os.path.exists(self.testdir):
             os.mkdir(self.testdir)
+        self.journaldir = os.path.join(self.testdir, 'journal')
+        self.old_journaldir = DiskFileTransaction.JOURNAL_DIRECTORY
+        DiskFileTransaction.JOURNAL_DIRECTORY = self.journaldir
 
     def tearDown(self):
-        scories = os.listdir(self.testdir)
-        for sc in scories:
-            try:
-                os.unlink(os.path.join(self.testdir, sc))
-            except OSError:
-                sys.stderr.write("Could not remove %s in testdir\n", sc)
-        try:
-            os.rmdir(self.testdir)
-        except OSError:
-            pass
+        transaction.abort()
+        DiskFileTransaction.JOURNAL_DIRECTORY = self.old_journaldir
+        getDedupStore(self.testdir).close()
+        shutil.rmtree(self.testdir, ignore_errors=True)
 
     def testUploadAndAbort(self):
         df = DiskFile('id','title', storage_path=self.testdir)
@@ -71,9 +99,14 @@ class TestDiskFile(unittest.TestCase):
         self.assertEquals(df.getData(), test_data)
         # This should be text/plain, so str dumps the beginning of data
         self.assertEquals(str(df), test_data)
+        df.update_data('x' * 1000)
+        df._finish()
+        self.assertEquals(str(df), 'x' * 500)
 
-        # Remove the file:
+        # Remove the file, on commit:
         df.manage_beforeDelete(None,None)
+        self.failUnless(os.path.exists(df.getFullFilename()))
+        df._finish()
         self.failIf(os.path.exists(df.getFullFilename()))
 
     def test_getNewFilename(self):
@@ -125,6 +158,597 @@ class TestDiskFile(unittest.TestCase):
         self.assertEquals(f.read(), 'Some new data')
         f.close()
 
+    def testUpdateFile(self):
+        data = 'x' * (3 * 1 << 16) + 'end'
+        df = DiskFile('id', 'title.txt', storage_path=self.testdir,
+                      file=StringIO(data))
+        self.assertEquals(df.get_size(), len(data))
+        self.assertEquals(df.content_type, 'text/plain')
+        df._finish()
+        self.assertEquals(df.getData(), data)
+        self.assertEquals(df._content_sha1,
+                          sha1(data).hexdigest())
+
+        df.update_file(StringIO(test_data))
+        df._finish()
+        self.assertEquals(df.get_size(), len(test_data))
+        self.assertEquals(df.getData(), test_data)
+        self.assertEquals(df._content_sha1, sha1(test_data).hexdigest())
+
+    def testTransaction(self):
+        transaction.abort()
+        dfs = [DiskFile('id', 'title%d' % i, storage_path=self.testdir,
+                        file=test_data) for i in range(3)]
+        paths = [df.getFullFilename() for df in dfs]
+        transaction.commit()
+        for df, tmp_path in zip(dfs, paths):
+            self.failIf(os.path.exists(tmp_path))
+            self.assertEquals(df.getData(), test_data)
+        # journal removed
+        self.assertEquals(os.listdir(self.journaldir), [])
+
+        dfs[0].update_data('Some new data')
+        tmp_path = dfs[0].getFullFilename()
+        transaction.abort()
+        self.failIf(os.path.exists(tmp_path))
+        self.assertEquals(dfs[0].getData(), test_data)
+
+    def testRecoverJournal(self):
+        removed = os.path.join(self.testdir, 'obsolete')
+        open(removed, 'w').close()
+        df = DiskFile('id', 'title', storage_path=self.testdir,
+                      file='Some new data')
+        ops = df._getFinishOperations()
+        ops.append(('remove', removed))
+        journal = Journal.create(self.journaldir, ops)
+        # in use
+        self.assertEquals(recoverJournals(self.journaldir), 0)
+        journal.markCommitted()
+        journal.close()
+        # crash
+        df._resetPending()
+        self.failIf(os.path.exists(df.getFullFilename()))
+
+        self.assertEquals(recoverJournals(self.journaldir), 1)
+        self.assertEquals(df.getData(), 'Some new data')
+        self.failIf(os.path.exists(removed))
+        self.assertEquals(os.listdir(self.journaldir), [])
+        # nothing left to do
+        self.assertEquals(recoverJournals(self.journaldir), 0)
+
+    def testRecoverUncommittedJournal(self):
+        removed = os.path.join(self.testdir, 'kept')
+        open(removed, 'w').close()
+        journal = Journal.create(self.journaldir, [('remove', removed)])
+        journal.close()
+        # crash before the commit: discarded
+        self.assertEquals(recoverJournals(self.journaldir), 1)
+        self.failUnless(os.path.exists(removed))
+        self.assertEquals(os.listdir(self.journaldir), [])
+
+    def testRecoverDereference(self):
+        store = getDedupStore(self.testdir)
+        filename = getContentFilename(sha1(test_data).hexdigest())
+        store.addRef(filename, 2)
+        ops = [('addref', self.testdir, filename, -1)]
+        journal = Journal.create(self.journaldir, ops)
+        journal.markCommitted()
+        # crash after the change, before it is marked done
+        DiskFileTransaction._applyOperation(ops[0],
+                                            marker=(journal.name, 0))
+        journal.close()
+        self.assertEquals(recoverJournals(self.journaldir), 1)
+        self.assertEquals(store.getRefCount(filename), 1)
+
+        # crash before the change
+        journal = Journal.create(self.journaldir, ops)
+        journal.markCommitted()
+        journal.close()
+        self.assertEquals(recoverJournals(self.journaldir), 1)
+        self.assertEquals(store.getRefCount(filename), 0)
+        # markers forgotten
+        self.assertEquals(store._getConnection().execute(
+            "SELECT COUNT(*) FROM applied").fetchone()[0], 0)
+
+    def testSavepoint(self):
+        transaction.abort()
+        df = DiskFile('id', 'title', storage_path=self.testdir,
+                      file='first')
+        first_tmp = df.getFullFilename()
+        savepoint = transaction.savepoint()
+        df.update_data('second')
+        second_tmp = df.getFullFilename()
+        # kept for the savepoint
+        self.failUnless(os.path.exists(first_tmp))
+        other = DiskFile('other', 'other', storage_path=self.testdir,
+                         file=test_data)
+        other_tmp = other.getFullFilename()
+        savepoint.rollback()
+        self.failIf(os.path.exists(second_tmp))
+        self.failIf(os.path.exists(other_tmp))
+        self.assertEquals(df.getData(), 'first')
+        transaction.commit()
+        self.assertEquals(df.getData(), 'first')
+        self.failIf(os.path.exists(first_tmp))
+
+    def testSavepointStored(self):
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            transaction.abort()
+            df = conn.root()['df'] = DiskFile(
+                'df', 'title', storage_path=self.testdir, file='first')
+            transaction.commit()
+            df.update_data('second')
+            second_tmp = df.getFullFilename()
+            savepoint = transaction.savepoint()
+            df.update_data('third')
+            savepoint.rollback()
+            # invalidated by the rollback, reloaded with its pending changes
+            self.assertEquals(df.getData(), 'second')
+            transaction.commit()
+            self.assertEquals(df.getData(), 'second')
+            self.failIf(os.path.exists(second_tmp))
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testTransactionAbortAfterVote(self):
+        transaction.abort()
+        df = DiskFile('id', 'title', storage_path=self.testdir,
+                      file=test_data)
+        tmp_path = df.getFullFilename()
+        txn = transaction.get()
+        manager = DiskFileTransaction.getDataManager()
+        manager.tpc_begin(txn)
+        manager.commit(txn)
+        manager.tpc_vote(txn)
+        self.assertEquals(len(os.listdir(self.journaldir)), 1)
+        manager.tpc_abort(txn)
+        self.assertEquals(os.listdir(self.journaldir), [])
+        self.failIf(os.path.exists(tmp_path))
+
+    def testTentativeFiles(self):
+        transaction.abort()
+        manager = DiskFileTransaction.getDataManager()
+        dfs = [DiskFile('id', 'title%d' % i, storage_path=self.testdir,
+                        file=test_data) for i in range(2)]
+        paths = [df.getFullFilename() for df in dfs]
+        for df in dfs:
+            manager.registerTentative(df)
+        # e.g. stored by a datamodel commit
+        manager.confirm(dfs[1])
+        transaction.commit()
+        # not stored, the temporary file is removed
+        self.failIf(os.path.exists(paths[0]))
+        self.failIf(os.path.exists(dfs[0].getFullFilename()))
+        self.assertEquals(dfs[1].getData(), test_data)
+
+    def testFactoryFileStored(self):
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        from Products.CPSSchemas.BasicFields import CPSDiskFileField
+        from Products.CPSSchemas.FileUtils import FileObjectFactory
+        field = CPSDiskFileField('f')
+        field.disk_storage_path = self.testdir
+        field.disk_storage_layout = FLAT_LAYOUT
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            transaction.abort()
+            # stored without a datamodel commit, e.g. by a script
+            df = FileObjectFactory.make(field, 'f', 'title', test_data)
+            conn.root()['df'] = df
+            transaction.commit()
+            self.assertEquals(df.getData(), test_data)
+            self.assert_(os.path.exists(df.getFullFilename()))
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testTentativeFileStored(self):
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            transaction.abort()
+            df = DiskFile('id', 'title', storage_path=self.testdir,
+                          file=test_data)
+            DiskFileTransaction.getDataManager().registerTentative(df)
+            # stored without being confirmed
+            conn.root()['df'] = df
+            transaction.commit()
+            self.assertEquals(df.getData(), test_data)
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testCutPaste(self):
+        df = DiskFile('id', 'title', storage_path=self.testdir,
+                      file=test_data)
+        df._finish()
+        path = df.getFullFilename()
+        df.manage_beforeDelete(None, None)
+        df.manage_afterAdd(None, None)
+        self.failIf(hasattr(df, '_copy_data'))
+        df._finish()
+        self.assertEquals(df.getFullFilename(), path)
+        self.assertEquals(df.getData(), test_data)
+
+        # aborted deletion
+        df.manage_beforeDelete(None, None)
+        df._abort()
+        self.assertEquals(df.getData(), test_data)
+
+        # deletion, with volatile attributes lost (deactivated object)
+        df.manage_beforeDelete(None, None)
+        for key in df.__dict__.keys():
+            if key.startswith('_v_'):
+                del df.__dict__[key]
+        df._finish()
+        self.failIf(os.path.exists(path))
+
+    def testCopyPaste(self):
+        df = DiskFile('id', 'title', storage_path=self.testdir,
+                      file=test_data)
+        df._finish()
+        path = df.getFullFilename()
+        df.manage_afterClone(df)
+        self.failIfEqual(df.getFullFilename(), path)
+        self.assertEquals(df.getData(), test_data)
+        # the copy is independent
+        df.update_data('Some new data')
+        df._finish()
+        self.assertEquals(open(path).read(), test_data)
+
+    def testHashedLayout(self):
+        df = DiskFile('id', 'thesong.mp3', storage_path=self.testdir,
+                      layout=HASHED_LAYOUT)
+        df.update_data(test_data)
+        self.assertEquals(df._v_tmp_filename.count('/'), 2)
+        self.failUnless(df._v_tmp_filename.endswith('_tmp.mp3'))
+        df._finish()
+        filename = df._filename
+        self.assertEquals(filename.count('/'), 2)
+        self.failUnless(filename.endswith('.mp3'))
+        self.assertEquals(df.getData(), test_data)
+        # nothing in the flat store itself
+        self.failIf([name for name in os.listdir(self.testdir)
+                     if os.path.isfile(os.path.join(self.testdir, name))])
+
+        df.update_data('Some new data')
+        df._finish()
+        self.assertEquals(df._filename, filename)
+        self.assertEquals(df.getData(), 'Some new data')
+
+        df.manage_afterClone(df)
+        self.failIfEqual(df._filename, filename)
+        self.assertEquals(df._filename.count('/'), 2)
+        self.assertEquals(df.getData(), 'Some new data')
+
+    def testMigrateLayout(self):
+        df = DiskFile('id', 'title', storage_path=self.testdir,
+                      file=test_data)
+        df._finish()
+        old_path = df.getFullFilename()
+        self.failIf(df._migrateLayout(FLAT_LAYOUT))
+
+        # aborted migration
+        self.failUnless(df._migrateLayout(HASHED_LAYOUT))
+        df._abort()
+        self.failUnless(os.path.exists(old_path))
+        df._filename = 'title' # reverted by the ZODB
+        del df._file_layout
+
+        self.failUnless(df._migrateLayout(HASHED_LAYOUT))
+        df._finish()
+        self.assertEquals(df._file_layout, HASHED_LAYOUT)
+        self.assertEquals(df._filename.count('/'), 2)
+        self.failIf(os.path.exists(old_path))
+        self.assertEquals(df.getData(), test_data)
+
+    def testDedupLayout(self):
+        store = getDedupStore(self.testdir)
+        df1 = DiskFile('id', 'one', storage_path=self.testdir,
+                       file=test_data, layout=DEDUP_LAYOUT)
+        df1._finish()
+        df2 = DiskFile('id', 'two', storage_path=self.testdir,
+                       file=test_data, layout=DEDUP_LAYOUT)
+        df2._finish()
+        filename = df1._filename
+        self.assertEquals(df2._filename, filename)
+        self.failUnless(filename.startswith('sha1/'))
+        self.assertEquals(store.getRefCount(filename), 2)
+        self.assertEquals(df2.getData(), test_data)
+
+        # copy
+        df2.manage_afterClone(df2)
+        df2._finish()
+        self.assertEquals(store.getRefCount(filename), 3)
+
+        # move
+        df2.manage_beforeDelete(None, None)
+        df2.manage_afterAdd(None, None)
+        df2._finish()
+        self.assertEquals(store.getRefCount(filename), 3)
+
+        # aborted deletion
+        df2.manage_beforeDelete(None, None)
+        df2._abort()
+        self.assertEquals(store.getRefCount(filename), 3)
+
+        # update
+        df2.update_data('Some new data')
+        df2._finish()
+        self.failIfEqual(df2._filename, filename)
+        self.assertEquals(store.getRefCount(filename), 2)
+        self.assertEquals(store.getRefCount(df2._filename), 1)
+        self.assertEquals(df1.getData(), test_data)
+
+        # deletions and garbage collection
+        df1.manage_beforeDelete(None, None)
+        df1._finish()
+        self.assertEquals(store.collect(), 0)
+        df2.manage_beforeDelete(None, None)
+        df2._finish()
+        self.assertEquals(store.getRefCount(filename), 0)
+        self.failUnless(os.path.exists(df1.getFullFilename()))
+        self.assertEquals(store.collect(), 1)
+        self.failIf(os.path.exists(df1.getFullFilename()))
+        self.failUnless(os.path.exists(df2.getFullFilename()))
+
+    def testDedupCollectOrphans(self):
+        store = getDedupStore(self.testdir)
+        df = DiskFile('id', 'one', storage_path=self.testdir,
+                      file=test_data, layout=DEDUP_LAYOUT)
+        df._finish()
+        orphan = os.path.join(os.path.dirname(df.getFullFilename()), 'orphan')
+        f = open(orphan, 'wb')
+        f.write(test_data)
+        f.close()
+        self.assertEquals(store.collect(), 0) # too recent
+        self.assertEquals(store.collect(grace=-10), 1)
+        self.failIf(os.path.exists(orphan))
+        self.failUnless(os.path.exists(df.getFullFilename()))
+
+    def testDedupCollectRecheck(self):
+        # candidates reused between the walk and their batch are kept
+        store = getDedupStore(self.testdir)
+        df = DiskFile('id', 'one', storage_path=self.testdir,
+                      file=test_data, layout=DEDUP_LAYOUT)
+        df._finish()
+        filename = df._filename
+        store.addRef(filename, -1)
+        store.addRef(filename, 1)
+        self.assertEquals(store._run(store._collectUnused, [filename]), 0)
+        mtime = os.path.getmtime(df.getFullFilename())
+        self.assertEquals(store._run(store._collectUnindexed,
+                                     [(filename, mtime)]), 0)
+        orphan = filename[:-len(df._content_sha1)] + 'orphan'
+        f = open(os.path.join(self.testdir, orphan), 'wb')
+        f.write(test_data)
+        f.close()
+        mtime = os.path.getmtime(os.path.join(self.testdir, orphan))
+        self.assertEquals(store._run(store._collectUnindexed,
+                                     [(orphan, mtime - 10)]), 0)
+        self.assertEquals(store._run(store._collectUnindexed,
+                                     [(orphan, mtime)]), 1)
+
+    def testSortedSpool(self):
+        spool = SortedSpool(chunk_size=3)
+        items = ['b', 'a b', 'e', 'c', 'a', 'd\n', 'b']
+        for item in items:
+            spool.add(item)
+        items.sort()
+        self.assertEquals(list(spool), items)
+
+    def testScanDiskFiles(self):
+        from OFS.Folder import Folder
+        root = Folder('root')
+        root.sub = Folder('sub')
+        root.sub.df1 = DiskFile('df1', 'one', storage_path=self.testdir,
+                                file=test_data)
+        root.sub.df1._finish()
+        root.df2 = DiskFile('df2', 'two', storage_path=self.testdir,
+                            file=test_data, layout=DEDUP_LAYOUT)
+        root.df2._finish()
+        root.df3 = DiskFile('df3', 'three', storage_path=self.testdir,
+                            file=test_data, layout=DEDUP_LAYOUT)
+        root.df3._finish()
+        missing = root.df4 = DiskFile('df4', 'four', storage_path=self.testdir,
+                                      file=test_data)
+        missing._finish()
+        os.remove(missing.getFullFilename())
+        store_path = os.path.normpath(missing._getStorePath())
+        orphan = os.path.join(store_path, 'orphan')
+        f = open(orphan, 'wb')
+        f.write(test_data)
+        f.close()
+        recent = os.path.join(store_path, 'recent')
+        open(recent, 'wb').close()
+        old = os.path.getmtime(orphan) - 7200
+        os.utime(orphan, (old, old))
+
+        report = scanDiskFiles(root)
+        self.assertEquals(report['objects'], 4)
+        self.assertEquals(report['files'], 4)
+        self.assertEquals(report['orphans'], [orphan, recent])
+        self.assertEquals(report['orphans_count'], 2)
+        self.assertEquals(report['missing'],
+                          [os.path.join(store_path, missing._filename)])
+        self.assertEquals(report['removed'], 0)
+        self.failUnless(os.path.exists(orphan))
+
+        # other portals may use the same storage directory
+        self.assertRaises(ValueError, scanDiskFiles, root, delete=True)
+        self.failUnless(os.path.exists(orphan))
+
+    def testWalkBigBTree(self):
+        from BTrees.OOBTree import OOBTree
+        from persistent.mapping import PersistentMapping
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            root = conn.root()
+            # thousands of buckets, chained
+            tree = root['tree'] = OOBTree()
+            for i in xrange(50000):
+                tree['%06d' % i] = PersistentMapping({'i': i})
+            tree['%06d' % 25000]['df'] = DiskFile(
+                'df', 'one', storage_path=self.testdir, file=test_data)
+            transaction.commit()
+            walker = DiskFileWalker()
+            dfs = list(walker.walk(root))
+            self.assertEquals([df.title for df in dfs], ['one'])
+            self.assert_(walker.count > 50000)
+
+            # not committed yet
+            walker = DiskFileWalker()
+            dfs = list(walker.walk(OOBTree(tree)))
+            self.assertEquals([df.title for df in dfs], ['one'])
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testScanDiskFilesDelete(self):
+        from OFS.Folder import Folder
+        from persistent.mapping import PersistentMapping
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            app = conn.root()['Application'] = Folder('app')
+            app.portal = Folder('portal')
+            # not an OFS item
+            app.portal.mapping = PersistentMapping()
+            app.portal.mapping['df'] = DiskFile(
+                'df', 'one', storage_path=self.testdir, file=test_data)
+            # outside of the application
+            conn.root()['other'] = DiskFile(
+                'df', 'two', storage_path=self.testdir, file=test_data,
+                layout=DEDUP_LAYOUT)
+            transaction.commit()
+            store_path = os.path.normpath(app.portal.mapping['df']
+                                          ._getStorePath())
+
+            orphan = os.path.join(store_path, 'orphan')
+            open(orphan, 'wb').close()
+            # content of a DiskFile in another database
+            data = 'Some other data'
+            filename = getContentFilename(sha1(data).hexdigest())
+            referenced = os.path.join(store_path, filename)
+            os.makedirs(os.path.dirname(referenced))
+            f = open(referenced, 'wb')
+            f.write(data)
+            f.close()
+            getDedupStore(self.testdir).addRef(filename, 1)
+            for path in (orphan, referenced):
+                old = os.path.getmtime(path) - 7200
+                os.utime(path, (old, old))
+
+            self.assertRaises(ValueError, scanDiskFiles, app.portal,
+                              delete=True)
+            report = scanDiskFiles(app, delete=True)
+            self.assertEquals(report['objects'], 2)
+            self.assertEquals(report['missing_count'], 0)
+            self.assertEquals(report['orphans'], [orphan, referenced])
+            self.assertEquals(report['removed'], 1)
+            self.assertEquals(report['referenced'], [referenced])
+            self.failIf(os.path.exists(orphan))
+            self.failUnless(os.path.exists(referenced))
+            self.assertEquals(getDedupStore(self.testdir)
+                              .getRefCount(filename), 1)
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testScanDiskFilesRebuild(self):
+        from OFS.Folder import Folder
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+        db = DB(DemoStorage())
+        conn = db.open()
+        try:
+            app = conn.root()['Application'] = Folder('app')
+            app.df1 = DiskFile('df1', 'one', storage_path=self.testdir,
+                               file=test_data, layout=DEDUP_LAYOUT)
+            app.df2 = DiskFile('df2', 'two', storage_path=self.testdir,
+                               file=test_data, layout=DEDUP_LAYOUT)
+            transaction.commit()
+            store = getDedupStore(os.path.normpath(app.df1._getStorePath()))
+            filename = app.df1._filename
+            self.assertEquals(store.getRefCount(filename), 2)
+            # references leaked by a bug
+            store.addRef(filename, 3)
+            leaked = getContentFilename(sha1('Some other data').hexdigest())
+            store.addRef(leaked, 1)
+
+            self.assertRaises(ValueError, scanDiskFiles, Folder('root'),
+                              rebuild=True)
+            report = scanDiskFiles(app, rebuild=True)
+            self.assertEquals(report['objects'], 2)
+            self.assertEquals(report['rebuilt'], 2)
+            self.assertEquals(store.getRefCount(filename), 2)
+            self.assertEquals(store.getRefCount(leaked), 0)
+            # nothing left to fix
+            self.assertEquals(store.rebuildRefCounts([filename] * 2), 0)
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testIndexHtml(self):
+        df = DiskFile('id', 'title', storage_path=self.testdir,
+                      file=test_data)
+        df._finish()
+
+        response = FakeResponse()
+        result = df.index_html(FakeRequest(), response)
+        self.assertEquals(''.join(result), test_data)
+        result.close()
+        self.assertEquals(response.status, 200)
+        self.assertEquals(response.headers['Content-Length'], len(test_data))
+        self.assertEquals(response.headers['Accept-Ranges'], 'bytes')
+
+        response = FakeResponse()
+        result = df.index_html(FakeRequest(Range='bytes=2-5'), response)
+        self.assertEquals(len(result), 4)
+        self.assertEquals(''.join(result), test_data[2:6])
+        result.close()
+        self.assertEquals(response.status, 206)
+        self.assertEquals(response.headers['Content-Range'],
+                          'bytes 2-5/%d' % len(test_data))
+        self.assertEquals(response.headers['Content-Length'], 4)
+
+        response = FakeResponse()
+        result = df.index_html(FakeRequest(Range='bytes=-3'), response)
+        self.assertEquals(''.join(result), test_data[-3:])
+        result.close()
+
+        response = FakeResponse()
+        result = df.index_html(FakeRequest(Range='bytes=1000-'), response)
+        self.assertEquals(result, '')
+        self.assertEquals(response.status, 416)
+
+        # multiple ranges: whole file
+        response = FakeResponse()
+        result = df.index_html(FakeRequest(Range='bytes=0-1,3-4'), response)
+        self.assertEquals(''.join(result), test_data)
+        result.close()
+        self.assertEquals(response.status, 200)
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestDiskFile))
@@ -26,6 +26,9 @@ from DateTime.DateTime import DateTime
 from Products.CPSSchemas import BasicFields
 from Products.CPSSchemas.Field import FieldRegistry
 from Products.CPSSchemas.Field import ValidationError
+from Products.CPSSchemas.Field import StorageNamespace
+from Products.CPSSchemas.Field import isStaticExpression
+from Products.CPSSchemas.DataModel import DEFAULT_VALUE_MARKER
 from Products.CPSSchemas.BasicFields import fromUTF8
 
 class FakePortal(Implicit):
@@ -47,6 +50,35 @@ class Unit(unittest.TestCase):
         # iso-latin-1 instead of utf8, we return unicode in any case
         self.assertTrue(isinstance(fromUTF8('\xc9'), unicode))
 
+    def test_StorageNamespace(self):
+        data = {'f1': 'a', 'f2': DEFAULT_VALUE_MARKER}
+        ns = StorageNamespace(data, value='v')
+        self.assertEquals(ns['value'], 'v')
+        self.assertEquals(ns['f1'], 'a')
+        self.assertEquals(ns['f2'], '')
+        self.assertEquals(ns.get('f3', 'no'), 'no')
+        self.assertRaises(KeyError, ns.__getitem__, 'f3')
+        self.assert_('f1' in ns)
+        self.assert_(ns.has_key('value'))
+        # no copy of data is done
+        data['f3'] = 'c'
+        self.assertEquals(ns['f3'], 'c')
+        # copies are views on the same data
+        ns2 = ns.copy()
+        ns2['value'] = 'w'
+        data['f1'] = 'b'
+        self.assertEquals(ns2['f1'], 'b')
+        self.assertEquals(ns2['value'], 'w')
+        self.assertEquals(ns['value'], 'v')
+
+    def test_isStaticExpression(self):
+        for expr in ('string:', 'string:foo', 'nothing', 'python:[]',
+                     'python: None', 'python:"a"', 'python:-1.5'):
+            self.assert_(isStaticExpression(expr), expr)
+        for expr in ('string:${foo}', 'python:user', 'python:[] + x',
+                     'portal/title'):
+            self.failIf(isStaticExpression(expr), expr)
+
 class BasicFieldTests(unittest.TestCase):
 
     def makeOne(self, cls, fid='the_id'):
@@ -83,6 +115,24 @@ class BasicFieldTests(unittest.TestCase):
             # Check that default is valid
             self.assertEquals(field.validate(default), default)
 
+    def testStaticDefault(self):
+        field = self.makeOne(BasicFields.CPSListField)
+        default = field.getDefault()
+        self.assertEquals(default, [])
+        self.assertEquals(field._v_static_default, ([],))
+        # mutable defaults are copied
+        default.append('foo')
+        self.assertEquals(field.getDefault(), [])
+
+        # changing the expression invalidates
+        field.manage_changeProperties(default_expr="python:['bar']")
+        self.assertEquals(field._v_static_default, None)
+        self.assertEquals(field.getDefault(), ['bar'])
+        self.assertEquals(field._v_static_default, ())
+        field.manage_changeProperties(default_expr_static=True)
+        self.assertEquals(field.getDefault(), ['bar'])
+        self.assertEquals(field._v_static_default, (['bar'],))
+
     def testIntField(self):
         field = self.makeOne(BasicFields.CPSIntField)
         self.assertEquals(field.getDefault(), 0)
@@ -298,6 +348,44 @@ class BasicFieldTests(unittest.TestCase):
 
         # TODO: add test for "dependant fields" themselves there.
 
+    def testFileFieldConversions(self):
+        field = self.makeOne(BasicFields.CPSFileField)
+        field.suffix_text = '_text'
+        schemas = ({'the_id': None, 'the_id_text': None},)
+        calls = []
+        class FakeTransforms(Implicit):
+            def convertTo(self, mt, raw, **kw):
+                calls.append(raw)
+                class Result:
+                    def getData(self):
+                        return 'converted_' + raw
+                return Result()
+        context = FakePortal()
+        context.default_charset = 'utf-8'
+        context.portal_transforms = FakeTransforms()
+
+        file = File('file', '', 'content')
+        data = {'the_id': file, 'the_id_text': None}
+        self.assertEquals(
+            field.computeDependantFields(schemas, data, context=context),
+            ['the_id_text'])
+        self.assertEquals(data['the_id_text'], 'converted_content')
+        self.assertEquals(len(calls), 1)
+
+        # same content, no conversion
+        data['the_id_text'] = 'converted_content'
+        self.assertEquals(
+            field.computeDependantFields(schemas, data, context=context), ())
+        self.assertEquals(len(calls), 1)
+
+        # new content
+        file.manage_upload('new content')
+        self.assertEquals(
+            field.computeDependantFields(schemas, data, context=context),
+            ['the_id_text'])
+        self.assertEquals(data['the_id_text'], 'converted_new content')
+        self.assertEquals(len(calls), 2)
+
     def testSubOjectsField(self):
         # non-regression test for #1943
         field = self.makeOne(BasicFields.CPSSubObjectsField)
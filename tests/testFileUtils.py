@@ -1,11 +1,16 @@
 # (c) 2003 Nuxeo SARL <http://nuxeo.com>
 # $Id$
 
+import os
 import unittest
+import shutil
+import tempfile
 
 from Acquisition import Implicit
 from OFS.Image import File
 from Products.CPSSchemas import FileUtils
+from Products.CPSSchemas.ConversionCache import ConversionCache
+from Products.CPSSchemas.ConversionCache import setConversionCache
 
 
 class FakePortal(Implicit):
@@ -52,9 +57,119 @@ class TestFileUtils(unittest.TestCase):
         result = FileUtils.convertFileToHtml(file, context=fakePortal)
         self.assertEquals(result.getData().strip(), 'converted_test')
 
+    def testGetFileFingerprint(self):
+        self.assertEquals(FileUtils.getFileFingerprint(None), None)
+        file = File('test', 'test', 'test')
+        fingerprint = FileUtils.getFileFingerprint(file)
+        self.assertEquals(fingerprint,
+                          '4:a94a8fe5ccb19ba61c4c0873d391e987982fbbd3')
+        self.assertEquals(
+            FileUtils.getFileFingerprint(File('other', 'other', 'test')),
+            fingerprint)
+        file.manage_upload('tesT')
+        self.assertNotEquals(FileUtils.getFileFingerprint(file), fingerprint)
+
+    def testMaxConversionSize(self):
+        file = File('test', 'test', 'test')
+        portal = FakePortal()
+        portal.portal_transforms = fakePortalTransforms
+        portal.portal_schemas = FakePortal()
+        portal.portal_schemas.max_conversion_size = 3
+        self.assertEquals(FileUtils.convertFileToText(file, context=portal),
+                          None)
+        portal.portal_schemas.max_conversion_size = 4
+        self.assertEquals(FileUtils.convertFileToText(file, context=portal),
+                          'converted_test')
+
+    def testReadFile(self):
+        data = 'x' * (3 * 1 << 16) + 'end'
+        file = File('test', 'test', data)
+        self.assertEquals(FileUtils.readFile(file), data)
+        self.assertEquals(''.join(FileUtils.iterFileChunks(file)), data)
+        self.assertEquals(FileUtils.readFile(file, max_size=1000), None)
+
+
+class TestConversionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ConversionCache(self.path)
+        self.old_cache = setConversionCache(self.cache)
+
+    def tearDown(self):
+        setConversionCache(self.old_cache)
+        shutil.rmtree(self.path)
+
+    def testCachedConversion(self):
+        file = File('test', 'test', 'test')
+        result = FileUtils.convertFileToText(file, context=fakePortal)
+        self.assertEquals(result, 'converted_test')
+        self.assertEquals(self.cache.hits, 0)
+        self.assertEquals(self.cache.misses, 1)
+
+        # same content in another file
+        other = File('other', 'other', 'test')
+        result = FileUtils.convertFileToText(other, context=fakePortal)
+        self.assertEquals(result, 'converted_test')
+        self.assertEquals(self.cache.hits, 1)
+        html = FileUtils.convertFileToHtml(other, context=fakePortal)
+        self.assertEquals(html.getData(), 'converted_test')
+        self.assertEquals(self.cache.misses, 2) # other target
+
+        other.content_type = 'text/html'
+        FileUtils.convertFileToText(other, context=fakePortal)
+        self.assertEquals(self.cache.misses, 3) # other source
+
+        stats = self.cache.getStatistics()
+        self.assertEquals(stats['entries'], 3)
+        self.assertEquals(stats['hits'], 1)
+
+    def testEviction(self):
+        class Result:
+            def __init__(self, data):
+                self.data = data
+            def getData(self):
+                return self.data
+        self.cache.max_size = 2500
+        self.cache.set('a', Result('a' * 1000))
+        self.cache.set('b', Result('b' * 1000))
+        self.assertEquals(self.cache.getStatistics()['entries'], 2)
+        # 'a' is the least recently used
+        os.utime(self.cache._getFilename('a'), (1000, 1000))
+        os.utime(self.cache._getFilename('b'), (2000, 2000))
+        self.cache.set('c', Result('c' * 1000))
+        self.assertEquals(self.cache.getStatistics()['entries'], 2)
+        self.assert_(self.cache.getStatistics()['size'] <= 2500)
+        self.assertEquals(self.cache.get('a'), None)
+        self.assertEquals(self.cache.get('c').getData(), 'c' * 1000)
+
+    def testCorruptedEntry(self):
+        class Result:
+            def getData(self):
+                return 'data'
+        self.cache.set('a', Result())
+        filename = self.cache._getFilename('a')
+        f = open(filename, 'wb')
+        f.write('garbage')
+        f.close()
+        self.assertEquals(self.cache.get('a'), None)
+        self.assertEquals(self.cache.misses, 1)
+        # dropped
+        self.failIf(os.path.exists(filename))
+
+    def testClear(self):
+        file = File('test', 'test', 'test')
+        FileUtils.convertFileToText(file, context=fakePortal)
+        self.cache.clear()
+        self.assertEquals(self.cache.getStatistics(),
+                          {'hits': 0, 'misses': 0, 'size': 0, 'entries': 0})
+
+
 
 def test_suite():
-    suites = [unittest.makeSuite(TestFileUtils)]
+    suites = [unittest.makeSuite(TestFileUtils),
+              unittest.makeSuite(TestConversionCache),
+              ]
     return unittest.TestSuite(suites)
 
 if __name__=="__main__":
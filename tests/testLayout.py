@@ -20,16 +20,25 @@
 
 import unittest
 
+from persistent.TimeStamp import TimeStamp
 from Acquisition import Implicit
 from Products.CPSSchemas.Layout import CPSLayout
 from Products.CPSSchemas.Schema import CPSSchema
 from Products.CPSSchemas.DataStructure import DataStructure
 from Products.CPSSchemas.DataModel import DataModel
 from Products.CPSSchemas.StorageAdapter import AttributeStorageAdapter
+from Products.CPSSchemas.FragmentCache import FragmentCache
+from Products.CPSSchemas.FragmentCache import setFragmentCache
 
 
 class FakePortal(Implicit):
-    pass
+    def getPhysicalPath(self):
+        return ('',)
+    def unrestrictedTraverse(self, rpath):
+        ob = self
+        for segment in rpath.split('/'):
+            ob = getattr(ob, segment)
+        return ob
 fakePortal = FakePortal()
 
 class FakeUrlTool(Implicit):
@@ -96,6 +105,75 @@ class LayoutTests(unittest.TestCase):
                            [{'widget_id': 'my_int2', 'ncols': 1},],
                            [{'widget_id': 'my_string', 'ncols': 1},]])
 
+    def test_getFrozenLayoutDefinition(self):
+        layout = self.makeLayout()
+        frozen = layout.getFrozenLayoutDefinition()
+        self.assert_(layout.getFrozenLayoutDefinition() is frozen)
+        self.assertEquals(frozen.ncols, 1)
+        self.assertEquals(len(frozen.rows), 3)
+        cell = frozen.rows[0][0]
+        self.assertEquals(cell.widget_id, 'my_int')
+        self.assertEquals(cell['ncols'], 1)
+        self.assertRaises(AttributeError, setattr, cell, 'ncols', 2)
+        self.assertRaises(AttributeError, setattr, frozen, 'ncols', 2)
+        self.assertEquals(frozen.asDict(), layout.getLayoutDefinition())
+
+        layoutdef = frozen.asDict()
+        layoutdef['rows'][0].append({'widget_id': 'my_string', 'ncols': 2})
+        layout.setLayoutDefinition(layoutdef)
+        frozen = layout.getFrozenLayoutDefinition()
+        self.assertEquals(frozen.ncols, 3)
+        self.assertEquals([cell.widget_id for cell in frozen.rows[0]],
+                          ['my_int', 'my_string'])
+
+    def test_getFrozenLayoutDefinition_extra(self):
+        # keys other than the standard ones are kept, read-only
+        layout = self.makeLayoutOnlyWidgets()
+        layoutdef = {'ncols': 1, 'style': 'compact', 'rows': [
+            [{'widget_id': 'my_int', 'ncols': 1, 'css_class': ['row']}],
+            [{'widget_id': 'my_string', 'ncols': 1}]]}
+        layout.setLayoutDefinition(layoutdef)
+        frozen = layout.getFrozenLayoutDefinition()
+        self.assertEquals(frozen['style'], 'compact')
+        self.assertEquals(frozen.get('nothing'), None)
+        cell = frozen.rows[0][0]
+        self.assertEquals(cell['css_class'], ['row'])
+        self.assertRaises(KeyError, cell.__getitem__, 'nothing')
+        self.assertEquals(frozen.asDict(), layout.getLayoutDefinition())
+        cell.asDict()['css_class'].append('changed')
+        self.assertEquals(cell['css_class'], ['row'])
+
+        dm = self.makeDataModelWithSchema()
+        ds = self.makeDataStructure(dm)
+        layout.prepareLayoutWidgets(ds)
+        ls = layout.computeLayoutStructure('edit', dm)
+        self.assertEquals(ls['style'], 'compact')
+        self.assertEquals(ls['rows'][0][0]['css_class'], ['row'])
+        self.assertEquals(ls['rows'][0][0]['widget_id'], 'my_int')
+        self.failIf('css_class' in ls['rows'][1][0])
+
+    def test_getLayoutFieldIds(self):
+        layout = self.makeLayout()
+        layout.addWidget('unused', 'String Widget', fields=['unused'])
+        self.assertEquals(layout.getLayoutFieldIds('view'),
+                          frozenset(['my_int', 'my_int2', 'my_string']))
+
+        # compound widgets are followed
+        layout.addWidget('compound', 'Compound Widget',
+                         widget_ids=['unused'])
+        layoutdef = layout.getLayoutDefinition()
+        layoutdef['rows'].append([{'widget_id': 'compound', 'ncols': 1}])
+        layout.setLayoutDefinition(layoutdef)
+        self.assertEquals(layout.getLayoutFieldIds('view'),
+                          frozenset(['my_int', 'my_int2', 'my_string',
+                                     'unused']))
+
+        # widget changes are taken into account
+        layout['my_int'].manage_changeProperties(hidden_layout_modes=['view'])
+        self.assertEquals(layout.getLayoutFieldIds('view'),
+                          frozenset(['my_int2', 'my_string', 'unused']))
+        self.assert_('my_int' in layout.getLayoutFieldIds('edit'))
+
     def test_prepareLayoutWidgets(self):
         layout = self.makeLayout()
         dm = self.makeDataModelWithSchema()
@@ -142,6 +220,111 @@ class LayoutTests(unittest.TestCase):
         self.assertEquals(ls['widgets'].has_key('my_int'), True)
         self.assertEquals(ls['widgets'].has_key('my_string'), True)
 
+    def test_computeLayoutStructure_cache(self):
+        layout = self.makeLayout()
+        dm = self.makeDataModelWithSchema()
+        ds = self.makeDataStructure(dm)
+        layout.prepareLayoutWidgets(ds)
+
+        ls = layout.computeLayoutStructure('view', dm)
+        self.assertEquals(len(layout._v_layout_skeletons), 1)
+        cell = ls['rows'][0][0]
+        self.assertEquals(cell['widget_id'], 'my_int')
+        self.assertEquals(cell['widget_mode'], 'view')
+        cell['widget_rendered'] = 'rendered'
+        ls['widgets']['my_int']['widget_mode'] = 'hidden'
+
+        # structures are independent
+        ls = layout.computeLayoutStructure('view', dm)
+        self.assertEquals(len(layout._v_layout_skeletons), 1)
+        cell = ls['rows'][0][0]
+        self.failIf('widget_rendered' in cell)
+        self.assertEquals(cell['widget_mode'], 'view')
+        self.assertEquals(ls['widgets']['my_int']['widget_mode'], 'view')
+        self.assertEquals(layout.getLayoutDefinition()['rows'][0],
+                          [{'widget_id': 'my_int', 'ncols': 1}])
+
+        # widget changes are taken into account
+        layout['my_int'].manage_changeProperties(hidden_layout_modes=['view'])
+        ls = layout.computeLayoutStructure('view', dm)
+        self.assertEquals([row[0]['widget_id'] for row in ls['rows']],
+                          ['my_int2', 'my_string'])
+        ls = layout.computeLayoutStructure('edit', dm)
+        self.assertEquals(ls['rows'][0][0]['widget_mode'], 'edit')
+        self.assertEquals(len(layout._v_layout_skeletons), 2)
+
+    def makeLayoutWithIndirectWidget(self):
+        from Products.CPSSchemas.Widget import widgetRegistry
+        from Products.CPSSchemas.widgets.indirect import IndirectWidget
+        fakePortal.base_int = widgetRegistry.getClass('Int Widget')(
+            'base_int', fields=['my_int'])
+        layout = self.makeLayout()
+        layout.addSubObject(IndirectWidget('ind'))
+        ind = layout['ind']
+        ind.manage_changeProperties(base_widget_rpath='base_int')
+        ind.manage_addProperty('fields', ('my_int2',), 'lines')
+        layoutdef = layout.getLayoutDefinition()
+        layoutdef['rows'].append([{'widget_id': 'ind', 'ncols': 1}])
+        layout.setLayoutDefinition(layoutdef)
+        return layout
+
+    def test_computeLayoutStructure_indirect(self):
+        layout = self.makeLayoutWithIndirectWidget()
+        base = fakePortal.base_int
+        try:
+            dm = self.makeDataModelWithSchema()
+            ds = self.makeDataStructure(dm)
+            layout.prepareLayoutWidgets(ds)
+            ls = layout.computeLayoutStructure('view', dm)
+            self.assertEquals(len(ls['rows']), 4)
+            cell = ls['rows'][3][0]
+            self.assertEquals(cell['widget_id'], 'ind')
+            self.assertEquals(cell['widget_mode'], 'view')
+            self.assert_('ind' in layout._getStaticWidgetIds())
+
+            # changes of the base widget are taken into account
+            base.manage_changeProperties(hidden_layout_modes=['view'])
+            base._p_serial = '\0' * 7 + '\1' # as if committed
+            ls = layout.computeLayoutStructure('view', dm)
+            self.assertEquals([row[0]['widget_id'] for row in ls['rows']],
+                              ['my_int', 'my_int2', 'my_string'])
+
+            # and of the indirect widget itself
+            layout['ind'].manage_addProperty('hidden_layout_modes', '',
+                                             'tokens')
+            ls = layout.computeLayoutStructure('view', dm)
+            self.assertEquals(len(ls['rows']), 4)
+        finally:
+            del fakePortal.base_int
+
+    def test_getLayoutFieldIds_indirect(self):
+        layout = self.makeLayoutWithIndirectWidget()
+        base = fakePortal.base_int
+        try:
+            self.assertEquals(layout.getLayoutFieldIds('view'),
+                              frozenset(['my_int', 'my_int2', 'my_string']))
+            layout['my_int2'].manage_changeProperties(
+                hidden_layout_modes=['view'])
+            # still used by the indirect widget
+            self.assertEquals(layout.getLayoutFieldIds('view'),
+                              frozenset(['my_int', 'my_int2', 'my_string']))
+
+            # changes of the base widget are taken into account
+            base.manage_changeProperties(hidden_layout_modes=['view'])
+            base._p_serial = '\0' * 7 + '\1' # as if committed
+            self.assertEquals(layout.getLayoutFieldIds('view'),
+                              frozenset(['my_int', 'my_string']))
+        finally:
+            del fakePortal.base_int
+
+    def test_hasDynamicMode(self):
+        layout = self.makeLayout()
+        widget = layout['my_string']
+        self.failIf(widget.hasDynamicMode())
+        widget.manage_changeProperties(css_class_expr='string:foo')
+        self.assert_(widget.hasDynamicMode())
+        self.assertEquals(layout._getStaticWidgetIds(), ('my_int', 'my_int2'))
+
     def test_validateLayoutStructure(self):
         layout = self.makeLayout()
         dm = self.makeDataModelWithSchema()
@@ -180,9 +363,109 @@ class LayoutTests(unittest.TestCase):
         validation = layout.validateLayoutStructure(ls, ds)
         self.assert_(validation)
 
+    def test_renderLayoutStructure_fragment_cache(self):
+        layout = self.makeLayout()
+        widget = layout['my_int']
+        widget.manage_changeProperties(cache_view_rendering=True)
+        widget._p_serial = TimeStamp(2010, 1, 1, 0, 0, 0).raw()
+        dm = self.makeDataModelWithSchema()
+        doc = dm.getObject()
+        doc._p_mtime = 1262304000.0
+        doc.getPhysicalPath = lambda: ('', 'doc')
+        cache = FragmentCache()
+        old = setFragmentCache(cache)
+        try:
+            for i in range(2):
+                ds = self.makeDataStructure(dm)
+                layout.prepareLayoutWidgets(ds)
+                ls = layout.computeLayoutStructure('view', dm)
+                layout.renderLayoutStructure(ls, ds, layout_mode='view')
+                self.assertEquals(ls['rows'][0][0]['widget_rendered'], '13')
+            self.assertEquals(cache.getStatistics()['entries'], 1)
+            self.assertEquals(cache.hits, 1)
+
+            # other values, other fragment
+            dm['my_int'] = 14
+            ds = self.makeDataStructure(dm)
+            layout.prepareLayoutWidgets(ds)
+            ls = layout.computeLayoutStructure('view', dm)
+            layout.renderLayoutStructure(ls, ds, layout_mode='view')
+            self.assertEquals(ls['rows'][0][0]['widget_rendered'], '14')
+            self.assertEquals(cache.hits, 1)
+        finally:
+            setFragmentCache(old)
+
+    def test_renderLayoutStructure_fragment_cache_indirect(self):
+        layout = self.makeLayoutWithIndirectWidget()
+        base = fakePortal.base_int
+        base.manage_changeProperties(cache_view_rendering=True)
+        base._p_serial = TimeStamp(2010, 1, 1, 0, 0, 0).raw()
+        layout['ind']._p_serial = TimeStamp(2010, 1, 1, 0, 0, 0).raw()
+        dm = self.makeDataModelWithSchema()
+        doc = dm.getObject()
+        doc._p_mtime = 1262304000.0
+        doc.getPhysicalPath = lambda: ('', 'doc')
+        cache = FragmentCache()
+        old = setFragmentCache(cache)
+
+        def render():
+            ds = self.makeDataStructure(dm)
+            layout.prepareLayoutWidgets(ds)
+            ls = layout.computeLayoutStructure('view', dm)
+            layout.renderLayoutStructure(ls, ds, layout_mode='view')
+            self.assertEquals(ls['rows'][3][0]['widget_rendered'], '23')
+
+        try:
+            render()
+            render()
+            # only the indirect widget has a base widget caching renderings
+            self.assertEquals(cache.getStatistics()['entries'], 1)
+            self.assertEquals(cache.hits, 1)
+
+            # the base widget changed, its fragments aren't used anymore
+            base._p_serial = TimeStamp(2010, 1, 2, 0, 0, 0).raw()
+            render()
+            self.assertEquals(cache.getStatistics()['entries'], 2)
+            self.assertEquals(cache.hits, 1)
+        finally:
+            setFragmentCache(old)
+            del fakePortal.base_int
+
+
+class FragmentCacheTests(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = FragmentCache(100)
+        self.assertEquals(cache.get('a'), None)
+        self.assert_(cache.set('a', 'x' * 10))
+        self.assertEquals(cache.get('a'), 'x' * 10)
+        self.assertEquals(cache.size, 10)
+        self.assert_(cache.set('a', u'y' * 10))
+        self.assertEquals(cache.size, 20)
+        self.failIf(cache.set('b', 'x' * 101))
+        self.assertEquals(cache.getStatistics(),
+                          {'hits': 1, 'misses': 1, 'size': 20, 'entries': 1})
+        cache.clear()
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.size, 0)
+
+    def test_eviction(self):
+        cache = FragmentCache(100)
+        for key in 'abcd':
+            cache.set(key, 'x' * 25)
+        cache.get('a') # recently used
+        cache.set('e', 'x' * 25)
+        self.assertEquals(cache.size, 75)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('c'), None)
+        self.assertEquals(cache.get('a'), 'x' * 25)
+        self.assertEquals(cache.get('e'), 'x' * 25)
+
+
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(LayoutTests),
+        unittest.makeSuite(FragmentCacheTests),
         ))
 
 if __name__ == '__main__':
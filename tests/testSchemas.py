@@ -37,6 +37,17 @@ class TestSchemas(unittest.TestCase):
         self.assertEquals(tool['s1'], schema1)
         self.assertEquals(tool['s2'], schema2)
 
+    def testDataModelFactory(self):
+        tool = SchemasTool()
+        schema1 = tool.addSchema('s1', CPSSchema('s1', 'Schema1'))
+        schema1.addField('f1', 'CPS String Field')
+        schema2 = tool.addSchema('s2', CPSSchema('s2', 'Schema2'))
+        schema2.addField('f2', 'CPS String Field')
+        factory = tool.getDataModelFactory(['s2', 's1'])
+        self.assertEquals([s.getId() for s in factory.schemas], ['s2', 's1'])
+        dm = factory.makeDataModel(None)
+        self.assertEquals(sorted(dm._fields.keys()), ['f1', 'f2'])
+
     def testSchema(self):
         schema = CPSSchema('s1', 'Schema1')
         self.assertEquals(schema.getId(), 's1')
@@ -46,6 +57,25 @@ class TestSchemas(unittest.TestCase):
         self.assertEquals(schema['f1'].getFieldId(), 'f1')
         self.assertEquals(schema['f2'].getFieldId(), 'f2')
 
+    def testKeyIndex(self):
+        schema = CPSSchema('s1', 'Schema1')
+        schema.addField('f1', 'CPS String Field')
+        schema.addField('f2', 'CPS Int Field')
+        self.assert_(schema.has_key('f1'))
+        self.assert_(schema.has_key('f__f1'))
+        self.failIf(schema.has_key('f3'))
+        self.assertEquals([(k, v.getId()) for k, v in schema.items()],
+                          [('f1', 'f__f1'), ('f2', 'f__f2')])
+        # changes are seen
+        schema.addField('f3', 'CPS String Field')
+        self.assert_(schema.has_key('f3'))
+        schema.delSubObject('f1')
+        self.failIf(schema.has_key('f1'))
+        self.assertEquals(schema.keys(), ['f2', 'f3'])
+        # keys can be modified by the caller
+        schema.keys().append('foo')
+        self.assertEquals(schema.keys(), ['f2', 'f3'])
+
     def testSchemaAdapter(self):
         schema = CPSSchema('s1', 'Schema1')
         self.assertEquals(isinstance(schema.getStorageAdapter(object()),
@@ -27,6 +27,7 @@ from OFS.SimpleItem import Item
 from Products.CPSUtil.text import OLD_CPS_ENCODING, upgrade_string_unicode
 from Vocabulary import Vocabulary, CPSVocabulary
 from DataModel import WriteAccessError
+from DiskFile import DiskFile, HASHED_LAYOUT
 
 logger = logging.getLogger(__name__)
 
@@ -93,6 +94,31 @@ def _fix_attached_one(id, ob, counter):
     if counter[0] % 1000 == 0:
         logger.info("Fixed %d attached file names so far", counter[0])
 
+def migrate_disk_files_layout(portal, layout=HASHED_LAYOUT):
+    """Move the files of all DiskFile objects to another storage layout.
+
+    Typically used to move existing var/files stores to the hashed layout,
+    where new file names are allocated without listing the directory.
+    Files are hardlinked (or copied) to their new names, and the old ones
+    removed at the end of the transaction.
+
+    Set disk_storage_layout on portal_schemas for new files.
+    """
+    counter = [0]
+    _migrate_disk_files_recurse(portal, layout, counter)
+    logger.info("Moved %d disk files to the %s layout.", counter[0], layout)
+
+def _migrate_disk_files_recurse(ob, layout, counter):
+    ob.getId() # unghostify, so that __dict__ is fetched
+    for key, value in ob.__dict__.items():
+        if isinstance(value, DiskFile):
+            if getattr(ob, key)._migrateLayout(layout):
+                counter[0] += 1
+                if counter[0] % 1000 == 0:
+                    logger.info("Moved %d disk files so far", counter[0])
+        elif isinstance(value, Item):
+            _migrate_disk_files_recurse(getattr(ob, key), layout, counter)
+
 def fix_voc_unicode(voc):
     if not isinstance(voc, CPSVocabulary):
         raise ValueError(
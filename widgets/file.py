@@ -36,6 +36,9 @@ from Products.CPSUtil.html import renderHtmlTag
 from Products.CPSUtil.file import PersistableFileUpload
 from Products.CPSUtil.file import makeFileUploadFromOFSFile
 from Products.CPSSchemas.utils import getHumanReadableSize
+from Products.CPSSchemas.FileUtils import FileObjectFactory
+from Products.CPSSchemas.DiskFile import DiskFile
+from Products.CPSSchemas.DiskFileTransaction import getDataManager
 from Products.CPSSchemas.Widget import CPSWidget
 
 logger = logging.getLogger(__name__)
@@ -189,7 +192,21 @@ class CPSFileWidget(CPSWidget):
         return '', {}
 
     def makeFile(self, filename, fileupload, datastructure):
-        return File(self.fields[0], filename, fileupload)
+        field_id = self.fields[0]
+        getField = getattr(datastructure.getDataModel(), 'getField', None)
+        field = getField is not None and getField(field_id) or None
+        if (field is not None
+            and field.meta_type in FileObjectFactory.methods):
+            # e.g., disk files are written directly from the upload
+            file = FileObjectFactory.make(field, field_id, filename,
+                                          fileupload)
+            if isinstance(file, DiskFile):
+                # the temporary file is removed at the end of the
+                # transaction unless the DiskFile is stored by a datamodel
+                # commit (see CPSDiskFileField.computeDependantFields)
+                getDataManager().registerTentative(file)
+            return file
+        return File(field_id, filename, fileupload)
 
     def otherProcessing(self, choice, datastructure):
         return
@@ -30,6 +30,13 @@ from Products.CPSSchemas.Layout import CPSLayout
 
 from Products.CPSSchemas.interfaces import IWidget
 
+
+def _getPersistentState(ob):
+    """Return (serial, changed) of a persistent object."""
+    ob._p_activate() # invalidated objects are ghosts, with an old serial
+    return (ob._p_serial, ob._p_changed)
+
+
 class IndirectWidget(SimpleItemWithProperties, object):
     """See documentation in CPSSchemas/doc/indirect_widget
 
@@ -65,6 +72,7 @@ class IndirectWidget(SimpleItemWithProperties, object):
                    )
 
     _v_worker = (None, None) # actualy, worker + base widget
+    _v_base_state = None # of the base widget the worker was made from
     _v_parent = (None,)
     is_parent_indirect = True
 
@@ -78,7 +86,8 @@ class IndirectWidget(SimpleItemWithProperties, object):
 
     def getWorkerWidget(self):
         worker, base = self._v_worker
-        if worker is None:
+        if worker is None or _getPersistentState(base) != self._v_base_state:
+            # new, or the base widget changed
             self.makeWorkerWidget()
             worker, base = self._v_worker
 
@@ -101,6 +110,14 @@ class IndirectWidget(SimpleItemWithProperties, object):
 #    def title_or_id(self):
 #        return self.getWorkerWidget().title or self.getId()
 
+    def getBaseWidgetState(self):
+        """Return the state of the base widget, which changes with it.
+
+        Layouts use it to drop their caches (see CPSLayout).
+        """
+        self.getWorkerWidget()
+        return self._v_base_state
+
     def clear(self):
         try:
             delattr(self, '_v_worker')
@@ -138,6 +155,7 @@ class IndirectWidget(SimpleItemWithProperties, object):
 
         # store in volatile var, without any aq wrapping (tuple hack)
         self._v_worker = (worker, base)
+        self._v_base_state = _getPersistentState(base)
 
     security.declarePublic('getWidgetId')
     def getWidgetId(self):
@@ -194,6 +212,21 @@ class IndirectWidget(SimpleItemWithProperties, object):
             'label_edit', 'hidden_empty', 'required',
             'label', 'help', 'is_i18n', 'fieldset'])
 
+    def _setPropValue(self, id, value):
+        SimpleItemWithProperties._setPropValue(self, id, value)
+        self._propertiesChanged()
+
+    def _delProperty(self, id):
+        SimpleItemWithProperties._delProperty(self, id)
+        self._propertiesChanged()
+
+    def _propertiesChanged(self):
+        """Rebuild the worker, and tell the layout to drop its caches."""
+        self.clear()
+        layout = self._v_parent[0]
+        if layout is not None:
+            layout.subObjectChanged()
+
     def valid_property_id(self, pid):
         """Allow adding properties on attributes that are forwarded.
         """